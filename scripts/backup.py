@@ -0,0 +1,160 @@
+"""Export snippets of XSnippet API to a file, and import them back.
+
+The export is streamed from `GET /v1/snippets/export` as newline-delimited
+JSON and appended to the output file line by line. An interrupted export is
+resumed from the last complete line of the file, so running the very same
+command again picks up where the previous run has stopped:
+
+    python scripts/backup.py --url https://api.xsnippet.org \\
+        --token "$TOKEN" export snippets.ndjson
+
+The file can be imported into another instance (e.g. to seed a test
+environment) via `POST /v1/snippets/import/bulk`, which requires a token with
+the `import` permission. Snippets that already exist are reported as
+duplicates and skipped, so an import can be safely repeated, too:
+
+    python scripts/backup.py --url http://127.0.0.1:8000 \\
+        --token "$IMPORT_TOKEN" import snippets.ndjson
+
+The token can also be passed via the XSNIPPET_TOKEN environment variable.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import sys
+
+import requests
+
+
+# Connect and read timeouts in seconds. The read timeout limits the gaps
+# between the chunks of a streamed response, not the duration of an export.
+TIMEOUT = (10, 300)
+# The size of the chunks the output file is read backwards in when an export
+# is resumed.
+TAIL_CHUNK_SIZE = 64 * 1024
+
+
+def _last_checkpoint(path):
+    """Return the creation date and the id of the last snippet in the file.
+
+    A line that has been cut off by an interrupted export is removed, so that
+    the export can be appended to the file right away. None is returned if
+    the file does not exist or has no complete lines.
+    """
+
+    try:
+        f = open(path, "rb+")
+    except FileNotFoundError:
+        return None
+
+    with f:
+        size = f.seek(0, os.SEEK_END)
+
+        # read the file backwards until the last complete line is found
+        tail = b""
+        while len(tail) < size and tail.count(b"\n") < 2:
+            chunk = min(TAIL_CHUNK_SIZE, size - len(tail))
+            f.seek(size - len(tail) - chunk)
+            tail = f.read(chunk) + tail
+
+        end = tail.rfind(b"\n") + 1
+        f.truncate(size - len(tail) + end)
+
+        complete = tail[:end].rstrip(b"\n")
+        line = complete[complete.rfind(b"\n") + 1:]
+        if not line:
+            return None
+
+    snippet = json.loads(line)
+    return snippet["created_at"], snippet["id"]
+
+
+def export_snippets(session, args):
+    params = {}
+    checkpoint = _last_checkpoint(args.output)
+    if checkpoint is not None:
+        params["after_created_at"], params["after_id"] = checkpoint
+        print(f"Resuming the export after snippet {checkpoint[1]}", file=sys.stderr)
+
+    count = 0
+    with session.get(f"{args.url}/v1/snippets/export", params=params,
+                     stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+
+        # the server aborts the response if the export fails midway, which
+        # is raised as an error here, so the file never ends with a partial
+        # line that looks complete
+        with open(args.output, "ab") as output:
+            for line in response.iter_lines():
+                if line:
+                    output.write(line + b"\n")
+                    count += 1
+
+    print(f"Exported {count} snippets", file=sys.stderr)
+    return 0
+
+
+def import_snippets(session, args):
+    statuses = collections.Counter()
+    with open(args.input, "rb") as f:
+        while True:
+            batch = list(itertools.islice(f, args.batch_size))
+            if not batch:
+                break
+
+            response = session.post(f"{args.url}/v1/snippets/import/bulk",
+                                    data=b"".join(batch),
+                                    headers={"Content-Type": "application/x-ndjson"},
+                                    timeout=TIMEOUT)
+            response.raise_for_status()
+
+            for result in response.json():
+                statuses[result["status"]] += 1
+                if result["status"] not in (201, 409):
+                    print(f"Failed to import snippet {result['id']}: {result.get('message')}",
+                          file=sys.stderr)
+
+    failed = sum(count for status, count in statuses.items() if status not in (201, 409))
+    print(f"Imported {statuses[201]} snippets, skipped {statuses[409]} existing ones, "
+          f"failed to import {failed}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000",
+                        help="base URL of XSnippet API")
+    parser.add_argument("--token", default=os.getenv("XSNIPPET_TOKEN"),
+                        help="bearer token to authenticate with "
+                             "(default: $XSNIPPET_TOKEN)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="export all snippets to a file")
+    export.add_argument("output", help="file to append the snippets to; an "
+                                       "interrupted export is resumed from it")
+    export.set_defaults(func=export_snippets)
+
+    import_ = commands.add_parser("import", help="import snippets from a file")
+    import_.add_argument("input", help="file with the exported snippets")
+    import_.add_argument("--batch-size", type=int, default=1000,
+                         help="number of snippets sent by a single request")
+    import_.set_defaults(func=import_snippets)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    session = requests.Session()
+    if args.token:
+        session.headers["Authorization"] = f"Bearer {args.token}"
+
+    return args.func(session, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,63 @@
 use std::collections::BTreeSet;
+use std::time::Duration;
 
+use futures_util::future;
 use rocket::fairing::AdHoc;
 use serde::Deserialize;
 
 use super::routes;
-use super::storage::{SqlStorage, Storage};
-use super::web::{AuthValidator, JwtValidator, RequestIdHeader};
+use super::storage::{
+    CacheStats, CachedPages, CachedStorage, MeteredStorage, PoolOptions, PoolStats, ReplicaOptions,
+    SqlStorage, Storage,
+};
+use super::web::{
+    AuthValidator, Compression, Cursors, JwtStats, JwtValidator, Metrics, RequestIdHeader,
+    RequestMetrics, MIN_COMPRESSED_SIZE,
+};
 
 #[derive(Debug, Deserialize)]
 pub struct Config {
     /// Database connection string
     pub database_url: String,
+    /// The maximum number of database connections
+    #[serde(default = "default_database_pool_size")]
+    pub database_pool_size: usize,
+    /// The number of idle database connections opened on startup and kept
+    /// open even if unused, so that the first requests do not wait for them
+    #[serde(default = "default_database_pool_min_idle")]
+    pub database_pool_min_idle: usize,
+    /// The number of milliseconds a request waits for a database connection
+    /// before it fails with 503 Service Unavailable. Setting it to 0 makes the
+    /// requests wait indefinitely
+    #[serde(default = "default_database_pool_wait_timeout_ms")]
+    pub database_pool_wait_timeout_ms: u64,
+    /// The number of milliseconds it may take to establish a new database
+    /// connection. Setting it to 0 disables the timeout
+    #[serde(default = "default_database_connect_timeout_ms")]
+    pub database_connect_timeout_ms: u64,
+    /// The number of seconds after which a database connection is closed and
+    /// replaced by a new one. Setting it to 0 disables the limit
+    #[serde(default = "default_database_connection_max_lifetime")]
+    pub database_connection_max_lifetime: u64,
+    /// The number of seconds after which an unused database connection is
+    /// closed. Setting it to 0 disables the limit
+    #[serde(default = "default_database_connection_max_idle")]
+    pub database_connection_max_idle: u64,
+    /// The number of milliseconds after which a database query is cancelled.
+    /// Setting it to 0 disables the timeout
+    #[serde(default = "default_database_statement_timeout_ms")]
+    pub database_statement_timeout_ms: u64,
+    /// Connection strings of read replicas of the database. Reads are spread
+    /// across the healthy replicas, while writes always go to `database_url`.
+    /// The connection pool of each replica has the same settings as the one
+    /// of the primary
+    #[serde(default)]
+    pub database_replica_urls: Vec<String>,
+    /// The number of milliseconds after a write during which all reads go to
+    /// the primary, so that clients see their own changes even if the
+    /// replicas lag behind
+    #[serde(default = "default_database_read_your_writes_window_ms")]
+    pub database_read_your_writes_window_ms: u64,
 
     /// Keeps a set of supported syntaxes. When set, RESTful API rejects
     /// snippets with *unsupported* syntaxes. Normally this set must be
@@ -29,8 +76,123 @@ pub struct Config {
     /// The location of JWT Key Set with keys used to validate the tokens (e.g. "https://xsnippet.eu.auth0.com/.well-known/jwks.json")
     #[serde(default = "default_jwks_uri")]
     pub jwt_jwks_uri: String,
+    /// The number of milliseconds an attempt to load JWT Key Set may take
+    #[serde(default = "default_jwt_jwks_fetch_timeout_ms")]
+    pub jwt_jwks_fetch_timeout_ms: u64,
+    /// The number of times loading JWT Key Set on startup is retried before
+    /// giving up (or falling back to `jwt_jwks_cache_path`)
+    #[serde(default = "default_jwt_jwks_fetch_retries")]
+    pub jwt_jwks_fetch_retries: u32,
+    /// The file a copy of JWT Key Set is saved to whenever it's loaded. The
+    /// copy is used if JWT Key Set can't be loaded on startup (e.g. because
+    /// the issuer is unavailable)
+    #[serde(default)]
+    pub jwt_jwks_cache_path: Option<String>,
+    /// The maximum number of verified tokens kept in the in-memory cache.
+    /// Setting it to 0 disables the cache
+    #[serde(default = "default_jwt_cache_size")]
+    pub jwt_cache_size: u64,
+    /// The number of seconds after which JWT Key Set is reloaded from
+    /// `jwt_jwks_uri`. Setting it to 0 disables the periodic refresh
+    #[serde(default = "default_jwt_jwks_refresh_interval")]
+    pub jwt_jwks_refresh_interval: u64,
+    /// The minimum number of seconds between two reloads of JWT Key Set
+    /// triggered by tokens signed with unknown keys
+    #[serde(default = "default_jwt_jwks_min_refresh_interval")]
+    pub jwt_jwks_min_refresh_interval: u64,
+
+    /// The maximum total size (in bytes) of snippets kept in the in-memory
+    /// cache. Setting it to 0 disables the cache
+    #[serde(default = "default_snippet_cache_size")]
+    pub snippet_cache_size: u64,
+    /// The number of seconds after which a cached snippet is re-read from the
+    /// database. Writes drop the cached snippets of the instance that has
+    /// made them, but the other instances keep serving theirs (which might
+    /// also have been read from a lagging replica) until they expire, so this
+    /// bounds for how long they can serve a stale snippet
+    #[serde(default = "default_snippet_cache_ttl")]
+    pub snippet_cache_ttl: u64,
+    /// The maximum total size (in bytes) of the first pages of snippets
+    /// (e.g. the latest snippets, or the latest ones with a given tag) kept in
+    /// the in-memory cache. Setting it to 0 disables the cache
+    #[serde(default = "default_page_cache_size")]
+    pub page_cache_size: u64,
+    /// The number of seconds after which a cached page is re-read from the
+    /// database. Writes drop the cached pages of the instance that has made
+    /// them, but the other instances keep serving theirs until they expire
+    #[serde(default = "default_page_cache_ttl")]
+    pub page_cache_ttl: u64,
+
+    /// Response bodies smaller than this number of bytes are not compressed.
+    /// Setting it to 0 makes all compressible responses compressed
+    #[serde(default = "default_compression_min_size")]
+    pub compression_min_size: usize,
+
+    /// The secret pagination cursors are signed with. Must be the same for
+    /// all instances of the service behind a load balancer. When not set, a
+    /// random secret is generated on startup, and the cursors issued by one
+    /// instance take a slower path on the others
+    #[serde(default)]
+    pub pagination_secret: Option<String>,
+}
+
+impl Config {
+    /// Returns the settings of the database connection pool.
+    pub fn pool_options(&self) -> PoolOptions {
+        // 0 means "no limit" for all of the settings
+        let limit = |value: u64, to_duration: fn(u64) -> Duration| {
+            Some(value).filter(|value| *value > 0).map(to_duration)
+        };
+
+        PoolOptions {
+            max_size: self.database_pool_size,
+            wait_timeout: limit(self.database_pool_wait_timeout_ms, Duration::from_millis),
+            connect_timeout: limit(self.database_connect_timeout_ms, Duration::from_millis),
+            max_lifetime: limit(self.database_connection_max_lifetime, Duration::from_secs),
+            max_idle: limit(self.database_connection_max_idle, Duration::from_secs),
+            statement_timeout: limit(self.database_statement_timeout_ms, Duration::from_millis),
+            min_idle: self.database_pool_min_idle,
+        }
+    }
+
+    /// Returns the settings of the read replicas of the database.
+    pub fn replica_options(&self) -> ReplicaOptions {
+        ReplicaOptions {
+            urls: self.database_replica_urls.clone(),
+            read_your_writes_window: Duration::from_millis(
+                self.database_read_your_writes_window_ms,
+            ),
+            ..Default::default()
+        }
+    }
 }
 
+fn default_database_pool_size() -> usize {
+    PoolOptions::default().max_size
+}
+fn default_database_pool_min_idle() -> usize {
+    2
+}
+fn default_database_pool_wait_timeout_ms() -> u64 {
+    1000
+}
+fn default_database_connect_timeout_ms() -> u64 {
+    5000
+}
+fn default_database_connection_max_lifetime() -> u64 {
+    1800
+}
+fn default_database_connection_max_idle() -> u64 {
+    600
+}
+fn default_database_statement_timeout_ms() -> u64 {
+    30000
+}
+fn default_database_read_your_writes_window_ms() -> u64 {
+    ReplicaOptions::default()
+        .read_your_writes_window
+        .as_millis() as u64
+}
 fn default_jwt_audience() -> String {
     "https://api.xsnippet.org".to_string()
 }
@@ -40,6 +202,36 @@ fn default_jwt_issuer() -> String {
 fn default_jwks_uri() -> String {
     "https://xsnippet.eu.auth0.com/.well-known/jwks.json".to_string()
 }
+fn default_jwt_jwks_fetch_timeout_ms() -> u64 {
+    5000
+}
+fn default_jwt_jwks_fetch_retries() -> u32 {
+    3
+}
+fn default_jwt_cache_size() -> u64 {
+    10_000
+}
+fn default_jwt_jwks_refresh_interval() -> u64 {
+    3600
+}
+fn default_jwt_jwks_min_refresh_interval() -> u64 {
+    60
+}
+fn default_snippet_cache_size() -> u64 {
+    64 * 1024 * 1024
+}
+fn default_snippet_cache_ttl() -> u64 {
+    5
+}
+fn default_page_cache_size() -> u64 {
+    16 * 1024 * 1024
+}
+fn default_page_cache_ttl() -> u64 {
+    2
+}
+fn default_compression_min_size() -> usize {
+    MIN_COMPRESSED_SIZE
+}
 
 /// Create and return a Rocket application instance.
 pub fn create_app() -> rocket::Rocket<rocket::Build> {
@@ -51,26 +243,141 @@ pub fn create_app() -> rocket::Rocket<rocket::Build> {
                 return Err(app);
             }
         };
-        let storage: Box<dyn Storage> = match SqlStorage::new(&config.database_url) {
-            Ok(storage) => Box::new(storage),
+        let metrics = match Metrics::new() {
+            Ok(metrics) => metrics,
+            Err(e) => {
+                error!("Failed to create metrics: {}", e);
+                return Err(app);
+            }
+        };
+        let storage = match SqlStorage::with_replicas(
+            &config.database_url,
+            config.pool_options(),
+            config.replica_options(),
+        ) {
+            Ok(storage) => storage,
             Err(e) => {
                 error!("Failed to create a storage connection: {}", e);
                 return Err(app);
             }
         };
-        let auth: Box<dyn AuthValidator> = match JwtValidator::from_config(&config).await {
-            Ok(auth) => Box::new(auth),
+        let pool_stats = storage.pool_stats();
+        let health_check = storage.health_check();
+        let storage = MeteredStorage::new(storage, metrics.storage_durations());
+        let (storage, cache_stats, page_cache_stats) = if config.page_cache_size > 0 {
+            let storage = CachedPages::new(
+                storage,
+                config.page_cache_size,
+                Duration::from_secs(config.page_cache_ttl),
+            );
+            let page_cache_stats = storage.stats();
+            let (storage, cache_stats) = with_snippet_cache(storage, &config);
+            (storage, cache_stats, Some(page_cache_stats))
+        } else {
+            let (storage, cache_stats) = with_snippet_cache(storage, &config);
+            (storage, cache_stats, None)
+        };
+        // both can take a while, so the pool is warmed up while Jwks is loaded
+        let (warm_up, auth) =
+            future::join(health_check.warm_up(), JwtValidator::from_config(&config)).await;
+        if let Err(e) = warm_up {
+            // not fatal: the service is reported as not ready until the
+            // database is reachable
+            warn!("Failed to warm up the database connection pool: {}", e);
+        }
+        let (auth, auth_stats): (Box<dyn AuthValidator>, _) = match auth {
+            Ok(auth) => {
+                let stats = auth.stats();
+                (Box::new(auth), stats)
+            }
             Err(e) => {
                 error!("Failed to create an auth validator: {}", e);
                 return Err(app);
             }
         };
 
+        let metrics = match export_stats(
+            metrics,
+            pool_stats,
+            cache_stats.clone(),
+            page_cache_stats.clone(),
+            auth_stats.clone(),
+        ) {
+            Ok(metrics) => metrics,
+            Err(e) => {
+                error!("Failed to register metrics: {}", e);
+                return Err(app);
+            }
+        };
+
+        let app = match cache_stats {
+            Some(stats) => app.manage(stats.clone()).attach(AdHoc::on_shutdown(
+                "Snippet cache stats",
+                move |_| {
+                    Box::pin(async move {
+                        info!(
+                            hits = stats.hits(),
+                            misses = stats.misses(),
+                            evictions = stats.evictions(),
+                            "Snippet cache stats"
+                        );
+                    })
+                },
+            )),
+            None => app,
+        };
+        let app = match page_cache_stats {
+            Some(stats) => app.attach(AdHoc::on_shutdown("Page cache stats", move |_| {
+                Box::pin(async move {
+                    info!(
+                        hits = stats.hits(),
+                        misses = stats.misses(),
+                        evictions = stats.evictions(),
+                        "Page cache stats"
+                    );
+                })
+            })),
+            None => app,
+        };
+        let app = app.manage(auth_stats.clone()).attach(AdHoc::on_shutdown(
+            "JWT validation stats",
+            move |_| {
+                Box::pin(async move {
+                    info!(
+                        cache_hits = auth_stats.cache_hits(),
+                        cache_misses = auth_stats.cache_misses(),
+                        verifications = auth_stats.verifications(),
+                        verification_failures = auth_stats.verification_failures(),
+                        verification_time_ms = auth_stats.verification_time().as_millis() as u64,
+                        jwks_refreshes = auth_stats.jwks_refreshes(),
+                        jwks_refresh_failures = auth_stats.jwks_refresh_failures(),
+                        "JWT validation stats"
+                    );
+                })
+            },
+        ));
+
+        let compression = Compression {
+            min_size: config.compression_min_size,
+        };
+        let cursors = match &config.pagination_secret {
+            Some(secret) => Cursors::new(secret.as_bytes()),
+            None => {
+                warn!("pagination_secret is not set, using a random one");
+                Cursors::random()
+            }
+        };
+
         Ok(app
             .manage(config)
             .manage(storage)
+            .manage(health_check)
             .manage(auth)
-            .attach(RequestIdHeader))
+            .manage(cursors)
+            .attach(RequestMetrics(metrics.request_durations()))
+            .manage(metrics)
+            .attach(RequestIdHeader)
+            .attach(compression))
     }));
 
     let routes = routes![
@@ -78,8 +385,60 @@ pub fn create_app() -> rocket::Rocket<rocket::Build> {
         routes::snippets::list_snippets,
         routes::snippets::get_snippet,
         routes::snippets::get_raw_snippet,
+        routes::snippets::get_snippet_version,
+        routes::snippets::replace_snippet,
+        routes::snippets::update_snippet,
         routes::syntaxes::get_syntaxes,
         routes::snippets::import_snippet,
+        routes::snippets::import_snippets,
+        routes::snippets::export_snippets,
     ];
-    app.mount("/v1", routes)
+    app.mount("/v1", routes).mount(
+        "/",
+        routes![
+            routes::metrics::get_metrics,
+            routes::health::get_liveness,
+            routes::health::get_readiness,
+        ],
+    )
+}
+
+/// Wrap the storage into the snippet cache, unless the cache is disabled.
+fn with_snippet_cache<S: Storage + 'static>(
+    storage: S,
+    config: &Config,
+) -> (Box<dyn Storage>, Option<CacheStats>) {
+    if config.snippet_cache_size > 0 {
+        let storage = CachedStorage::new(
+            storage,
+            config.snippet_cache_size,
+            Duration::from_secs(config.snippet_cache_ttl),
+        );
+        let stats = storage.stats();
+        (Box::new(storage), Some(stats))
+    } else {
+        (Box::new(storage), None)
+    }
+}
+
+/// Export the stats of the application components as Prometheus metrics.
+fn export_stats(
+    metrics: Metrics,
+    pool_stats: PoolStats,
+    cache_stats: Option<CacheStats>,
+    page_cache_stats: Option<CacheStats>,
+    auth_stats: JwtStats,
+) -> prometheus::Result<Metrics> {
+    let mut metrics = metrics
+        .with_pool_stats(pool_stats)?
+        .with_jwt_stats(auth_stats)?;
+
+    if let Some(stats) = cache_stats {
+        metrics = metrics.with_cache_stats(stats)?;
+    }
+    if let Some(stats) = page_cache_stats {
+        metrics = metrics.with_page_cache_stats(stats)?;
+    }
+
+    Ok(metrics)
 }
@@ -6,6 +6,10 @@ use serde::{ser::SerializeStruct, Serialize, Serializer};
 use crate::storage::StorageError;
 use crate::web::{NegotiatedContentType, Output};
 
+/// The number of seconds after which clients are asked to retry requests that
+/// failed because the service is overloaded.
+const RETRY_AFTER: u64 = 1;
+
 /// All possible unsuccessful outcomes of an API request.
 ///
 /// Allows to handle application errors in the unified manner:
@@ -22,8 +26,10 @@ pub enum ApiError {
     NotFound(String),                   // ==> HTTP 404 Not Found
     NotAcceptable(&'static str),        // ==> HTTP 406 Not Acceptable
     Conflict(String),                   // ==> HTTP 409 Conflict
+    PayloadTooLarge(String),            // ==> HTTP 413 Payload Too Large
     UnsupportedMediaType(&'static str), // ==> HTTP 415 Unsupported Media Type
     InternalError(String),              // ==> HTTP 500 Internal Server Error
+    ServiceUnavailable(String),         // ==> HTTP 503 Service Unavailable
 }
 
 impl ApiError {
@@ -34,9 +40,11 @@ impl ApiError {
             ApiError::Forbidden(msg) => msg,
             ApiError::NotAcceptable(msg) => msg,
             ApiError::Conflict(msg) => msg,
+            ApiError::PayloadTooLarge(msg) => msg,
             ApiError::NotFound(msg) => msg,
             ApiError::InternalError(msg) => msg,
             ApiError::UnsupportedMediaType(msg) => msg,
+            ApiError::ServiceUnavailable(msg) => msg,
         }
     }
 
@@ -47,9 +55,11 @@ impl ApiError {
             ApiError::Forbidden(_) => http::Status::Forbidden,
             ApiError::NotAcceptable(_) => http::Status::NotAcceptable,
             ApiError::Conflict(_) => http::Status::Conflict,
+            ApiError::PayloadTooLarge(_) => http::Status::PayloadTooLarge,
             ApiError::NotFound(_) => http::Status::NotFound,
             ApiError::UnsupportedMediaType(_) => http::Status::UnsupportedMediaType,
             ApiError::InternalError(_) => http::Status::InternalServerError,
+            ApiError::ServiceUnavailable(_) => http::Status::ServiceUnavailable,
         }
     }
 }
@@ -59,6 +69,11 @@ impl From<StorageError> for ApiError {
         match value {
             StorageError::Duplicate { id: _ } => ApiError::Conflict(value.to_string()),
             StorageError::NotFound { id: _ } => ApiError::NotFound(value.to_string()),
+            StorageError::Unavailable(_) => {
+                // the details are only interesting to the operators
+                warn!("{}", value);
+                ApiError::ServiceUnavailable("Service is overloaded, try again later".to_string())
+            }
             _ => ApiError::InternalError(value.to_string()),
         }
     }
@@ -90,19 +105,23 @@ impl<'r, 'o: 'r> Responder<'r, 'o> for ApiError {
             let NegotiatedContentType(content_type) =
                 request.local_cache(|| /* default */ NegotiatedContentType(ContentType::Text));
 
-            if *content_type == ContentType::Text {
+            let retry_after = matches!(self, ApiError::ServiceUnavailable(_));
+            let mut response = if *content_type == ContentType::Text {
                 // if content negotiation has failed, return the error as plain text
                 Response::build_from(
                     response::content::RawText(self.reason().to_string()).respond_to(request)?,
                 )
-                .status(http_status)
-                .ok()
             } else {
                 // otherwise, return the error in the requested data format
                 Response::build_from(Output(self).respond_to(request)?)
-                    .status(http_status)
-                    .ok()
+            };
+
+            response.status(http_status);
+            if retry_after {
+                // let well-behaved clients back off instead of retrying immediately
+                response.raw_header("Retry-After", RETRY_AFTER.to_string());
             }
+            response.ok()
         }
     }
 }
@@ -0,0 +1,27 @@
+use rocket::State;
+
+use crate::errors::ApiError;
+use crate::storage::HealthCheck;
+
+/// Liveness probe. Only tells that the service is up and handles requests:
+/// restarting the service would not fix an outage of the database.
+#[get("/healthz")]
+pub fn get_liveness() -> &'static str {
+    "OK"
+}
+
+/// Readiness probe. Tells that the service can serve requests, i.e. that the
+/// database is reachable. The probe is cheap: it only runs a trivial query
+/// on a pooled connection (the pool is warmed up at startup).
+#[get("/readyz")]
+pub async fn get_readiness(health_check: &State<HealthCheck>) -> Result<&'static str, ApiError> {
+    match health_check.check().await {
+        Ok(()) => Ok("OK"),
+        Err(e) => {
+            warn!("Readiness check has failed: {}", e);
+            Err(ApiError::ServiceUnavailable(
+                "Database is unavailable".to_string(),
+            ))
+        }
+    }
+}
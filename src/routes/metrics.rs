@@ -0,0 +1,17 @@
+use rocket::http::ContentType;
+use rocket::State;
+
+use crate::errors::ApiError;
+use crate::web::Metrics;
+
+#[get("/metrics")]
+pub fn get_metrics(metrics: &State<Metrics>) -> Result<(ContentType, String), ApiError> {
+    // Prometheus text exposition format, version 0.0.4
+    let content_type =
+        ContentType::new("text", "plain").with_params([("version", "0.0.4"), ("charset", "utf-8")]);
+
+    match metrics.gather() {
+        Ok(text) => Ok((content_type, text)),
+        Err(e) => Err(ApiError::InternalError(e.to_string())),
+    }
+}
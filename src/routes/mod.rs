@@ -1,2 +1,4 @@
+pub mod health;
+pub mod metrics;
 pub mod snippets;
 pub mod syntaxes;
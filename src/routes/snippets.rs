@@ -2,19 +2,29 @@ use std::convert::TryFrom;
 
 use percent_encoding::{utf8_percent_encode, AsciiSet, CONTROLS};
 use rocket::http::uri::Origin;
-use rocket::http::{HeaderMap, RawStr};
+use rocket::http::{HeaderMap, RawStr, Status};
 use rocket::response::status::Created;
 use rocket::State;
-use serde::Deserialize;
+use serde::{Deserialize, Serialize};
 
 use crate::application::Config;
 use crate::errors::ApiError;
-use crate::storage::{Changeset, DateTime, Direction, ListSnippetsQuery, Snippet, Storage};
+use crate::storage::{
+    Changeset, Checkpoint, DateTime, Direction, ListSnippetsQuery, Marker, Page, Snippet,
+    SnippetChanges, SnippetStream, SnippetSummary, Storage, View,
+};
 use crate::web::{
-    BearerAuth, DoNotAcceptAny, Input, NegotiatedContentType, Output, PaginationLimit,
-    WithHttpHeaders,
+    BearerAuth, Conditional, Cursors, DoNotAcceptAny, Input, InputStream, NegotiatedContentType,
+    Output, OutputStream, PaginationLimit, Preconditions, Validators, WithHttpHeaders,
 };
 
+/// The number of snippets that are passed to the storage at once by the bulk
+/// import endpoint. Bounds the amount of memory required to process a request
+/// regardless of the number of snippets in it.
+const IMPORT_BATCH_SIZE: usize = 1000;
+/// The maximum length (in characters) of a full-text search query.
+const MAX_SEARCH_QUERY_LENGTH: usize = 256;
+
 async fn create_snippet_impl(
     storage: &dyn Storage,
     snippet: &Snippet,
@@ -102,25 +112,32 @@ pub struct NewSnippet {
     pub tags: Option<Vec<String>>,
 }
 
+/// Check the values of the snippet fields passed by the user.
+fn validate(config: &Config, content: Option<&str>, syntax: Option<&str>) -> Result<(), ApiError> {
+    if content.is_some_and(str::is_empty) {
+        return Err(ApiError::BadRequest(String::from(
+            "`content` - empty values not allowed.",
+        )));
+    }
+    if let Some(syntax) = syntax {
+        if let Some(allowed_syntaxes) = &config.syntaxes {
+            if !allowed_syntaxes.contains(syntax) {
+                return Err(ApiError::BadRequest(format!(
+                    "`syntax` - unallowed value {}.",
+                    syntax
+                )));
+            }
+        }
+    }
+
+    Ok(())
+}
+
 impl TryFrom<(&Config, NewSnippet)> for Snippet {
     type Error = ApiError;
 
     fn try_from((config, value): (&Config, NewSnippet)) -> Result<Self, Self::Error> {
-        if value.content.is_empty() {
-            return Err(ApiError::BadRequest(String::from(
-                "`content` - empty values not allowed.",
-            )));
-        }
-        if let Some(syntax) = &value.syntax {
-            if let Some(allowed_syntaxes) = &config.syntaxes {
-                if !allowed_syntaxes.contains(syntax) {
-                    return Err(ApiError::BadRequest(format!(
-                        "`syntax` - unallowed value {}.",
-                        syntax
-                    )));
-                }
-            }
-        }
+        validate(config, Some(&value.content), value.syntax.as_deref())?;
 
         Ok(Snippet::new(
             value.title,
@@ -144,32 +161,105 @@ pub async fn create_snippet(
     create_snippet_impl(storage.as_ref(), &snippet, origin.path().as_str()).await
 }
 
-fn split_marker(mut snippets: Vec<Snippet>, limit: usize) -> (Option<String>, Vec<Snippet>) {
-    if snippets.len() > limit {
-        snippets.truncate(limit);
-        (snippets.last().map(|m| m.id.to_owned()), snippets)
+/// Returns a cursor pointing at the snippet at the given index of the page,
+/// if there is one.
+fn cursor_at(cursors: &Cursors, page: &Page, index: usize, search: Option<&str>) -> Option<String> {
+    page.snippets
+        .get(index)
+        .zip(page.positions.get(index))
+        .map(|(snippet, position)| cursors.encode(position, &snippet.id, search))
+}
+
+fn split_marker(
+    cursors: &Cursors,
+    mut page: Page,
+    limit: usize,
+    search: Option<&str>,
+) -> (Option<String>, Page) {
+    if page.snippets.len() > limit {
+        page.truncate(limit);
+        (cursor_at(cursors, &page, limit - 1, search), page)
     } else {
-        (None, snippets)
+        (None, page)
+    }
+}
+
+/// A page of snippets serialized according to the requested view.
+#[derive(Serialize)]
+#[serde(untagged)]
+pub enum SnippetList {
+    Full(Vec<Snippet>),
+    Summary(Vec<SnippetSummary>),
+}
+
+impl SnippetList {
+    fn new(snippets: Vec<Snippet>, view: View) -> Self {
+        match view {
+            View::Full => SnippetList::Full(snippets),
+            View::Summary => {
+                SnippetList::Summary(snippets.into_iter().map(SnippetSummary).collect())
+            }
+        }
     }
 }
 
 #[allow(clippy::too_many_arguments)]
-#[get("/snippets?<title>&<syntax>&<tag>&<marker>&<limit>")]
+#[get("/snippets?<title>&<syntax>&<tag>&<q>&<marker>&<limit>&<view>&<count>")]
 pub async fn list_snippets<'h>(
     storage: &State<Box<dyn Storage>>,
+    cursors: &State<Cursors>,
     origin: &Origin<'_>,
     title: Option<String>,
     syntax: Option<String>,
     tag: Option<String>,
+    q: Option<String>,
     limit: Result<PaginationLimit, rocket::form::Errors<'_>>,
     marker: Option<String>,
-    _content_type: &NegotiatedContentType,
+    view: Option<&str>,
+    count: Option<&str>,
+    content_type: &NegotiatedContentType,
+    preconditions: Preconditions,
     _user: BearerAuth,
-) -> Result<WithHttpHeaders<'h, Output<Vec<Snippet>>>, ApiError> {
+) -> Result<WithHttpHeaders<'h, Conditional<Output<SnippetList>>>, ApiError> {
+    // the summary view omits the content, so that browsing the list does not
+    // require loading (and transferring) the whole history of every snippet
+    let view = match view {
+        None | Some("full") => View::Full,
+        Some("summary") => View::Summary,
+        Some(_) => {
+            return Err(ApiError::BadRequest(
+                "View must be one of: full, summary".to_string(),
+            ))
+        }
+    };
+    // counting the snippets is expensive, so the total is only returned on
+    // request, and it's an estimate
+    let with_count = match count {
+        None => false,
+        Some("estimated") => true,
+        Some(_) => {
+            return Err(ApiError::BadRequest(
+                "Count must be one of: estimated".to_string(),
+            ))
+        }
+    };
+    // a blank query would not match anything, so it's ignored instead
+    let search = q.filter(|q| !q.trim().is_empty());
+    if search
+        .as_ref()
+        .is_some_and(|q| q.chars().count() > MAX_SEARCH_QUERY_LENGTH)
+    {
+        return Err(ApiError::BadRequest(format!(
+            "Search query must be at most {} characters long",
+            MAX_SEARCH_QUERY_LENGTH
+        )));
+    }
     let mut criteria = ListSnippetsQuery {
         title,
         syntax,
         tags: tag.map(|v| vec![v]),
+        search,
+        view,
         ..Default::default()
     };
 
@@ -179,31 +269,58 @@ pub async fn list_snippets<'h>(
         .map_err(|e| ApiError::BadRequest(e.first().map(|e| e.to_string()).unwrap_or_default()))?
         .0;
     criteria.pagination.limit = limit + 1;
-    criteria.pagination.marker = marker;
+    // Markers are either cursors issued by previous requests, which carry the
+    // position of the marker snippet, or plain slugs, which are looked up by
+    // the storage.
+    let search = criteria.search.clone();
+    criteria.pagination.marker = marker.map(|marker| cursors.decode(&marker, search.as_deref()));
 
-    let snippets = storage.list(criteria.clone()).await?;
+    let page = storage.list(criteria.clone()).await?;
     let mut prev_needed = false;
-    let (next_marker, snippets) = split_marker(snippets, limit);
-    let prev_marker = if criteria.pagination.marker.is_some() && !snippets.is_empty() {
+    let (next_marker, page) = split_marker(cursors, page, limit, search.as_deref());
+
+    // The first page that has no next page contains all matching snippets.
+    // Otherwise, the count is estimated by the storage
+    let total_count = match (with_count, &criteria.pagination.marker, &next_marker) {
+        (false, _, _) => None,
+        (true, None, None) => Some(page.snippets.len() as u64),
+        (true, _, _) => Some(storage.estimate_count(&criteria).await?),
+    };
+
+    let prev_marker = if criteria.pagination.marker.is_some() && !page.snippets.is_empty() {
         // In order to generate Link entry for previous page we have no choice
         // but to issue the query one more time into opposite direction.
         criteria.pagination.direction = Direction::Asc;
-        criteria.pagination.marker = Some(snippets[0].id.to_owned());
-        let prev_snippets = storage.list(criteria).await?;
-        prev_needed = !prev_snippets.is_empty();
+        criteria.pagination.marker = Some(Marker::Position(page.positions[0]));
+        let prev_page = storage.list(criteria).await?;
+        prev_needed = !prev_page.snippets.is_empty();
 
-        prev_snippets.get(limit).map(|m| m.id.to_owned())
+        cursor_at(cursors, &prev_page, limit, search.as_deref())
     } else {
         None
     };
 
-    let mut headers_map = HeaderMap::new();
-    headers_map.add_raw(
-        "Link",
-        create_link_header(origin, next_marker, prev_marker, prev_needed),
+    let link = create_link_header(origin, next_marker, prev_marker, prev_needed);
+    let total_count = total_count.map(|count| count.to_string());
+    let validators = Validators::for_snippets(
+        &page.snippets,
+        &[
+            &content_type.0.to_string(),
+            &link,
+            view.as_str(),
+            total_count.as_deref().unwrap_or_default(),
+        ],
     );
+    let mut headers_map = HeaderMap::new();
+    headers_map.add_raw("Link", link);
+    if let Some(total_count) = total_count {
+        headers_map.add_raw("X-Total-Count", total_count);
+    }
 
-    Ok(WithHttpHeaders(headers_map, Some(Output(snippets))))
+    Ok(WithHttpHeaders(
+        headers_map,
+        Some(preconditions.respond(validators, Output(SnippetList::new(page.snippets, view)))),
+    ))
 }
 
 #[derive(Deserialize)]
@@ -261,33 +378,303 @@ pub async fn import_snippet(
     create_snippet_impl(storage.as_ref(), &snippet, base_path.as_str()).await
 }
 
+/// The outcome of importing a single snippet via the bulk import endpoint.
+#[derive(Serialize)]
+pub struct ImportResult {
+    /// Snippet identifier. None if the snippet could not be parsed.
+    pub id: Option<String>,
+    /// HTTP status code that the single snippet import endpoint would have
+    /// responded with.
+    pub status: u16,
+    /// Reason why the snippet could not be imported.
+    #[serde(skip_serializing_if = "Option::is_none")]
+    pub message: Option<String>,
+}
+
+impl ImportResult {
+    fn created(id: String) -> Self {
+        ImportResult {
+            id: Some(id),
+            status: Status::Created.code,
+            message: None,
+        }
+    }
+
+    fn failed(id: Option<String>, error: ApiError) -> Self {
+        ImportResult {
+            id,
+            status: error.status().code,
+            message: Some(error.reason().to_string()),
+        }
+    }
+}
+
+/// Import snippets in bulk. The snippets are imported in batches, each of
+/// which is committed on its own, so if the request body can't be read to the
+/// end (e.g. because it exceeds the size limit), the snippets that have been
+/// processed by then are still reported, with the status of the error.
+#[post("/snippets/import/bulk", data = "<body>")]
+pub async fn import_snippets(
+    config: &State<Config>,
+    storage: &State<Box<dyn Storage>>,
+    body: Result<InputStream<'_>, ApiError>,
+    user: BearerAuth,
+    _content_type: &NegotiatedContentType,
+) -> Result<(Status, Output<Vec<ImportResult>>), ApiError> {
+    if !user.0.can_import_snippets() {
+        return Err(ApiError::Forbidden(
+            "User is not allowed to import snippets".to_string(),
+        ));
+    }
+
+    let mut body = body?;
+    let mut results = Vec::new();
+    loop {
+        let items = match body.next_batch::<ImportSnippet>(IMPORT_BATCH_SIZE).await {
+            Ok(items) if items.is_empty() => break,
+            Ok(items) => items,
+            Err(e) if results.is_empty() => return Err(e),
+            // the previous batches have been committed, so the client is
+            // told which snippets have made it, and can resume from there
+            Err(e) => {
+                warn!("Bulk import has been interrupted: {}", e.reason());
+                return Ok((e.status(), Output(results)));
+            }
+        };
+
+        // validate the snippets first. The ones that are not valid are
+        // reported right away and are not passed to the storage
+        let mut batch_results = Vec::with_capacity(items.len());
+        let mut snippets = Vec::with_capacity(items.len());
+        for item in items {
+            let id = item.as_ref().ok().and_then(|item| item.id.clone());
+            match item.and_then(|item| Snippet::try_from((config.inner(), item))) {
+                Ok(snippet) => {
+                    batch_results.push(None);
+                    snippets.push(snippet);
+                }
+                Err(e) => batch_results.push(Some(ImportResult::failed(id, e))),
+            }
+        }
+
+        let mut outcomes = snippets.iter().zip(storage.import(&snippets).await?);
+        for result in batch_results {
+            results.push(match result {
+                Some(result) => result,
+                None => match outcomes.next() {
+                    Some((snippet, Ok(()))) => ImportResult::created(snippet.id.to_owned()),
+                    Some((snippet, Err(e))) => {
+                        ImportResult::failed(Some(snippet.id.to_owned()), ApiError::from(e))
+                    }
+                    None => {
+                        return Err(ApiError::InternalError(
+                            "Storage has not reported the outcome of import".to_string(),
+                        ))
+                    }
+                },
+            });
+        }
+    }
+
+    Ok((Status::Ok, Output(results)))
+}
+
+/// Streams all snippets from older to newer ones as newline-delimited JSON,
+/// which can be fed to the bulk import endpoint as is. An interrupted export
+/// is resumed by passing the `created_at` and the `id` of the last received
+/// snippet as `after_created_at` and `after_id` respectively.
+#[get("/snippets/export?<after_created_at>&<after_id>")]
+pub async fn export_snippets(
+    storage: &State<Box<dyn Storage>>,
+    after_created_at: Option<&str>,
+    after_id: Option<String>,
+    user: BearerAuth,
+) -> Result<OutputStream<SnippetStream>, ApiError> {
+    if !user.0.can_export_snippets() {
+        return Err(ApiError::Forbidden(
+            "User is not allowed to export snippets".to_string(),
+        ));
+    }
+
+    let after = match (after_created_at, after_id) {
+        (Some(created_at), Some(id)) => Some(Checkpoint {
+            created_at: chrono::DateTime::parse_from_rfc3339(created_at)
+                .map_err(|e| ApiError::BadRequest(format!("Invalid `after_created_at`: {}", e)))?
+                .with_timezone(&chrono::Utc),
+            id,
+        }),
+        (None, None) => None,
+        _ => {
+            return Err(ApiError::BadRequest(
+                "`after_created_at` and `after_id` must be passed together".to_string(),
+            ))
+        }
+    };
+
+    Ok(OutputStream(storage.export(after).await?))
+}
+
 #[get("/snippets/<id>", format = "text/plain", rank = 1)]
 pub async fn get_raw_snippet(
     storage: &State<Box<dyn Storage>>,
     id: String,
+    preconditions: Preconditions,
     _user: BearerAuth,
     // W/o this, a request specifying any media type (i.e. */*), would be matched by this route,
     // which is not what we want. We can't add the desired format to the route below, because it's
     // supposed to perform content negotiation and return an ApiError when a user requests an
     // unsupported format.
     _not_any: DoNotAcceptAny,
-) -> Result<String, ApiError> {
-    Ok(storage
-        .get(&id)
-        .await?
+) -> Result<Conditional<String>, ApiError> {
+    // only the latest changeset is needed, so the rest of them are not loaded.
+    // Its content is loaded in full: it's stored as a single value, which
+    // PostgreSQL reads in full anyway. Only compressing and sending the body
+    // is done in chunks
+    let mut snippet = storage.get_latest(&id).await?;
+    let content = snippet
         .changesets
-        .into_iter()
-        .next_back()
-        .map(|c| c.content)
-        .unwrap_or_default())
+        .last_mut()
+        .map(|c| std::mem::take(&mut c.content))
+        .unwrap_or_default();
+    let validators = Validators::for_snippets(std::slice::from_ref(&snippet), &["text/plain"]);
+
+    // the body is compressed (if requested) by the web::Compression fairing
+    Ok(preconditions.respond(validators, content))
 }
 
 #[get("/snippets/<id>", rank = 2)]
 pub async fn get_snippet(
     storage: &State<Box<dyn Storage>>,
     id: String,
-    _content_type: &NegotiatedContentType,
+    content_type: &NegotiatedContentType,
+    preconditions: Preconditions,
     _user: BearerAuth,
+) -> Result<Conditional<Output<Snippet>>, ApiError> {
+    let snippet = storage.get(&id).await?;
+    let validators = Validators::for_snippets(
+        std::slice::from_ref(&snippet),
+        &[&content_type.0.to_string()],
+    );
+
+    Ok(preconditions.respond(validators, Output(snippet)))
+}
+
+/// Changes to a snippet. The fields that are omitted are left intact. The
+/// title and the syntax are unset by passing null.
+#[derive(Deserialize)]
+#[serde(deny_unknown_fields)]
+pub struct SnippetPatch {
+    /// New snippet title.
+    #[serde(default, deserialize_with = "present")]
+    pub title: Option<Option<String>>,
+    /// New snippet syntax.
+    #[serde(default, deserialize_with = "present")]
+    pub syntax: Option<Option<String>>,
+    /// New snippet content. Can't be empty. Added as a new version, unless
+    /// it's the same as the current content.
+    pub content: Option<String>,
+    /// New list of tags attached to the snippet.
+    pub tags: Option<Vec<String>>,
+}
+
+/// Deserializes a field that is present in the input as Some, even if its
+/// value is null, so that it can be told apart from a missing one.
+fn present<'de, T, D>(deserializer: D) -> Result<Option<T>, D::Error>
+where
+    T: Deserialize<'de>,
+    D: serde::Deserializer<'de>,
+{
+    T::deserialize(deserializer).map(Some)
+}
+
+impl From<SnippetPatch> for SnippetChanges {
+    fn from(value: SnippetPatch) -> Self {
+        SnippetChanges {
+            title: value.title,
+            syntax: value.syntax,
+            content: value.content,
+            tags: value.tags,
+        }
+    }
+}
+
+impl From<NewSnippet> for SnippetChanges {
+    /// A full replacement of the snippet: the omitted fields are unset.
+    fn from(value: NewSnippet) -> Self {
+        SnippetChanges {
+            title: Some(value.title),
+            syntax: Some(value.syntax),
+            content: Some(value.content),
+            tags: Some(value.tags.unwrap_or_default()),
+        }
+    }
+}
+
+async fn update_snippet_impl(
+    config: &Config,
+    storage: &dyn Storage,
+    id: &str,
+    user: BearerAuth,
+    changes: SnippetChanges,
+) -> Result<Output<Snippet>, ApiError> {
+    if !user.0.can_update_snippets() {
+        return Err(ApiError::Forbidden(
+            "User is not allowed to update snippets".to_string(),
+        ));
+    }
+    validate(
+        config,
+        changes.content.as_deref(),
+        changes.syntax.as_ref().and_then(Option::as_deref),
+    )?;
+
+    // The changes are applied by the storage to the latest state of the
+    // snippet rather than to a (possibly cached) copy of it, so concurrent
+    // updates of different fields don't overwrite each other
+    Ok(Output(storage.update(id, &changes).await?))
+}
+
+#[put("/snippets/<id>", data = "<body>")]
+pub async fn replace_snippet(
+    config: &State<Config>,
+    storage: &State<Box<dyn Storage>>,
+    id: String,
+    body: Result<Input<NewSnippet>, ApiError>,
+    user: BearerAuth,
+    _content_type: &NegotiatedContentType,
 ) -> Result<Output<Snippet>, ApiError> {
-    Ok(Output(storage.get(&id).await?))
+    let changes = SnippetChanges::from(body?.0);
+    update_snippet_impl(config.inner(), storage.as_ref(), &id, user, changes).await
+}
+
+#[patch("/snippets/<id>", data = "<body>")]
+pub async fn update_snippet(
+    config: &State<Config>,
+    storage: &State<Box<dyn Storage>>,
+    id: String,
+    body: Result<Input<SnippetPatch>, ApiError>,
+    user: BearerAuth,
+    _content_type: &NegotiatedContentType,
+) -> Result<Output<Snippet>, ApiError> {
+    let changes = SnippetChanges::from(body?.0);
+    update_snippet_impl(config.inner(), storage.as_ref(), &id, user, changes).await
+}
+
+#[get("/snippets/<id>/versions/<version>")]
+pub async fn get_snippet_version(
+    storage: &State<Box<dyn Storage>>,
+    id: String,
+    version: usize,
+    content_type: &NegotiatedContentType,
+    preconditions: Preconditions,
+    _user: BearerAuth,
+) -> Result<Conditional<Output<Snippet>>, ApiError> {
+    // the snippet is serialized with the content of the requested version
+    let snippet = storage.get_version(&id, version).await?;
+    let validators = Validators::for_snippets(
+        std::slice::from_ref(&snippet),
+        &[&content_type.0.to_string()],
+    );
+
+    Ok(preconditions.respond(validators, Output(snippet)))
 }
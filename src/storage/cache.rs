@@ -0,0 +1,763 @@
+use std::error;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::{Arc, Mutex, PoisonError};
+use std::time::Duration;
+
+use moka::future::Cache;
+use moka::notification::RemovalCause;
+
+use super::{
+    errors::StorageError, Checkpoint, Direction, ListSnippetsQuery, Page, Snippet, SnippetChanges,
+    SnippetStream, Storage, View,
+};
+
+// A rough estimate of the memory taken by a cached snippet on top of the
+// lengths of its strings (struct fields, allocation headers, cache metadata).
+const ENTRY_OVERHEAD: usize = 256;
+
+/// Counters of cache hits, misses, and evictions.
+///
+/// The counters are shared between all clones of the instance, so a clone can
+/// be handed out to the code that needs to report them (e.g. a fairing).
+#[derive(Clone, Debug, Default)]
+pub struct CacheStats {
+    hits: Arc<AtomicU64>,
+    misses: Arc<AtomicU64>,
+    evictions: Arc<AtomicU64>,
+}
+
+impl CacheStats {
+    /// The number of lookups that were served from the cache.
+    pub fn hits(&self) -> u64 {
+        self.hits.load(Ordering::Relaxed)
+    }
+
+    /// The number of lookups that had to go to the underlying storage.
+    pub fn misses(&self) -> u64 {
+        self.misses.load(Ordering::Relaxed)
+    }
+
+    /// The number of entries removed because the cache was full or their TTL
+    /// has expired. Explicit invalidations are not counted.
+    pub fn evictions(&self) -> u64 {
+        self.evictions.load(Ordering::Relaxed)
+    }
+}
+
+/// A Storage decorator that keeps recently read snippets in memory.
+///
+/// The cache is bounded by the total (estimated) size of the cached snippets
+/// in bytes and uses the TinyLFU admission policy with LRU eviction. Entries
+/// expire after the configured TTL, which also bounds the staleness of an entry
+/// if a concurrent `get` caches a snippet that is being updated or deleted.
+pub struct CachedStorage<S> {
+    inner: S,
+    cache: Cache<String, Arc<Snippet>>,
+    stats: CacheStats,
+}
+
+impl<S: Storage> CachedStorage<S> {
+    /// Wrap the given storage into a cache of up to `max_size` bytes, whose
+    /// entries expire after `ttl`.
+    pub fn new(inner: S, max_size: u64, ttl: Duration) -> Self {
+        let stats = CacheStats::default();
+        let evictions = stats.evictions.clone();
+
+        let cache = Cache::builder()
+            .max_capacity(max_size)
+            .weigher(|_id: &String, snippet: &Arc<Snippet>| {
+                u32::try_from(estimate_size(snippet)).unwrap_or(u32::MAX)
+            })
+            .time_to_live(ttl)
+            .eviction_listener(move |_id, _snippet, cause| {
+                if matches!(cause, RemovalCause::Size | RemovalCause::Expired) {
+                    evictions.fetch_add(1, Ordering::Relaxed);
+                }
+            })
+            .build();
+
+        Self {
+            inner,
+            cache,
+            stats,
+        }
+    }
+
+    /// Returns a handle to the cache counters.
+    pub fn stats(&self) -> CacheStats {
+        self.stats.clone()
+    }
+}
+
+/// Returns the approximate number of bytes taken by the snippet in memory.
+fn estimate_size(snippet: &Snippet) -> usize {
+    ENTRY_OVERHEAD
+        + snippet.id.len()
+        + snippet.title.as_ref().map_or(0, String::len)
+        + snippet.syntax.as_ref().map_or(0, String::len)
+        + snippet
+            .changesets
+            .iter()
+            .map(|changeset| std::mem::size_of_val(changeset) + changeset.content.len())
+            .sum::<usize>()
+        + snippet
+            .tags
+            .iter()
+            .map(|tag| std::mem::size_of_val(tag) + tag.len())
+            .sum::<usize>()
+}
+
+#[rocket::async_trait]
+impl<S: Storage> Storage for CachedStorage<S> {
+    async fn create(&self, snippet: &Snippet) -> Result<Snippet, StorageError> {
+        self.inner.create(snippet).await
+    }
+
+    async fn import(
+        &self,
+        snippets: &[Snippet],
+    ) -> Result<Vec<Result<(), StorageError>>, StorageError> {
+        self.inner.import(snippets).await
+    }
+
+    async fn list(&self, criteria: ListSnippetsQuery) -> Result<Page, StorageError> {
+        self.inner.list(criteria).await
+    }
+
+    async fn estimate_count(&self, criteria: &ListSnippetsQuery) -> Result<u64, StorageError> {
+        self.inner.estimate_count(criteria).await
+    }
+
+    async fn export(&self, after: Option<Checkpoint>) -> Result<SnippetStream, StorageError> {
+        // exports would only evict the snippets that are actually popular
+        self.inner.export(after).await
+    }
+
+    async fn get(&self, id: &str) -> Result<Snippet, StorageError> {
+        if let Some(snippet) = self.cache.get(id).await {
+            self.stats.hits.fetch_add(1, Ordering::Relaxed);
+            return Ok(Snippet::clone(&snippet));
+        }
+
+        self.stats.misses.fetch_add(1, Ordering::Relaxed);
+        let snippet = self.inner.get(id).await?;
+        self.cache
+            .insert(id.to_owned(), Arc::new(snippet.clone()))
+            .await;
+
+        Ok(snippet)
+    }
+
+    async fn get_latest(&self, id: &str) -> Result<Snippet, StorageError> {
+        // a cached snippet has all changesets, but a miss does not populate
+        // the cache, as only a part of the snippet is loaded
+        if let Some(snippet) = self.cache.get(id).await {
+            self.stats.hits.fetch_add(1, Ordering::Relaxed);
+            return Ok(Snippet {
+                changesets: snippet.changesets.last().cloned().into_iter().collect(),
+                tags: Vec::new(),
+                ..Snippet::clone(&snippet)
+            });
+        }
+
+        self.stats.misses.fetch_add(1, Ordering::Relaxed);
+        self.inner.get_latest(id).await
+    }
+
+    async fn get_version(&self, id: &str, version: usize) -> Result<Snippet, StorageError> {
+        // the changesets are never modified, so any cached copy of the
+        // snippet has the right content, but the misses are handled as in
+        // get_latest
+        if let Some(snippet) = self.cache.get(id).await {
+            self.stats.hits.fetch_add(1, Ordering::Relaxed);
+            let changesets = snippet
+                .changesets
+                .iter()
+                .filter(|c| c.version == version)
+                .cloned()
+                .collect::<Vec<_>>();
+            if changesets.is_empty() {
+                return Err(StorageError::NotFound { id: id.to_owned() });
+            }
+
+            return Ok(Snippet {
+                changesets,
+                tags: Vec::new(),
+                ..Snippet::clone(&snippet)
+            });
+        }
+
+        self.stats.misses.fetch_add(1, Ordering::Relaxed);
+        self.inner.get_version(id, version).await
+    }
+
+    async fn update(&self, id: &str, changes: &SnippetChanges) -> Result<Snippet, StorageError> {
+        let result = self.inner.update(id, changes).await;
+        self.cache.invalidate(id).await;
+
+        result
+    }
+
+    async fn delete(&self, id: &str) -> Result<(), StorageError> {
+        let result = self.inner.delete(id).await;
+        self.cache.invalidate(id).await;
+
+        result
+    }
+}
+
+/// The criteria of a first page of snippets, normalized so that equivalent
+/// queries share a cache entry. `generation` is the number of writes that
+/// had completed before the page was fetched (see CachedPages).
+#[derive(Clone, Debug, Hash, PartialEq, Eq)]
+struct PageKey {
+    generation: u64,
+    title: Option<String>,
+    syntax: Option<String>,
+    tags: Option<Vec<String>>,
+    direction: Direction,
+    limit: usize,
+    view: View,
+}
+
+impl PageKey {
+    /// Returns the key of the page that satisfies the given criteria, or
+    /// None if the page is not cached. Only the first pages are cached, and
+    /// not the results of full-text search, which are rarely repeated.
+    fn new(generation: u64, criteria: &ListSnippetsQuery) -> Option<Self> {
+        if criteria.pagination.marker.is_some() || criteria.search.is_some() {
+            return None;
+        }
+
+        // a snippet matches if it has any of the tags, so their order does
+        // not matter
+        let tags = criteria.tags.clone().map(|mut tags| {
+            tags.sort_unstable();
+            tags.dedup();
+            tags
+        });
+
+        Some(Self {
+            generation,
+            title: criteria.title.clone(),
+            syntax: criteria.syntax.clone(),
+            tags,
+            direction: criteria.pagination.direction.clone(),
+            limit: criteria.pagination.limit,
+            view: criteria.view,
+        })
+    }
+}
+
+/// The error of a fetch shared by concurrent lookups of the same page. moka
+/// hands the error out to all of them, so it must be Sync, which
+/// StorageError is not.
+struct SharedError(Mutex<StorageError>);
+
+impl SharedError {
+    /// Returns the error to one of the lookups. Whoever comes last gets the
+    /// original error, the others get a copy of it.
+    fn into_error(shared: Arc<SharedError>) -> StorageError {
+        let shared = match Arc::try_unwrap(shared) {
+            Ok(SharedError(error)) => {
+                return error.into_inner().unwrap_or_else(PoisonError::into_inner)
+            }
+            Err(shared) => shared,
+        };
+
+        // the source of the error can't be cloned, so only its message is copied
+        fn message(e: &(dyn error::Error + Send)) -> Box<dyn error::Error + Send> {
+            Box::<dyn error::Error + Send + Sync>::from(e.to_string())
+        }
+        let error = shared.0.lock().unwrap_or_else(PoisonError::into_inner);
+        match &*error {
+            StorageError::Duplicate { id } => StorageError::Duplicate { id: id.clone() },
+            StorageError::NotFound { id } => StorageError::NotFound { id: id.clone() },
+            StorageError::Unavailable(e) => StorageError::Unavailable(message(e.as_ref())),
+            StorageError::InternalError(e) => StorageError::InternalError(message(e.as_ref())),
+        }
+    }
+}
+
+/// A Storage decorator that keeps the first pages of recent snippets in
+/// memory, so that the popular pages (the default one, and the ones of
+/// common filters) are not fetched from the database on every request.
+///
+/// Concurrent lookups of a page that is not cached wait for a single fetch.
+/// Writes (made through this instance) make all cached pages stale, but
+/// the writes made by other instances only show up once the pages expire,
+/// so the TTL is meant to be short. The cache is bounded by the total
+/// (estimated) size of the cached pages in bytes.
+pub struct CachedPages<S> {
+    inner: S,
+    cache: Cache<PageKey, Arc<Page>>,
+    /// The number of completed writes. It's a part of the cache keys, so
+    /// that a page fetched concurrently with a write is never served after
+    /// the write has completed.
+    generation: AtomicU64,
+    stats: CacheStats,
+}
+
+impl<S: Storage> CachedPages<S> {
+    /// Wrap the given storage into a cache of up to `max_size` bytes, whose
+    /// entries expire after `ttl`.
+    pub fn new(inner: S, max_size: u64, ttl: Duration) -> Self {
+        let stats = CacheStats::default();
+        let evictions = stats.evictions.clone();
+
+        let cache = Cache::builder()
+            .max_capacity(max_size)
+            .weigher(|_key: &PageKey, page: &Arc<Page>| {
+                let size = page.snippets.iter().map(estimate_size).sum::<usize>()
+                    + std::mem::size_of_val(page.positions.as_slice());
+                u32::try_from(size).unwrap_or(u32::MAX)
+            })
+            .time_to_live(ttl)
+            .eviction_listener(move |_key, _page, cause| {
+                if matches!(cause, RemovalCause::Size | RemovalCause::Expired) {
+                    evictions.fetch_add(1, Ordering::Relaxed);
+                }
+            })
+            .build();
+
+        Self {
+            inner,
+            cache,
+            generation: AtomicU64::new(0),
+            stats,
+        }
+    }
+
+    /// Returns a handle to the cache counters.
+    pub fn stats(&self) -> CacheStats {
+        self.stats.clone()
+    }
+
+    /// Makes the cached pages stale. Called once a write has completed,
+    /// even if it has failed, as it might have been committed anyway.
+    fn written(&self) {
+        self.generation.fetch_add(1, Ordering::SeqCst);
+        // the pages of the previous generations would only take up space
+        // until they expire
+        self.cache.invalidate_all();
+    }
+}
+
+#[rocket::async_trait]
+impl<S: Storage> Storage for CachedPages<S> {
+    async fn create(&self, snippet: &Snippet) -> Result<Snippet, StorageError> {
+        let result = self.inner.create(snippet).await;
+        self.written();
+
+        result
+    }
+
+    async fn import(
+        &self,
+        snippets: &[Snippet],
+    ) -> Result<Vec<Result<(), StorageError>>, StorageError> {
+        let result = self.inner.import(snippets).await;
+        self.written();
+
+        result
+    }
+
+    async fn list(&self, criteria: ListSnippetsQuery) -> Result<Page, StorageError> {
+        let key = match PageKey::new(self.generation.load(Ordering::SeqCst), &criteria) {
+            Some(key) => key,
+            None => return self.inner.list(criteria).await,
+        };
+
+        let entry = self
+            .cache
+            .entry(key)
+            .or_try_insert_with(async {
+                self.inner
+                    .list(criteria)
+                    .await
+                    .map(Arc::new)
+                    .map_err(|e| SharedError(Mutex::new(e)))
+            })
+            .await
+            .map_err(SharedError::into_error)?;
+        // the lookups that have waited for a concurrent fetch are hits, as
+        // they have not fetched the page themselves
+        if entry.is_fresh() {
+            self.stats.misses.fetch_add(1, Ordering::Relaxed);
+        } else {
+            self.stats.hits.fetch_add(1, Ordering::Relaxed);
+        }
+
+        Ok(Page::clone(entry.value()))
+    }
+
+    async fn estimate_count(&self, criteria: &ListSnippetsQuery) -> Result<u64, StorageError> {
+        self.inner.estimate_count(criteria).await
+    }
+
+    async fn export(&self, after: Option<Checkpoint>) -> Result<SnippetStream, StorageError> {
+        self.inner.export(after).await
+    }
+
+    async fn get(&self, id: &str) -> Result<Snippet, StorageError> {
+        self.inner.get(id).await
+    }
+
+    async fn get_latest(&self, id: &str) -> Result<Snippet, StorageError> {
+        self.inner.get_latest(id).await
+    }
+
+    async fn get_version(&self, id: &str, version: usize) -> Result<Snippet, StorageError> {
+        self.inner.get_version(id, version).await
+    }
+
+    async fn update(&self, id: &str, changes: &SnippetChanges) -> Result<Snippet, StorageError> {
+        // pages have the contents and the tags of the snippets, too
+        let result = self.inner.update(id, changes).await;
+        self.written();
+
+        result
+    }
+
+    async fn delete(&self, id: &str) -> Result<(), StorageError> {
+        let result = self.inner.delete(id).await;
+        self.written();
+
+        result
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use std::collections::HashMap;
+    use std::sync::Mutex;
+
+    use super::super::{Changeset, Marker, Pagination, Position};
+    use super::*;
+
+    /// A Storage implementation that keeps snippets in a hash map and counts
+    /// the number of calls to `get` and `list`.
+    #[derive(Default)]
+    struct FakeStorage {
+        snippets: Mutex<HashMap<String, Snippet>>,
+        gets: AtomicU64,
+        lists: AtomicU64,
+    }
+
+    #[rocket::async_trait]
+    impl Storage for Arc<FakeStorage> {
+        async fn create(&self, snippet: &Snippet) -> Result<Snippet, StorageError> {
+            let mut snippets = self.snippets.lock().unwrap();
+            snippets.insert(snippet.id.clone(), snippet.clone());
+
+            Ok(snippet.clone())
+        }
+
+        async fn import(
+            &self,
+            snippets: &[Snippet],
+        ) -> Result<Vec<Result<(), StorageError>>, StorageError> {
+            let mut results = Vec::new();
+            for snippet in snippets {
+                results.push(self.create(snippet).await.map(|_| ()));
+            }
+
+            Ok(results)
+        }
+
+        async fn list(&self, _criteria: ListSnippetsQuery) -> Result<Page, StorageError> {
+            self.lists.fetch_add(1, Ordering::Relaxed);
+            // let concurrent calls overlap, as they would with a database
+            rocket::tokio::task::yield_now().await;
+
+            let snippets: Vec<Snippet> = self.snippets.lock().unwrap().values().cloned().collect();
+            let positions = snippets
+                .iter()
+                .enumerate()
+                .map(|(i, snippet)| Position {
+                    created_at: snippet.created_at.unwrap_or_default(),
+                    internal_id: i as i32,
+                    rank: None,
+                })
+                .collect();
+
+            Ok(Page {
+                snippets,
+                positions,
+            })
+        }
+
+        async fn get(&self, id: &str) -> Result<Snippet, StorageError> {
+            self.gets.fetch_add(1, Ordering::Relaxed);
+            self.snippets
+                .lock()
+                .unwrap()
+                .get(id)
+                .cloned()
+                .ok_or_else(|| StorageError::NotFound { id: id.to_owned() })
+        }
+
+        async fn update(
+            &self,
+            id: &str,
+            changes: &SnippetChanges,
+        ) -> Result<Snippet, StorageError> {
+            let mut snippets = self.snippets.lock().unwrap();
+            let snippet = snippets
+                .get_mut(id)
+                .ok_or_else(|| StorageError::NotFound { id: id.to_owned() })?;
+            if let Some(title) = &changes.title {
+                snippet.title = title.clone();
+            }
+            if let Some(syntax) = &changes.syntax {
+                snippet.syntax = syntax.clone();
+            }
+            if let Some(content) = &changes.content {
+                let version = snippet.changesets.len();
+                snippet
+                    .changesets
+                    .push(Changeset::new(version, content.clone()));
+            }
+            if let Some(tags) = &changes.tags {
+                snippet.tags = tags.clone();
+            }
+
+            Ok(snippet.clone())
+        }
+
+        async fn delete(&self, id: &str) -> Result<(), StorageError> {
+            match self.snippets.lock().unwrap().remove(id) {
+                Some(_) => Ok(()),
+                None => Err(StorageError::NotFound { id: id.to_owned() }),
+            }
+        }
+    }
+
+    fn snippet(content: &str) -> Snippet {
+        Snippet::new(
+            Some("Hello".to_string()),
+            Some("python".to_string()),
+            vec![Changeset::new(0, content.to_string())],
+            vec!["spam".to_string()],
+        )
+    }
+
+    #[tokio::test]
+    async fn read_through() {
+        let inner = Arc::new(FakeStorage::default());
+        let storage = CachedStorage::new(inner.clone(), 1 << 20, Duration::from_secs(60));
+        let reference = storage.create(&snippet("print(42)")).await.unwrap();
+
+        assert_eq!(storage.get(&reference.id).await.unwrap(), reference);
+        assert_eq!(storage.get(&reference.id).await.unwrap(), reference);
+        assert_eq!(inner.gets.load(Ordering::Relaxed), 1);
+
+        // errors are not cached
+        assert!(storage.get("eggs").await.is_err());
+        assert!(storage.get("eggs").await.is_err());
+        assert_eq!(inner.gets.load(Ordering::Relaxed), 3);
+
+        let stats = storage.stats();
+        assert_eq!((stats.hits(), stats.misses()), (1, 3));
+    }
+
+    #[tokio::test]
+    async fn invalidation() {
+        let inner = Arc::new(FakeStorage::default());
+        let storage = CachedStorage::new(inner.clone(), 1 << 20, Duration::from_secs(60));
+        let reference = storage.create(&snippet("print(42)")).await.unwrap();
+        storage.get(&reference.id).await.unwrap();
+
+        let changes = SnippetChanges {
+            content: Some("print(43)".to_string()),
+            ..Default::default()
+        };
+        let updated = storage.update(&reference.id, &changes).await.unwrap();
+        assert_eq!(
+            updated.changesets[1],
+            Changeset::new(1, "print(43)".to_string())
+        );
+        assert_eq!(storage.get(&reference.id).await.unwrap(), updated);
+
+        storage.delete(&reference.id).await.unwrap();
+        assert!(matches!(
+            storage.get(&reference.id).await,
+            Err(StorageError::NotFound { .. })
+        ));
+        assert_eq!(inner.gets.load(Ordering::Relaxed), 3);
+    }
+
+    #[tokio::test]
+    async fn get_latest() {
+        let inner = Arc::new(FakeStorage::default());
+        let storage = CachedStorage::new(inner.clone(), 1 << 20, Duration::from_secs(60));
+        let mut reference = snippet("print(42)");
+        reference
+            .changesets
+            .push(Changeset::new(1, "print(43)".to_string()));
+        let reference = storage.create(&reference).await.unwrap();
+        let expected = Snippet {
+            changesets: vec![reference.changesets[1].clone()],
+            tags: vec![],
+            ..reference.clone()
+        };
+
+        // a miss does not populate the cache with a partially loaded snippet
+        assert_eq!(storage.get_latest(&reference.id).await.unwrap(), expected);
+        assert_eq!(storage.get(&reference.id).await.unwrap(), reference);
+        assert_eq!(inner.gets.load(Ordering::Relaxed), 2);
+
+        // but the cached snippets are used
+        assert_eq!(storage.get_latest(&reference.id).await.unwrap(), expected);
+        assert_eq!(inner.gets.load(Ordering::Relaxed), 2);
+    }
+
+    #[tokio::test]
+    async fn get_version() {
+        let inner = Arc::new(FakeStorage::default());
+        let storage = CachedStorage::new(inner.clone(), 1 << 20, Duration::from_secs(60));
+        let mut reference = snippet("print(42)");
+        reference
+            .changesets
+            .push(Changeset::new(1, "print(43)".to_string()));
+        let reference = storage.create(&reference).await.unwrap();
+        let expected = Snippet {
+            changesets: vec![reference.changesets[0].clone()],
+            tags: vec![],
+            ..reference.clone()
+        };
+
+        assert_eq!(
+            storage.get_version(&reference.id, 0).await.unwrap(),
+            expected
+        );
+        assert_eq!(storage.get(&reference.id).await.unwrap(), reference);
+        assert_eq!(inner.gets.load(Ordering::Relaxed), 2);
+
+        assert_eq!(
+            storage.get_version(&reference.id, 0).await.unwrap(),
+            expected
+        );
+        assert!(matches!(
+            storage.get_version(&reference.id, 2).await,
+            Err(StorageError::NotFound { .. })
+        ));
+        assert_eq!(inner.gets.load(Ordering::Relaxed), 2);
+    }
+
+    #[tokio::test]
+    async fn eviction() {
+        let inner = Arc::new(FakeStorage::default());
+        let reference = snippet(&"x".repeat(1024));
+        let max_size = estimate_size(&reference) as u64 * 4;
+        let storage = CachedStorage::new(inner.clone(), max_size, Duration::from_secs(60));
+
+        for _ in 0..32 {
+            let mut snippet = reference.clone();
+            snippet.id = Snippet::random_id(reference.id.len());
+            storage.create(&snippet).await.unwrap();
+            storage.get(&snippet.id).await.unwrap();
+        }
+        storage.cache.run_pending_tasks().await;
+
+        assert!(storage.cache.weighted_size() <= max_size);
+        assert!(storage.stats().evictions() > 0);
+    }
+
+    fn by_tags(tags: &[&str]) -> ListSnippetsQuery {
+        ListSnippetsQuery {
+            tags: Some(tags.iter().map(|tag| tag.to_string()).collect()),
+            ..Default::default()
+        }
+    }
+
+    #[tokio::test]
+    async fn first_pages() {
+        let inner = Arc::new(FakeStorage::default());
+        let storage = CachedPages::new(inner.clone(), 1 << 20, Duration::from_secs(60));
+        let reference = storage.create(&snippet("print(42)")).await.unwrap();
+
+        let page = storage.list(ListSnippetsQuery::default()).await.unwrap();
+        assert_eq!(page.snippets, vec![reference.clone()]);
+        assert_eq!(
+            storage.list(ListSnippetsQuery::default()).await.unwrap(),
+            page
+        );
+        assert_eq!(inner.lists.load(Ordering::Relaxed), 1);
+
+        // equivalent criteria share the page
+        storage.list(by_tags(&["spam", "eggs"])).await.unwrap();
+        storage
+            .list(by_tags(&["eggs", "spam", "eggs"]))
+            .await
+            .unwrap();
+        assert_eq!(inner.lists.load(Ordering::Relaxed), 2);
+
+        // the next pages and search results are not cached
+        let next = ListSnippetsQuery {
+            pagination: Pagination {
+                marker: Some(Marker::Id(reference.id.clone())),
+                ..Default::default()
+            },
+            ..Default::default()
+        };
+        let search = ListSnippetsQuery {
+            search: Some("print".to_string()),
+            ..Default::default()
+        };
+        for criteria in [next.clone(), next, search.clone(), search] {
+            storage.list(criteria).await.unwrap();
+        }
+        assert_eq!(inner.lists.load(Ordering::Relaxed), 6);
+
+        let stats = storage.stats();
+        assert_eq!((stats.hits(), stats.misses()), (2, 2));
+    }
+
+    #[tokio::test]
+    async fn first_pages_invalidation() {
+        let inner = Arc::new(FakeStorage::default());
+        let storage = CachedPages::new(inner.clone(), 1 << 20, Duration::from_secs(60));
+        let reference = storage.create(&snippet("print(42)")).await.unwrap();
+        storage.list(ListSnippetsQuery::default()).await.unwrap();
+
+        let imported = snippet("print(43)");
+        storage.import(&[imported.clone()]).await.unwrap();
+        let page = storage.list(ListSnippetsQuery::default()).await.unwrap();
+        assert_eq!(page.snippets.len(), 2);
+
+        let changes = SnippetChanges {
+            content: Some("print(44)".to_string()),
+            ..Default::default()
+        };
+        let updated = storage.update(&reference.id, &changes).await.unwrap();
+        assert_eq!(
+            updated.changesets[1],
+            Changeset::new(1, "print(44)".to_string())
+        );
+        let page = storage.list(ListSnippetsQuery::default()).await.unwrap();
+        assert!(page.snippets.contains(&updated));
+
+        storage.delete(&imported.id).await.unwrap();
+        let page = storage.list(ListSnippetsQuery::default()).await.unwrap();
+        assert_eq!(page.snippets, vec![updated]);
+        assert_eq!(inner.lists.load(Ordering::Relaxed), 4);
+    }
+
+    #[tokio::test]
+    async fn first_pages_coalescing() {
+        let inner = Arc::new(FakeStorage::default());
+        let storage = CachedPages::new(inner.clone(), 1 << 20, Duration::from_secs(60));
+        storage.create(&snippet("print(42)")).await.unwrap();
+
+        let pages = futures_util::future::join_all(
+            (0..8).map(|_| storage.list(ListSnippetsQuery::default())),
+        )
+        .await;
+        assert!(pages.iter().all(|page| page.is_ok()));
+        assert_eq!(inner.lists.load(Ordering::Relaxed), 1);
+
+        let stats = storage.stats();
+        assert_eq!((stats.hits(), stats.misses()), (7, 1));
+    }
+}
@@ -9,6 +9,9 @@ pub enum StorageError {
     Duplicate { id: String },
     /// Snippet with this id can't be found
     NotFound { id: String },
+    /// The storage can't serve the request right now (e.g. because all
+    /// database connections are busy), but the request can be retried later
+    Unavailable(Box<dyn error::Error + Send>),
     /// All other errors that can't be handled by the storage layer
     InternalError(Box<dyn error::Error + Send>),
 }
@@ -18,6 +21,7 @@ impl fmt::Display for StorageError {
         match self {
             StorageError::Duplicate { id } => write!(f, "Snippet with id `{}` already exists", id),
             StorageError::NotFound { id } => write!(f, "Snippet with id `{}` is not found", id),
+            StorageError::Unavailable(e) => write!(f, "Storage is unavailable: `{}`", e),
             StorageError::InternalError(e) => write!(f, "Internal error: `{}`", e),
         }
     }
@@ -59,5 +63,11 @@ mod tests {
             "Internal error: `invalid float literal`",
             format!("{}", StorageError::InternalError(Box::new(error)))
         );
+
+        let error = "foo".parse::<f32>().err().unwrap();
+        assert_eq!(
+            "Storage is unavailable: `invalid float literal`",
+            format!("{}", StorageError::Unavailable(Box::new(error)))
+        );
     }
 }
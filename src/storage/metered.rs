@@ -0,0 +1,99 @@
+use std::future::Future;
+use std::time::Instant;
+
+use prometheus::HistogramVec;
+
+use super::{
+    errors::StorageError, Checkpoint, ListSnippetsQuery, Page, Snippet, SnippetChanges,
+    SnippetStream, Storage,
+};
+
+/// A Storage decorator that records the duration of each call of the
+/// underlying storage.
+///
+/// Durations are observed by the given histogram, which must have two labels:
+/// the name of the Storage method and the outcome of the call ("ok" or the
+/// kind of the returned error).
+pub struct MeteredStorage<S> {
+    inner: S,
+    durations: HistogramVec,
+}
+
+impl<S: Storage> MeteredStorage<S> {
+    pub fn new(inner: S, durations: HistogramVec) -> Self {
+        Self { inner, durations }
+    }
+
+    async fn observe<T, F>(&self, operation: &str, call: F) -> Result<T, StorageError>
+    where
+        F: Future<Output = Result<T, StorageError>>,
+    {
+        let started = Instant::now();
+        let result = call.await;
+        self.durations
+            .with_label_values(&[operation, outcome(&result)])
+            .observe(started.elapsed().as_secs_f64());
+
+        result
+    }
+}
+
+/// Returns the value of the outcome label for the given result.
+fn outcome<T>(result: &Result<T, StorageError>) -> &'static str {
+    match result {
+        Ok(_) => "ok",
+        Err(StorageError::Duplicate { .. }) => "duplicate",
+        Err(StorageError::NotFound { .. }) => "not_found",
+        Err(StorageError::Unavailable(_)) => "unavailable",
+        Err(StorageError::InternalError(_)) => "error",
+    }
+}
+
+#[rocket::async_trait]
+impl<S: Storage> Storage for MeteredStorage<S> {
+    async fn create(&self, snippet: &Snippet) -> Result<Snippet, StorageError> {
+        self.observe("create", self.inner.create(snippet)).await
+    }
+
+    async fn import(
+        &self,
+        snippets: &[Snippet],
+    ) -> Result<Vec<Result<(), StorageError>>, StorageError> {
+        self.observe("import", self.inner.import(snippets)).await
+    }
+
+    async fn list(&self, criteria: ListSnippetsQuery) -> Result<Page, StorageError> {
+        self.observe("list", self.inner.list(criteria)).await
+    }
+
+    async fn estimate_count(&self, criteria: &ListSnippetsQuery) -> Result<u64, StorageError> {
+        self.observe("estimate_count", self.inner.estimate_count(criteria))
+            .await
+    }
+
+    async fn export(&self, after: Option<Checkpoint>) -> Result<SnippetStream, StorageError> {
+        // only the time it takes to start the export is observed
+        self.observe("export", self.inner.export(after)).await
+    }
+
+    async fn get(&self, id: &str) -> Result<Snippet, StorageError> {
+        self.observe("get", self.inner.get(id)).await
+    }
+
+    async fn get_latest(&self, id: &str) -> Result<Snippet, StorageError> {
+        self.observe("get_latest", self.inner.get_latest(id)).await
+    }
+
+    async fn get_version(&self, id: &str, version: usize) -> Result<Snippet, StorageError> {
+        self.observe("get_version", self.inner.get_version(id, version))
+            .await
+    }
+
+    async fn update(&self, id: &str, changes: &SnippetChanges) -> Result<Snippet, StorageError> {
+        self.observe("update", self.inner.update(id, changes)).await
+    }
+
+    async fn delete(&self, id: &str) -> Result<(), StorageError> {
+        self.observe("delete", self.inner.delete(id)).await
+    }
+}
@@ -1,10 +1,22 @@
+mod cache;
 mod errors;
+mod metered;
 mod models;
 mod sql;
 
+use futures_util::stream::{self, BoxStream, StreamExt};
+
+pub use cache::{CacheStats, CachedPages, CachedStorage};
 pub use errors::StorageError;
-pub use models::{Changeset, DateTime, Direction, ListSnippetsQuery, Pagination, Snippet};
-pub use sql::SqlStorage;
+pub use metered::MeteredStorage;
+pub use models::{
+    Changeset, Checkpoint, DateTime, Direction, ListSnippetsQuery, Marker, Page, Pagination,
+    Position, Snippet, SnippetChanges, SnippetSummary, View, PREVIEW_LENGTH,
+};
+pub use sql::{HealthCheck, PoolOptions, PoolStats, ReplicaOptions, SqlStorage};
+
+/// A stream of snippets returned by `Storage::export`.
+pub type SnippetStream = BoxStream<'static, Result<Snippet, StorageError>>;
 
 /// CRUD interface for storing/loading snippets from a persistent storage.
 ///
@@ -15,16 +27,95 @@ pub trait Storage: Send + Sync {
     /// Save the state of the given snippet to the persistent storage.
     async fn create(&self, snippet: &Snippet) -> Result<Snippet, StorageError>;
 
+    /// Save the state of the given snippets to the persistent storage in
+    /// batches. Unlike `create`, a snippet that can't be saved does not fail
+    /// the whole operation: the returned vector contains the outcome for each
+    /// snippet in the order they were passed.
+    async fn import(
+        &self,
+        snippets: &[Snippet],
+    ) -> Result<Vec<Result<(), StorageError>>, StorageError>;
+
     /// Returns a list of snippets that satisfy the given criteria.
-    async fn list(&self, criteria: ListSnippetsQuery) -> Result<Vec<Snippet>, StorageError>;
+    async fn list(&self, criteria: ListSnippetsQuery) -> Result<Page, StorageError>;
+
+    /// Returns an estimate of the number of snippets that satisfy the given
+    /// criteria (pagination is ignored). The estimate is cheap to compute,
+    /// but might be off, in particular for small or recently modified sets.
+    async fn estimate_count(&self, criteria: &ListSnippetsQuery) -> Result<u64, StorageError> {
+        // the exact count is the best estimate, albeit an expensive one
+        let mut criteria = criteria.clone();
+        criteria.pagination = Pagination {
+            limit: usize::MAX,
+            ..Default::default()
+        };
+
+        Ok(self.list(criteria).await?.snippets.len() as u64)
+    }
+
+    /// Returns all snippets from older to newer ones, starting after the
+    /// given checkpoint, if any. Only the latest changeset of each snippet
+    /// is returned. The snippets are meant to be consumed as they arrive:
+    /// the storage does not keep all of them in memory at once, and might
+    /// hold on to resources (e.g. a database connection) until the stream
+    /// is exhausted or dropped.
+    async fn export(&self, after: Option<Checkpoint>) -> Result<SnippetStream, StorageError> {
+        let criteria = ListSnippetsQuery {
+            pagination: Pagination {
+                direction: Direction::Asc,
+                limit: usize::MAX,
+                marker: after.map(|checkpoint| Marker::Id(checkpoint.id)),
+            },
+            ..Default::default()
+        };
+
+        let snippets = self.list(criteria).await?.snippets;
+        Ok(stream::iter(snippets.into_iter().map(|mut snippet| {
+            let latest = snippet.changesets.pop();
+            snippet.changesets = latest.into_iter().collect();
+            Ok(snippet)
+        }))
+        .boxed())
+    }
 
     /// Returns the snippet uniquely identified by a given id (a slug or a
     /// legacy numeric id)
     async fn get(&self, id: &str) -> Result<Snippet, StorageError>;
 
-    /// Update the state of the given snippet in the persistent storage
-    #[allow(dead_code)]
-    async fn update(&self, snippet: &Snippet) -> Result<Snippet, StorageError>;
+    /// Returns the snippet uniquely identified by a given id (a slug or a
+    /// legacy numeric id) with only its latest changeset and without tags.
+    /// Allows for retrieving the content of a snippet without loading the
+    /// whole history of changes.
+    async fn get_latest(&self, id: &str) -> Result<Snippet, StorageError> {
+        let mut snippet = self.get(id).await?;
+        let latest = snippet.changesets.pop();
+        snippet.changesets = latest.into_iter().collect();
+        snippet.tags.clear();
+
+        Ok(snippet)
+    }
+
+    /// Returns the snippet uniquely identified by a given id (a slug or a
+    /// legacy numeric id) with only the changeset of the given version and
+    /// without tags.
+    async fn get_version(&self, id: &str, version: usize) -> Result<Snippet, StorageError> {
+        let mut snippet = self.get(id).await?;
+        snippet.changesets.retain(|c| c.version == version);
+        if snippet.changesets.is_empty() {
+            return Err(StorageError::NotFound { id: id.to_owned() });
+        }
+        snippet.tags.clear();
+
+        Ok(snippet)
+    }
+
+    /// Apply the given changes to the snippet uniquely identified by a given
+    /// id (a slug). The changes are applied to the current state of the
+    /// snippet in the persistent storage, so the fields that are not changed
+    /// keep the values written by concurrent updates. The history of changes
+    /// is append-only: a changed content is added as a new version, and the
+    /// stored versions are never modified.
+    async fn update(&self, id: &str, changes: &SnippetChanges) -> Result<Snippet, StorageError>;
 
     /// Delete the snippet uniquely identified by a given id (a slug or a legacy
     /// numeric id)
@@ -2,11 +2,14 @@ use rand::distr::{Alphanumeric, SampleString};
 use serde::{ser::SerializeStruct, Serialize, Serializer};
 
 const DEFAULT_SLUG_LENGTH: usize = 8;
+/// The maximum number of characters of the content included into the summary
+/// view of a snippet.
+pub const PREVIEW_LENGTH: usize = 256;
 
 pub type DateTime = chrono::DateTime<chrono::Utc>;
 
 /// A code snippet
-#[derive(Debug, Default, Eq, PartialEq)]
+#[derive(Clone, Debug, Default, Eq, PartialEq)]
 pub struct Snippet {
     /// Slug that uniquely identifies the snippet
     pub id: String,
@@ -76,26 +79,114 @@ impl Serialize for Snippet {
     }
 }
 
-#[derive(Debug, Clone)]
+/// A snippet serialized without its content. Only the beginning of the
+/// content (up to PREVIEW_LENGTH characters) is exposed as `preview`, and
+/// `truncated` tells whether there is more to it.
+#[derive(Debug)]
+pub struct SnippetSummary(pub Snippet);
+
+impl Serialize for SnippetSummary {
+    fn serialize<S>(&self, serializer: S) -> Result<S::Ok, S::Error>
+    where
+        S: Serializer,
+    {
+        let snippet = &self.0;
+        let content = snippet
+            .changesets
+            .last()
+            .map(|v| v.content.as_str())
+            .unwrap_or_default();
+        let (preview, truncated) = match content.char_indices().nth(PREVIEW_LENGTH) {
+            Some((end, _)) => (&content[..end], true),
+            None => (content, false),
+        };
+
+        let mut s = serializer.serialize_struct("SnippetSummary", 8)?;
+        s.serialize_field("id", &snippet.id)?;
+        s.serialize_field("title", &snippet.title)?;
+        s.serialize_field("syntax", &snippet.syntax)?;
+        s.serialize_field("preview", preview)?;
+        s.serialize_field("truncated", &truncated)?;
+        s.serialize_field("tags", &snippet.tags)?;
+        s.serialize_field("created_at", &snippet.created_at)?;
+        s.serialize_field("updated_at", &snippet.updated_at)?;
+        s.end()
+    }
+}
+
+/// The parts of snippets that are loaded by a query.
+#[derive(Debug, Default, Clone, Copy, PartialEq, Eq, Hash)]
+pub enum View {
+    /// Snippets are loaded in full.
+    #[default]
+    Full,
+    /// Only the latest changeset of each snippet is loaded, and its content
+    /// is cut to PREVIEW_LENGTH + 1 characters (i.e. just enough to tell
+    /// whether the preview is truncated). Meant to be serialized as
+    /// SnippetSummary.
+    Summary,
+}
+
+impl View {
+    pub fn as_str(&self) -> &'static str {
+        match self {
+            View::Full => "full",
+            View::Summary => "summary",
+        }
+    }
+}
+
+#[derive(Debug, Clone, PartialEq, Eq, Hash)]
 pub enum Direction {
     /// From older to newer snippets.
-    #[allow(dead_code)]
     Asc,
     /// From newer to older snippets.
     Desc,
 }
 
+/// The position of a snippet in the order snippets are listed in.
+#[derive(Clone, Copy, Debug, PartialEq)]
+pub struct Position {
+    /// Timestamp of when the snippet was created
+    pub created_at: DateTime,
+    /// The identifier of the snippet internal to the storage. Resolves the
+    /// ties of created_at
+    pub internal_id: i32,
+    /// The relevance of the snippet to the full-text search query, if the
+    /// snippets are searched
+    pub rank: Option<f32>,
+}
+
+/// Identifies the last snippet on the previous page.
+#[derive(Clone, Debug, PartialEq)]
+pub enum Marker {
+    /// The id (slug) of the snippet. The storage has to look the snippet up
+    /// to find out its position
+    Id(String),
+    /// The position of the snippet, as returned by a previous call of `list`
+    Position(Position),
+}
+
+/// Identifies the last exported snippet, so that an export can be resumed.
+/// Snippets are exported from older to newer ones.
+#[derive(Clone, Debug, PartialEq, Eq)]
+pub struct Checkpoint {
+    /// Timestamp of when the snippet was created
+    pub created_at: DateTime,
+    /// The id (slug) of the snippet. Resolves the ties of created_at
+    pub id: String,
+}
+
 #[derive(Debug, Clone)]
 pub struct Pagination {
     /// Pagination direction.
     pub direction: Direction,
     /// The maximum number of snippets per page.
     pub limit: usize,
-    /// The id (slug) of the last snippet on the previous page. Used to identify
-    /// the first snippet on the next page. If not set, pagination starts
-    /// from the newest or the oldest snippet, depending on the chosen
-    /// diretion.
-    pub marker: Option<String>,
+    /// The last snippet on the previous page. Used to identify the first
+    /// snippet on the next page. If not set, pagination starts from the
+    /// newest or the oldest snippet, depending on the chosen diretion.
+    pub marker: Option<Marker>,
 }
 
 impl Pagination {
@@ -121,12 +212,35 @@ pub struct ListSnippetsQuery {
     /// If set, only the snippets that have *one of* the specified tags attached
     /// will be returned.
     pub tags: Option<Vec<String>>,
+    /// If set, only the snippets whose titles or contents match the specified
+    /// full-text search query will be returned, most relevant first.
+    pub search: Option<String>,
     /// Pagination parameters.
     pub pagination: Pagination,
+    /// The parts of the snippets to be loaded.
+    pub view: View,
+}
+
+/// A page of snippets returned by `Storage::list`.
+#[derive(Clone, Debug, Default, PartialEq)]
+pub struct Page {
+    /// The snippets in the requested order
+    pub snippets: Vec<Snippet>,
+    /// The positions of the snippets (in the same order), which can be passed
+    /// back as pagination markers
+    pub positions: Vec<Position>,
+}
+
+impl Page {
+    /// Shorten the page, keeping the first `len` snippets.
+    pub fn truncate(&mut self, len: usize) {
+        self.snippets.truncate(len);
+        self.positions.truncate(len);
+    }
 }
 
 /// A particular snippet revision
-#[derive(Debug, Default, Eq, Ord, PartialEq, PartialOrd)]
+#[derive(Clone, Debug, Default, Eq, Ord, PartialEq, PartialOrd)]
 pub struct Changeset {
     /// Changeset index. Version numbers start from 0 and are incremented by 1
     pub version: usize,
@@ -150,6 +264,21 @@ impl Changeset {
     }
 }
 
+/// Changes to the state of a snippet. The fields that are None are left
+/// intact
+#[derive(Clone, Debug, Default, Eq, PartialEq)]
+pub struct SnippetChanges {
+    /// New snippet title. Some(None) unsets the title
+    pub title: Option<Option<String>>,
+    /// New snippet syntax. Some(None) unsets the syntax
+    pub syntax: Option<Option<String>>,
+    /// New snippet content. Added as a new revision, unless it's the same as
+    /// the content of the most recent one
+    pub content: Option<String>,
+    /// New list of tags attached to the snippet
+    pub tags: Option<Vec<String>>,
+}
+
 #[cfg(test)]
 mod tests {
     use super::*;
@@ -369,4 +498,51 @@ mod tests {
         let actual = serde_json::to_string(&reference).expect("failed to serialize snippet");
         assert_eq!(actual, expected);
     }
+    #[test]
+    fn test_summary_serialization() {
+        let dt = chrono::DateTime::parse_from_rfc3339("2020-08-09T10:39:57+00:00")
+            .unwrap()
+            .with_timezone(&chrono::Utc);
+        let mut snippet = Snippet {
+            id: "spam".to_string(),
+            title: Some("Hello".to_string()),
+            syntax: Some("python".to_string()),
+            changesets: vec![Changeset::new(1, "print(42)".to_string())],
+            tags: vec!["foo".to_string()],
+            created_at: Some(dt),
+            updated_at: Some(dt),
+        };
+
+        let expected = "{\
+            \"id\":\"spam\",\
+            \"title\":\"Hello\",\
+            \"syntax\":\"python\",\
+            \"preview\":\"print(42)\",\
+            \"truncated\":false,\
+            \"tags\":[\"foo\"],\
+            \"created_at\":\"2020-08-09T10:39:57Z\",\
+            \"updated_at\":\"2020-08-09T10:39:57Z\"\
+        }";
+        let actual = serde_json::to_string(&SnippetSummary(snippet.clone()))
+            .expect("failed to serialize snippet");
+        assert_eq!(actual, expected);
+
+        // the preview is cut at a character (not byte) boundary
+        let content = "\u{1F980}".repeat(PREVIEW_LENGTH + 1);
+        snippet.changesets = vec![Changeset::new(1, content.clone())];
+        let actual = serde_json::to_value(SnippetSummary(snippet.clone()))
+            .expect("failed to serialize snippet");
+        assert_eq!(
+            actual["preview"],
+            content.chars().take(PREVIEW_LENGTH).collect::<String>()
+        );
+        assert_eq!(actual["truncated"], true);
+
+        // a snippet without changesets has an empty preview
+        snippet.changesets = vec![];
+        let actual =
+            serde_json::to_value(SnippetSummary(snippet)).expect("failed to serialize snippet");
+        assert_eq!(actual["preview"], "");
+        assert_eq!(actual["truncated"], false);
+    }
 }
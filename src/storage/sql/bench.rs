@@ -0,0 +1,490 @@
+//! Benchmarks of SqlStorage that do not involve the HTTP layer.
+//!
+//! The storage is called directly, so that a slowdown can be attributed to
+//! either SQL or the rest of the stack (Rocket, serialization) by comparing
+//! the numbers with the latency of the API. Every operation is measured
+//! separately, and reports its latency percentiles and throughput, along
+//! with the number of queries, round-trips, and the time spent waiting for
+//! a connection per call.
+//!
+//! Unlike the tests, which never commit, the benchmarks run concurrent
+//! calls on many connections, so they need a database of their own: all
+//! snippets are deleted from it before the run. The benchmarks are ignored
+//! by default, and are skipped if the database is not configured:
+//!
+//! ```text
+//! XSNIPPET_BENCH_DATABASE_URL=postgres://localhost/xsnippet_bench \
+//!     cargo test --release -- --ignored --nocapture storage_benchmark
+//! ```
+//!
+//! The parameters are passed as environment variables:
+//!
+//! * XSNIPPET_BENCH_SNIPPETS - the number of snippets the database is seeded
+//!   with (default: 10000)
+//! * XSNIPPET_BENCH_CHANGESETS - the number of changesets per snippet
+//!   (default: 1)
+//! * XSNIPPET_BENCH_CONTENT_SIZE - the size of each changeset in bytes
+//!   (default: 1024)
+//! * XSNIPPET_BENCH_CONCURRENCY - the number of concurrent calls (default: 8)
+//! * XSNIPPET_BENCH_POOL_SIZE - the maximum number of connections (default:
+//!   the concurrency)
+//! * XSNIPPET_BENCH_OPERATIONS - the number of calls per operation (default:
+//!   1000)
+//! * XSNIPPET_BENCH_IMPORT_BATCH - the number of snippets per import call
+//!   (default: 100)
+//! * XSNIPPET_BENCH_PROFILE_DIR - if set, every operation is profiled by
+//!   `perf record`, and the profiles are written to this directory as
+//!   `<operation>.perf.data`. A profile can be turned into a flamegraph by
+//!   e.g. `perf script -i list.perf.data | inferno-collapse-perf |
+//!   inferno-flamegraph > list.svg`
+//!
+//! Queries are counted by the instrumentation of the connections. The
+//! number of round-trips is the number of queries plus the number of
+//! statements that have been prepared and cached; statements that are not
+//! cached (e.g. the ones with a variable number of bind parameters) are
+//! prepared on every call, so it's a lower bound.
+
+use std::future::Future;
+use std::path::{Path, PathBuf};
+use std::process::{Child, Command, Stdio};
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::Arc;
+use std::time::{Duration, Instant};
+
+use diesel::connection::{Instrumentation, InstrumentationEvent};
+use diesel_async::pooled_connection::deadpool::Pool;
+use diesel_async::pooled_connection::{AsyncDieselConnectionManager, ManagerConfig};
+use diesel_async::{AsyncConnection, AsyncPgConnection, SimpleAsyncConnection};
+use futures_util::future::FutureExt;
+use rocket::tokio;
+
+use super::super::{errors::StorageError, Changeset, ListSnippetsQuery, Snippet, Storage, View};
+use super::{establish, spawn_partition_maintenance, PoolWaits, Replicas, SqlStorage};
+
+/// The tags the snippets are labeled with, one per snippet.
+const TAGS: &[&str] = &["spam", "eggs", "ham", "foo", "bar", "baz", "qux", "quux"];
+/// The number of snippets imported per call when the database is seeded.
+const SEED_BATCH_SIZE: usize = 1000;
+
+/// Parameters of a benchmark run (see the module documentation).
+#[derive(Debug)]
+struct Params {
+    snippets: usize,
+    changesets: usize,
+    content_size: usize,
+    concurrency: usize,
+    pool_size: usize,
+    operations: usize,
+    import_batch: usize,
+    profile_dir: Option<PathBuf>,
+}
+
+impl Params {
+    fn from_env() -> Self {
+        let concurrency = param("XSNIPPET_BENCH_CONCURRENCY", 8);
+        Params {
+            snippets: param("XSNIPPET_BENCH_SNIPPETS", 10000),
+            changesets: param("XSNIPPET_BENCH_CHANGESETS", 1),
+            content_size: param("XSNIPPET_BENCH_CONTENT_SIZE", 1024),
+            concurrency,
+            pool_size: param("XSNIPPET_BENCH_POOL_SIZE", concurrency),
+            operations: param("XSNIPPET_BENCH_OPERATIONS", 1000),
+            import_batch: param("XSNIPPET_BENCH_IMPORT_BATCH", 100),
+            profile_dir: std::env::var_os("XSNIPPET_BENCH_PROFILE_DIR").map(PathBuf::from),
+        }
+    }
+
+    /// Returns a new snippet. The contents are unique, so that the blobs are
+    /// not deduplicated, and the changesets only differ in their first
+    /// lines, so that the older ones are stored as deltas.
+    fn snippet(&self, number: usize) -> Snippet {
+        let line = format!("print({})\n", number);
+        let mut body = line.repeat(self.content_size / line.len() + 1);
+        body.truncate(self.content_size);
+
+        Snippet::new(
+            Some(format!("Snippet #{}", number)),
+            Some("python".to_string()),
+            (0..self.changesets.max(1))
+                .map(|version| Changeset::new(version, format!("# {}\n{}", version, body)))
+                .collect(),
+            vec![TAGS[number % TAGS.len()].to_string()],
+        )
+    }
+}
+
+fn param(name: &str, default: usize) -> usize {
+    match std::env::var(name) {
+        Ok(value) => value
+            .parse()
+            .unwrap_or_else(|_| panic!("{} must be a non-negative integer", name)),
+        Err(_) => default,
+    }
+}
+
+/// Counters of the queries run by all connections of a pool.
+#[derive(Clone, Debug, Default)]
+struct QueryCounters {
+    queries: Arc<AtomicU64>,
+    prepared: Arc<AtomicU64>,
+    transactions: Arc<AtomicU64>,
+    query_time_us: Arc<AtomicU64>,
+}
+
+/// The instrumentation of a single connection. A connection runs one query
+/// at a time, so the start of the current one is all it needs to keep.
+struct CountQueries {
+    counters: QueryCounters,
+    started: Option<Instant>,
+}
+
+impl Instrumentation for CountQueries {
+    fn on_connection_event(&mut self, event: InstrumentationEvent<'_>) {
+        match event {
+            InstrumentationEvent::StartQuery { .. } => {
+                self.counters.queries.fetch_add(1, Ordering::Relaxed);
+                self.started = Some(Instant::now());
+            }
+            InstrumentationEvent::FinishQuery { .. } => {
+                if let Some(started) = self.started.take() {
+                    self.counters
+                        .query_time_us
+                        .fetch_add(started.elapsed().as_micros() as u64, Ordering::Relaxed);
+                }
+            }
+            InstrumentationEvent::CacheQuery { .. } => {
+                self.counters.prepared.fetch_add(1, Ordering::Relaxed);
+            }
+            // savepoints are not transactions of their own
+            InstrumentationEvent::BeginTransaction { depth, .. } if depth.get() == 1 => {
+                self.counters.transactions.fetch_add(1, Ordering::Relaxed);
+            }
+            _ => {}
+        }
+    }
+}
+
+/// Returns a storage whose connections are instrumented to update the given
+/// counters. Replicas are not used, so all calls go to the given database.
+fn instrumented_storage(
+    database_url: &str,
+    pool_size: usize,
+    counters: &QueryCounters,
+) -> SqlStorage {
+    let mut config = ManagerConfig::default();
+    let counters = counters.clone();
+    config.custom_setup = Box::new(move |url| {
+        let counters = counters.clone();
+        establish(url, None)
+            .map(move |conn| {
+                let mut conn = conn?;
+                conn.set_instrumentation(CountQueries {
+                    counters,
+                    started: None,
+                });
+                Ok(conn)
+            })
+            .boxed()
+    });
+
+    let pool = Pool::builder(AsyncDieselConnectionManager::new_with_config(
+        database_url,
+        config,
+    ))
+    .max_size(pool_size)
+    .build()
+    .expect("Failed to build a db connection pool");
+    spawn_partition_maintenance(pool.clone());
+
+    SqlStorage {
+        pool,
+        replicas: Replicas::default(),
+        waits: PoolWaits::default(),
+        min_idle: 0,
+    }
+}
+
+/// The values of all counters at some point of a run.
+#[derive(Clone, Copy, Debug)]
+struct Totals {
+    queries: u64,
+    prepared: u64,
+    transactions: u64,
+    query_time: Duration,
+    pool_wait: Duration,
+}
+
+impl Totals {
+    fn new(storage: &SqlStorage, counters: &QueryCounters) -> Self {
+        let stats = storage.pool_stats();
+        Totals {
+            queries: counters.queries.load(Ordering::Relaxed),
+            prepared: counters.prepared.load(Ordering::Relaxed),
+            transactions: counters.transactions.load(Ordering::Relaxed),
+            query_time: Duration::from_micros(counters.query_time_us.load(Ordering::Relaxed)),
+            pool_wait: stats.wait_time(),
+        }
+    }
+
+    /// Returns the counters accumulated since the given earlier totals,
+    /// averaged over the given number of calls, as JSON.
+    fn per_call(&self, earlier: &Totals, calls: usize) -> serde_json::Value {
+        let calls = calls.max(1) as f64;
+        let queries = (self.queries - earlier.queries) as f64;
+        let prepared = (self.prepared - earlier.prepared) as f64;
+
+        serde_json::json!({
+            "queries": queries / calls,
+            "round_trips": (queries + prepared) / calls,
+            "transactions": (self.transactions - earlier.transactions) as f64 / calls,
+            "query_time_ms": millis(self.query_time - earlier.query_time) / calls,
+            "pool_wait_ms": millis(self.pool_wait - earlier.pool_wait) / calls,
+        })
+    }
+}
+
+fn millis(duration: Duration) -> f64 {
+    duration.as_secs_f64() * 1000.0
+}
+
+/// A `perf record` process attached to the benchmark.
+struct Profile(Child);
+
+impl Profile {
+    fn start(dir: &Path, operation: &str) -> Self {
+        let child = Command::new("perf")
+            .args(["record", "--call-graph", "dwarf", "-F", "999", "-o"])
+            .arg(dir.join(format!("{}.perf.data", operation)))
+            .args(["-p", &std::process::id().to_string()])
+            .stdout(Stdio::null())
+            .spawn()
+            .expect("Failed to run perf");
+        Profile(child)
+    }
+
+    fn stop(mut self) {
+        // perf only writes a complete profile when it's interrupted
+        Command::new("kill")
+            .args(["-INT", &self.0.id().to_string()])
+            .status()
+            .expect("Failed to stop perf");
+        self.0.wait().expect("Failed to wait for perf");
+    }
+}
+
+/// Runs the given operation the configured number of times, with the
+/// configured concurrency, and prints the results as a line of JSON. The
+/// operation is passed the storage and the number of the call.
+async fn measure<F, R>(
+    params: &Params,
+    storage: &Arc<SqlStorage>,
+    counters: &QueryCounters,
+    name: &str,
+    operation: F,
+) where
+    F: Fn(Arc<SqlStorage>, usize) -> R + Clone + Send + 'static,
+    R: Future<Output = Result<(), StorageError>> + Send + 'static,
+{
+    let profile = params
+        .profile_dir
+        .as_deref()
+        .map(|dir| Profile::start(dir, name));
+    if profile.is_some() {
+        // give perf a moment to attach to the process
+        tokio::time::sleep(Duration::from_millis(500)).await;
+    }
+
+    let before = Totals::new(storage, counters);
+    let started = Instant::now();
+    let workers = (0..params.concurrency)
+        .map(|worker| {
+            let storage = storage.clone();
+            let operation = operation.clone();
+            let calls = (worker..params.operations).step_by(params.concurrency);
+            tokio::spawn(async move {
+                let mut latencies = Vec::with_capacity(calls.len());
+                let mut errors = 0;
+                for call in calls {
+                    let started = Instant::now();
+                    if let Err(e) = operation(storage.clone(), call).await {
+                        warn!("Call #{} failed: {}", call, e);
+                        errors += 1;
+                    }
+                    latencies.push(started.elapsed());
+                }
+                (latencies, errors)
+            })
+        })
+        .collect::<Vec<_>>();
+
+    let mut latencies = Vec::with_capacity(params.operations);
+    let mut errors = 0;
+    for worker in workers {
+        let (worker_latencies, worker_errors) = worker.await.expect("Benchmark worker panicked");
+        latencies.extend(worker_latencies);
+        errors += worker_errors;
+    }
+    let elapsed = started.elapsed();
+    let after = Totals::new(storage, counters);
+
+    if let Some(profile) = profile {
+        profile.stop();
+    }
+
+    latencies.sort();
+    let percentile = |p: usize| {
+        latencies
+            .get((latencies.len() * p / 100).min(latencies.len().saturating_sub(1)))
+            .copied()
+            .map_or(0.0, millis)
+    };
+    println!(
+        "{}",
+        serde_json::json!({
+            "operation": name,
+            "calls": latencies.len(),
+            "errors": errors,
+            "throughput": latencies.len() as f64 / elapsed.as_secs_f64(),
+            "latency_ms": {
+                "p50": percentile(50),
+                "p90": percentile(90),
+                "p99": percentile(99),
+                "max": percentile(100),
+            },
+            "per_call": after.per_call(&before, latencies.len()),
+        })
+    );
+}
+
+/// Not a correctness test, but a benchmark of the storage operations. See
+/// the module documentation on how to run it.
+#[tokio::test(flavor = "multi_thread")]
+#[ignore]
+async fn storage_benchmark() {
+    let database_url = match std::env::var("XSNIPPET_BENCH_DATABASE_URL") {
+        Ok(url) => url,
+        Err(_) => {
+            error!("XSNIPPET_BENCH_DATABASE_URL is not set, skipping the benchmark");
+            return;
+        }
+    };
+    let params = Arc::new(Params::from_env());
+    assert!(params.concurrency > 0, "Concurrency must be positive");
+    println!("{:?}", params);
+
+    let counters = QueryCounters::default();
+    let storage = Arc::new(instrumented_storage(
+        &database_url,
+        params.pool_size,
+        &counters,
+    ));
+
+    // start from an empty database, so that the results only depend on the
+    // parameters
+    let mut conn = storage
+        .connection()
+        .await
+        .expect("Failed to get a connection");
+    conn.batch_execute("TRUNCATE snippets, changesets, tags, blobs")
+        .await
+        .expect("Failed to delete existing snippets");
+    drop(conn);
+
+    let seeded = (0..params.snippets)
+        .map(|number| params.snippet(number))
+        .collect::<Vec<_>>();
+    for batch in seeded.chunks(SEED_BATCH_SIZE) {
+        for result in storage
+            .import(batch)
+            .await
+            .expect("Failed to seed the database")
+        {
+            result.expect("Failed to seed the database");
+        }
+    }
+    let ids = Arc::new(
+        seeded
+            .into_iter()
+            .map(|snippet| snippet.id)
+            .collect::<Vec<_>>(),
+    );
+    // the statistics of the seeded tables are needed for the usual plans
+    let mut conn = storage
+        .connection()
+        .await
+        .expect("Failed to get a connection");
+    conn.batch_execute("ANALYZE snippets, changesets, tags, blobs")
+        .await
+        .expect("Failed to analyze the tables");
+    drop(conn);
+
+    let first = params.snippets;
+    let benchmark_params = params.clone();
+    measure(
+        &params,
+        &storage,
+        &counters,
+        "create",
+        move |storage, call| {
+            let snippet = benchmark_params.snippet(first + call);
+            async move { storage.create(&snippet).await.map(|_| ()) }
+        },
+    )
+    .await;
+
+    if !ids.is_empty() {
+        let get_ids = ids.clone();
+        measure(&params, &storage, &counters, "get", move |storage, call| {
+            let id = get_ids[rand::random::<u64>() as usize % get_ids.len()].clone();
+            async move { storage.get(&id).await.map(|_| ()) }
+        })
+        .await;
+    }
+
+    measure(
+        &params,
+        &storage,
+        &counters,
+        "list",
+        |storage, _| async move { storage.list(ListSnippetsQuery::default()).await.map(|_| ()) },
+    )
+    .await;
+
+    measure(
+        &params,
+        &storage,
+        &counters,
+        "list_summary_by_tag",
+        |storage, call| async move {
+            let criteria = ListSnippetsQuery {
+                tags: Some(vec![TAGS[call % TAGS.len()].to_string()]),
+                view: View::Summary,
+                ..Default::default()
+            };
+            storage.list(criteria).await.map(|_| ())
+        },
+    )
+    .await;
+
+    let first = params.snippets + params.operations;
+    let benchmark_params = params.clone();
+    measure(
+        &params,
+        &storage,
+        &counters,
+        "import",
+        move |storage, call| {
+            let first = first + call * benchmark_params.import_batch;
+            let snippets = (first..first + benchmark_params.import_batch)
+                .map(|number| benchmark_params.snippet(number))
+                .collect::<Vec<_>>();
+            async move {
+                for result in storage.import(&snippets).await? {
+                    result?;
+                }
+                Ok(())
+            }
+        },
+    )
+    .await;
+}
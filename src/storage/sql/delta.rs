@@ -0,0 +1,271 @@
+//! Compact diffs between the versions of a snippet.
+//!
+//! Only the latest changeset of a snippet is always stored in full. When a
+//! new version is appended, the previous one is replaced by a delta against
+//! the new one, i.e. by a list of operations that rebuild the older content
+//! from the newer one. Hence, the history is never rewritten, and an old
+//! version is rebuilt by applying the deltas from the nearest full version
+//! down to it.
+//!
+//! Snippets are mostly edited a few lines at a time, so the contents are
+//! compared line by line using the greedy algorithm from Myers' "An O(ND)
+//! Difference Algorithm and Its Variations", which is fast when the
+//! contents are similar. Contents that are too different are not worth a
+//! delta, and are stored in full instead.
+
+use serde::{Deserialize, Serialize};
+
+/// The maximum number of lines that may differ between two contents for a
+/// delta to be computed. Bounds the time and memory spent on a diff.
+const MAX_EDITS: usize = 1000;
+
+/// An operation of a delta. Serialized as `[start, length]` and `"text"`
+/// respectively, which keeps the deltas of small edits small.
+#[derive(Clone, Debug, PartialEq, Eq, Serialize, Deserialize)]
+#[serde(untagged)]
+pub enum Op {
+    /// Copy the given range of bytes of the base content
+    Copy(usize, usize),
+    /// Insert the given text
+    Insert(String),
+}
+
+/// Returns the operations that rebuild `target` from `base`, or None if the
+/// contents differ in more than MAX_EDITS lines.
+pub fn diff(base: &str, target: &str) -> Option<Vec<Op>> {
+    let a = base.split_inclusive('\n').collect::<Vec<_>>();
+    let b = target.split_inclusive('\n').collect::<Vec<_>>();
+
+    // the common prefix and suffix are matched right away, which is all
+    // there is to most edits
+    let prefix = a.iter().zip(b.iter()).take_while(|(x, y)| x == y).count();
+    let suffix = a[prefix..]
+        .iter()
+        .rev()
+        .zip(b[prefix..].iter().rev())
+        .take_while(|(x, y)| x == y)
+        .count();
+    let middle = matches(&a[prefix..a.len() - suffix], &b[prefix..b.len() - suffix])?;
+
+    // the line of the base each line of the target is copied from, if any
+    let mut sources = vec![None; b.len()];
+    for (j, source) in sources.iter_mut().enumerate().take(prefix) {
+        *source = Some(j);
+    }
+    for (i, j) in middle {
+        sources[prefix + j] = Some(prefix + i);
+    }
+    for (k, source) in sources[b.len() - suffix..].iter_mut().enumerate() {
+        *source = Some(a.len() - suffix + k);
+    }
+
+    let mut offsets = Vec::with_capacity(a.len());
+    let mut offset = 0;
+    for line in a.iter() {
+        offsets.push(offset);
+        offset += line.len();
+    }
+
+    let mut ops = Vec::new();
+    for (line, source) in b.iter().zip(sources) {
+        match (source, ops.last_mut()) {
+            // adjacent lines are copied by a single operation
+            (Some(i), Some(Op::Copy(start, len))) if *start + *len == offsets[i] => {
+                *len += a[i].len()
+            }
+            (Some(i), _) => ops.push(Op::Copy(offsets[i], a[i].len())),
+            (None, Some(Op::Insert(text))) => text.push_str(line),
+            (None, _) => ops.push(Op::Insert(line.to_string())),
+        }
+    }
+
+    Some(ops)
+}
+
+/// Rebuilds the content a delta has been computed for from its base.
+/// Returns None if the delta does not fit the base.
+pub fn apply(base: &str, delta: &[Op]) -> Option<String> {
+    let mut content = String::with_capacity(base.len());
+    for op in delta {
+        match op {
+            Op::Copy(start, len) => content.push_str(base.get(*start..start.checked_add(*len)?)?),
+            Op::Insert(text) => content.push_str(text),
+        }
+    }
+
+    Some(content)
+}
+
+/// Returns the pairs of indices of the matching lines of the longest common
+/// subsequence of `a` and `b` in ascending order, or None if it takes more
+/// than MAX_EDITS insertions and deletions to turn `a` into `b`.
+fn matches(a: &[&str], b: &[&str]) -> Option<Vec<(usize, usize)>> {
+    if a.is_empty() || b.is_empty() {
+        return Some(Vec::new());
+    }
+
+    let (n, m) = (a.len() as isize, b.len() as isize);
+    let max = (n + m) as usize;
+    // v[offset + k] is the furthest x reached on the diagonal k = x - y
+    let offset = max as isize + 1;
+    let mut v = vec![0isize; 2 * max + 3];
+    let at = |v: &[isize], k: isize| v[(offset + k) as usize];
+
+    // the diagonals -d..=d of v before each step, for backtracking
+    let mut trace = Vec::new();
+    for d in 0..=max.min(MAX_EDITS) as isize {
+        trace.push(v[(offset - d) as usize..=(offset + d) as usize].to_vec());
+
+        for k in (-d..=d).step_by(2) {
+            let mut x = if k == -d || (k != d && at(&v, k - 1) < at(&v, k + 1)) {
+                at(&v, k + 1)
+            } else {
+                at(&v, k - 1) + 1
+            };
+            let mut y = x - k;
+            while x < n && y < m && a[x as usize] == b[y as usize] {
+                x += 1;
+                y += 1;
+            }
+            v[(offset + k) as usize] = x;
+
+            if x >= n && y >= m {
+                return Some(backtrack(&trace, n, m));
+            }
+        }
+    }
+
+    None
+}
+
+/// Walks the edits found by `matches` back from the end, and collects the
+/// diagonal moves (i.e. the matching lines) along the way.
+fn backtrack(trace: &[Vec<isize>], n: isize, m: isize) -> Vec<(usize, usize)> {
+    let mut pairs = Vec::new();
+    let (mut x, mut y) = (n, m);
+    for (d, v) in trace.iter().enumerate().rev() {
+        let d = d as isize;
+        let at = |k: isize| v[(d + k) as usize];
+
+        let (prev_x, prev_y) = if d == 0 {
+            (0, 0)
+        } else {
+            let k = x - y;
+            let prev_k = if k == -d || (k != d && at(k - 1) < at(k + 1)) {
+                k + 1
+            } else {
+                k - 1
+            };
+            (at(prev_k), at(prev_k) - prev_k)
+        };
+        while x > prev_x && y > prev_y {
+            x -= 1;
+            y -= 1;
+            pairs.push((x as usize, y as usize));
+        }
+        (x, y) = (prev_x, prev_y);
+    }
+
+    pairs.reverse();
+    pairs
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn round_trip(base: &str, target: &str) -> Vec<Op> {
+        let delta = diff(base, target).expect("Failed to compute a delta");
+        assert_eq!(apply(base, &delta).as_deref(), Some(target));
+
+        delta
+    }
+
+    #[test]
+    fn edits() {
+        let base = (0..100)
+            .map(|i| format!("print({})\n", i))
+            .collect::<String>();
+
+        // a changed line is all that is stored
+        let target = base.replace("print(42)\n", "print('spam')\n");
+        assert_eq!(
+            round_trip(&base, &target),
+            vec![
+                Op::Copy(0, 410),
+                Op::Insert("print('spam')\n".to_string()),
+                Op::Copy(420, 570),
+            ]
+        );
+
+        // as well as inserted ones
+        let target = base.replace("print(42)\n", "print(42)\nprint('eggs')\n");
+        assert_eq!(round_trip(&base, &target).len(), 3);
+
+        // while the removed ones are simply not copied
+        let target = base.replace("print(7)\n", "").replace("print(77)\n", "");
+        assert_eq!(round_trip(&base, &target).len(), 3);
+
+        // lines that have been moved around are copied wherever possible
+        let mut lines = base.lines().collect::<Vec<_>>();
+        lines.swap(10, 90);
+        round_trip(&base, &(lines.join("\n") + "\n"));
+    }
+
+    #[test]
+    fn edge_cases() {
+        for (base, target) in [
+            ("", ""),
+            ("", "spam"),
+            ("spam", ""),
+            ("spam", "eggs"),
+            ("spam\neggs", "spam\neggs\n"),
+            ("spam\n\n\neggs", "\n\nspam\n\n"),
+            ("привет\nмир\n", "привет\nвсем\n"),
+            ("a\nb\nc\na\nb\nb\na\n", "c\nb\na\nb\na\nc\n"),
+        ] {
+            round_trip(base, target);
+            round_trip(target, base);
+        }
+
+        assert_eq!(round_trip("spam", "spam"), vec![Op::Copy(0, 4)]);
+        assert_eq!(round_trip("spam", ""), vec![]);
+    }
+
+    #[test]
+    fn too_different() {
+        let base = (0..MAX_EDITS)
+            .map(|i| format!("{}\n", i))
+            .collect::<String>();
+        let target = (0..MAX_EDITS)
+            .map(|i| format!("{}\n", -(i as isize) - 1))
+            .collect::<String>();
+
+        assert_eq!(diff(&base, &target), None);
+        // unless only one of them has any lines
+        round_trip(&base, "");
+        round_trip("", &target);
+    }
+
+    #[test]
+    fn mismatched_base() {
+        let delta = diff("spam\neggs\n", "eggs\n").unwrap();
+
+        assert_eq!(apply("spam\n", &delta), None);
+        // the ranges must fall on character boundaries
+        assert_eq!(apply("яйца\n", &[Op::Copy(1, 2)]), None);
+        assert_eq!(apply("spam", &[Op::Copy(usize::MAX, 2)]), None);
+    }
+
+    #[test]
+    fn serialization() {
+        let delta = vec![Op::Copy(0, 42), Op::Insert("spam\n".to_string())];
+        let serialized = serde_json::json!([[0, 42], "spam\n"]);
+
+        assert_eq!(serde_json::to_value(&delta).unwrap(), serialized);
+        assert_eq!(
+            serde_json::from_value::<Vec<Op>>(serialized).unwrap(),
+            delta
+        );
+    }
+}
@@ -0,0 +1,78 @@
+//! Estimates of the number of rows returned by queries.
+//!
+//! Counting the snippets that satisfy the criteria of a listing is as
+//! expensive as listing them all. Instead, the number is estimated by the
+//! query planner from the statistics it keeps about the tables, which costs
+//! the same regardless of the size of the tables. The estimates are only as
+//! accurate as the statistics, which are refreshed by (auto)ANALYZE.
+
+use diesel::pg::Pg;
+use diesel::query_builder::{AstPass, Query, QueryFragment, QueryId};
+use diesel::sql_types::Json;
+use diesel::QueryResult;
+
+/// Wraps a query into EXPLAIN (FORMAT JSON). The query is planned, but not
+/// executed.
+#[derive(Debug, QueryId)]
+pub struct ExplainJson<Q>(pub Q);
+
+impl<Q: QueryFragment<Pg>> QueryFragment<Pg> for ExplainJson<Q> {
+    fn walk_ast<'b>(&'b self, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+        out.push_sql("EXPLAIN (FORMAT JSON) ");
+        self.0.walk_ast(out.reborrow())
+    }
+}
+
+impl<Q> Query for ExplainJson<Q> {
+    type SqlType = Json;
+}
+
+/// Returns the number of rows the top node of the plan is expected to return.
+/// The plan must be the output of ExplainJson.
+pub fn plan_rows(plan: &serde_json::Value) -> u64 {
+    plan[0]["Plan"]["Plan Rows"]
+        .as_f64()
+        .map(|rows| rows.max(0.0).round() as u64)
+        .unwrap_or(0)
+}
+
+#[cfg(test)]
+mod tests {
+    use diesel::debug_query;
+    use diesel::prelude::*;
+
+    use super::super::schema::snippets;
+    use super::*;
+
+    #[test]
+    fn to_sql() {
+        let query = ExplainJson(
+            snippets::table
+                .select(snippets::id)
+                .filter(snippets::syntax.eq("rust")),
+        );
+
+        assert_eq!(
+            debug_query::<Pg, _>(&query).to_string(),
+            "EXPLAIN (FORMAT JSON) SELECT \"snippets\".\"id\" FROM \"snippets\" \
+             WHERE (\"snippets\".\"syntax\" = $1) -- binds: [\"rust\"]"
+        );
+    }
+
+    #[test]
+    fn rows() {
+        let plan = serde_json::json!([{
+            "Plan": {
+                "Node Type": "Index Only Scan",
+                "Relation Name": "snippets",
+                "Startup Cost": 0.42,
+                "Total Cost": 1234.5,
+                "Plan Rows": 42317,
+                "Plan Width": 4
+            }
+        }]);
+        assert_eq!(plan_rows(&plan), 42317);
+
+        assert_eq!(plan_rows(&serde_json::json!([])), 0);
+    }
+}
@@ -0,0 +1,119 @@
+//! Server-side cursors for exporting all snippets.
+//!
+//! An export reads the whole table, so neither loading it at once nor
+//! paging through it (which re-plans the query and seeks the index on every
+//! page) is an option. Instead, the query is declared as a cursor within a
+//! transaction, and the rows are fetched from it in fixed-size batches.
+//! PostgreSQL evaluates the query lazily, so the rows are only produced as
+//! fast as they are consumed, and all of them come from the same snapshot.
+
+use std::marker::PhantomData;
+
+use diesel::pg::Pg;
+use diesel::query_builder::{AstPass, Query, QueryFragment, QueryId};
+use diesel::QueryResult;
+
+/// The name of the cursor. A connection only serves one export at a time.
+const CURSOR_NAME: &str = "export_snippets";
+
+/// Wraps a query into DECLARE CURSOR. Must be executed within a
+/// transaction, which the cursor is closed with, unless it's closed by
+/// CloseCursor earlier.
+#[derive(Debug, QueryId)]
+pub struct DeclareCursor<Q>(pub Q);
+
+impl<Q: QueryFragment<Pg>> QueryFragment<Pg> for DeclareCursor<Q> {
+    fn walk_ast<'b>(&'b self, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+        out.push_sql("DECLARE ");
+        out.push_identifier(CURSOR_NAME)?;
+        out.push_sql(" NO SCROLL CURSOR FOR ");
+        self.0.walk_ast(out.reborrow())
+    }
+}
+
+/// Fetches up to the given number of the next rows of the cursor declared
+/// by DeclareCursor. `ST` is the SQL type of the rows of the declared query.
+#[derive(Debug)]
+pub struct Fetch<ST> {
+    rows: usize,
+    sql_type: PhantomData<ST>,
+}
+
+impl<ST> Fetch<ST> {
+    pub fn new(rows: usize) -> Self {
+        Fetch {
+            rows,
+            sql_type: PhantomData,
+        }
+    }
+}
+
+impl<ST> QueryId for Fetch<ST> {
+    type QueryId = ();
+
+    const HAS_STATIC_QUERY_ID: bool = false;
+}
+
+impl<ST> QueryFragment<Pg> for Fetch<ST> {
+    fn walk_ast<'b>(&'b self, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+        // the row count can't be a bind parameter. The statement refers to a
+        // cursor that only exists within the current transaction, so it's
+        // not cached either
+        out.unsafe_to_cache_prepared();
+        out.push_sql(&format!("FETCH FORWARD {} FROM ", self.rows));
+        out.push_identifier(CURSOR_NAME)
+    }
+}
+
+impl<ST> Query for Fetch<ST> {
+    type SqlType = ST;
+}
+
+/// Closes the cursor declared by DeclareCursor. Committing a nested
+/// transaction (i.e. releasing a savepoint) leaves the cursor open, so the
+/// cursor is closed explicitly before that.
+#[derive(Debug, QueryId)]
+pub struct CloseCursor;
+
+impl QueryFragment<Pg> for CloseCursor {
+    fn walk_ast<'b>(&'b self, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+        out.push_sql("CLOSE ");
+        out.push_identifier(CURSOR_NAME)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use diesel::debug_query;
+    use diesel::prelude::*;
+    use diesel::sql_types::Integer;
+
+    use super::super::schema::snippets;
+    use super::*;
+
+    #[test]
+    fn to_sql() {
+        let query = DeclareCursor(
+            snippets::table
+                .select(snippets::id)
+                .filter(snippets::syntax.eq("rust"))
+                .order_by(snippets::id),
+        );
+        assert_eq!(
+            debug_query::<Pg, _>(&query).to_string(),
+            "DECLARE \"export_snippets\" NO SCROLL CURSOR FOR \
+             SELECT \"snippets\".\"id\" FROM \"snippets\" \
+             WHERE (\"snippets\".\"syntax\" = $1) ORDER BY \"snippets\".\"id\" \
+             -- binds: [\"rust\"]"
+        );
+
+        assert_eq!(
+            debug_query::<Pg, _>(&Fetch::<Integer>::new(100)).to_string(),
+            "FETCH FORWARD 100 FROM \"export_snippets\" -- binds: []"
+        );
+        assert_eq!(
+            debug_query::<Pg, _>(&CloseCursor).to_string(),
+            "CLOSE \"export_snippets\" -- binds: []"
+        );
+    }
+}
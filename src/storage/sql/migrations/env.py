@@ -5,6 +5,31 @@ from alembic import context
 from sqlalchemy import create_engine, pool
 
 
+def database_url():
+    """Return the connection string of the database to migrate.
+
+    The value passed via `alembic -x database_url=...` takes precedence over
+    the ROCKET_DATABASE_URL environment variable.
+    """
+
+    return context.get_x_argument(as_dictionary=True).get(
+        'database_url', os.environ.get('ROCKET_DATABASE_URL'))
+
+
+def timeouts():
+    """Return the values of lock_timeout and statement_timeout for migrations.
+
+    Both can be overridden via `alembic -x lock_timeout=... -x
+    statement_timeout=...`. A migration that can't acquire a lock in time
+    fails, instead of making the application queries wait in the lock queue
+    behind it.
+    """
+
+    x_arguments = context.get_x_argument(as_dictionary=True)
+    return (x_arguments.get('lock_timeout', '5s'),
+            x_arguments.get('statement_timeout', '1min'))
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -19,11 +44,15 @@ def run_migrations_offline():
     """
 
     context.configure(
-        url=os.environ['ROCKET_DATABASE_URL'],
+        url=database_url(),
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        transaction_per_migration=True,
     )
 
+    lock_timeout, statement_timeout = timeouts()
+    context.execute(f"SET lock_timeout = '{lock_timeout}'")
+    context.execute(f"SET statement_timeout = '{statement_timeout}'")
     with context.begin_transaction():
         context.run_migrations()
 
@@ -34,14 +63,25 @@ def run_migrations_online():
     In this scenario we need to create an Engine
     and associate a connection with the context.
 
+    Each migration is run in a separate transaction, so that a migration can
+    commit its work and switch to the autocommit mode (e.g. to build an index
+    concurrently, see online_ddl.py).
+
     """
 
+    lock_timeout, statement_timeout = timeouts()
     connectable = create_engine(
-        os.environ['ROCKET_DATABASE_URL'],
+        database_url(),
         poolclass=pool.NullPool,
+        # the timeouts are set on connection (rather than by SET statements),
+        # so that they stay the session defaults that RESET returns to
+        connect_args={
+            'options': f'-c lock_timeout={lock_timeout} '
+                       f'-c statement_timeout={statement_timeout}',
+        },
     )
     with connectable.connect() as connection:
-        context.configure(connection=connection)
+        context.configure(connection=connection, transaction_per_migration=True)
         with context.begin_transaction():
             context.run_migrations()
 
@@ -0,0 +1,167 @@
+"""Helpers for schema changes that must not block the live traffic.
+
+Every migration runs in its own transaction (see env.py), and every statement
+of a migration is subject to lock_timeout and statement_timeout, so that a
+migration fails fast instead of queueing the application queries behind its
+locks. A failed migration is rolled back and can simply be re-run.
+
+Building an index inside a transaction blocks writes to the table until the
+build completes, which takes minutes on large tables. Migrations must use
+create_index_concurrently() and drop_index_concurrently() instead of
+op.create_index() and op.drop_index(). These helpers commit the migration's
+transaction, run the statement in the autocommit mode (CREATE INDEX
+CONCURRENTLY can't be run in a transaction block), and then open a new
+transaction for the rest of the migration. Hence, index operations should go
+last in a migration, or into a migration of their own.
+
+Likewise, adding a constraint validates it against the whole table while
+holding a lock that blocks writes (ACCESS EXCLUSIVE for CHECK constraints), and
+SET NOT NULL does the same unless a validated CHECK constraint already proves
+that there are no NULLs. Migrations must use add_constraint() and
+set_not_null() instead, which commit the migration's transaction too.
+"""
+
+import logging
+import time
+
+from alembic import context, op
+from sqlalchemy import exc, text
+
+
+LOG = logging.getLogger(__name__)
+
+# Building an index concurrently does not block writes, so it's exempt from
+# statement_timeout. It still waits for the transactions that hold conflicting
+# locks, though, and those waits are limited by lock_timeout; hence the retries.
+RETRIES = 5
+RETRY_DELAY = 2.0
+
+
+def _index_state(name):
+    """Return None if the index does not exist, or whether it is valid."""
+
+    return op.get_bind().execute(
+        text("""
+            SELECT i.indisvalid
+            FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name AND pg_table_is_visible(i.indrelid)
+        """),
+        {'name': name},
+    ).scalar()
+
+
+def create_index_concurrently(name, table, columns, retries=RETRIES, **kwargs):
+    """Build an index without blocking writes to the table.
+
+    A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind, which is
+    still maintained on writes but is never used by queries. Such indexes are
+    dropped before each attempt. A valid index with the same name is kept as
+    is, so that a migration that failed half-way can be re-run. The keyword
+    arguments are passed to op.create_index().
+    """
+
+    if context.is_offline_mode():
+        op.create_index(name, table, columns, postgresql_concurrently=True, **kwargs)
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute('SET statement_timeout = 0')
+        try:
+            for attempt in range(1, retries + 1):
+                valid = _index_state(name)
+                if valid:
+                    LOG.info('Index %s already exists', name)
+                    return
+                if valid is not None:
+                    LOG.warning('Dropping invalid index %s', name)
+                    op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+                try:
+                    op.create_index(
+                        name, table, columns, postgresql_concurrently=True, **kwargs)
+                    return
+                except exc.OperationalError as e:
+                    if attempt == retries:
+                        raise
+                    LOG.warning(
+                        'Attempt %d to create index %s failed: %s', attempt, name, e.orig)
+                    time.sleep(RETRY_DELAY * attempt)
+        finally:
+            op.execute('RESET statement_timeout')
+
+
+def drop_index_concurrently(name, table, retries=RETRIES):
+    """Drop an index without blocking reads and writes of the table."""
+
+    if context.is_offline_mode():
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        return
+
+    with op.get_context().autocommit_block():
+        for attempt in range(1, retries + 1):
+            if _index_state(name) is None:
+                return
+
+            try:
+                op.drop_index(name, table_name=table, postgresql_concurrently=True)
+                return
+            except exc.OperationalError as e:
+                if attempt == retries:
+                    raise
+                LOG.warning(
+                    'Attempt %d to drop index %s failed: %s', attempt, name, e.orig)
+                time.sleep(RETRY_DELAY * attempt)
+
+
+def _constraint_exists(table, name):
+    return op.get_bind().execute(
+        text("""
+            SELECT 1
+            FROM pg_constraint
+            WHERE conrelid = CAST(:table AS regclass) AND conname = :name
+        """),
+        {'table': table, 'name': name},
+    ).scalar() is not None
+
+
+def add_constraint(table, name, definition):
+    """Add a constraint without blocking writes to the table for a full scan.
+
+    The constraint is added as NOT VALID, which only holds the lock for as long
+    as it takes to update the catalog, and is committed right away. Then it's
+    validated in a transaction of its own, which scans the table, but does not
+    block reads or writes, and hence is exempt from statement_timeout. A
+    constraint that already exists is only validated, so that a migration that
+    failed half-way can be re-run.
+    """
+
+    add = f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition} NOT VALID'
+    validate = f'ALTER TABLE {table} VALIDATE CONSTRAINT {name}'
+    if context.is_offline_mode():
+        op.execute(add)
+        op.execute(validate)
+        return
+
+    with op.get_context().autocommit_block():
+        if not _constraint_exists(table, name):
+            op.execute(add)
+
+        op.execute('SET statement_timeout = 0')
+        try:
+            op.execute(validate)
+        finally:
+            op.execute('RESET statement_timeout')
+
+
+def set_not_null(table, column):
+    """Make a column NOT NULL without blocking writes to the table for a full scan.
+
+    A validated CHECK constraint is added first (see add_constraint()), which
+    lets PostgreSQL 12+ skip the scan on SET NOT NULL. SET NOT NULL itself runs
+    in the migration's transaction, which is opened anew.
+    """
+
+    name = f'check_{column}_not_null'
+    add_constraint(table, name, f'CHECK ({column} IS NOT NULL)')
+    op.alter_column(table, column, nullable=False)
+    op.drop_constraint(name, table)
@@ -0,0 +1,139 @@
+"""Full-text search of snippets
+
+Revision ID: 2c7e9f4a6b18
+Revises: 8d2b6e4f0a13
+Create Date: 2026-10-17 17:45:09.201377
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from online_ddl import create_index_concurrently, drop_index_concurrently, set_not_null
+
+
+revision = '2c7e9f4a6b18'
+down_revision = '8d2b6e4f0a13'
+branch_labels = None
+depends_on = None
+
+# the number of snippets whose search vectors are computed per transaction
+BATCH_SIZE = 10000
+
+
+def upgrade():
+    op.add_column('snippets', sa.Column('search_vector', postgresql.TSVECTOR, nullable=True))
+
+    # Code is not a natural language, so the 'simple' configuration is used:
+    # words are lowercased, but neither stemmed nor filtered as stop words.
+    # Matches in titles rank higher than matches in contents. A tsvector can't
+    # be larger than 1MB, so only the beginning of a huge content is indexed.
+    # The queries (see storage::sql::search) must use the same configuration.
+    op.execute("""
+        CREATE FUNCTION snippet_search_vector(title text, content text)
+        RETURNS tsvector
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$
+            SELECT setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+                   setweight(to_tsvector('simple', left(coalesce(content, ''), 100000)), 'B')
+        $$
+    """)
+    op.execute("""
+        CREATE FUNCTION snippet_latest_content(snippet_id integer)
+        RETURNS text
+        LANGUAGE sql STABLE PARALLEL SAFE
+        AS $$
+            SELECT b.content
+            FROM changesets c JOIN blobs b ON b.hash = c.blob_hash
+            WHERE c.snippet_id = $1
+            ORDER BY c.version DESC
+            LIMIT 1
+        $$
+    """)
+
+    # The vector depends on the latest changeset, which lives in other
+    # tables, so it can't be a generated column and is maintained by
+    # triggers instead: one that reacts to changes of the title, and
+    # statement-level ones that recompute the vectors of all snippets whose
+    # changesets have been modified by a statement (e.g. by a bulk import)
+    # at once.
+    op.execute("""
+        CREATE FUNCTION snippets_set_search_vector() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            NEW.search_vector := snippet_search_vector(NEW.title, snippet_latest_content(NEW.id));
+            RETURN NEW;
+        END
+        $$
+    """)
+    op.execute("""
+        CREATE TRIGGER snippets_search_vector
+        BEFORE INSERT OR UPDATE OF title ON snippets
+        FOR EACH ROW EXECUTE FUNCTION snippets_set_search_vector()
+    """)
+    op.execute("""
+        CREATE FUNCTION changesets_refresh_search_vector() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            UPDATE snippets s
+            SET search_vector = snippet_search_vector(s.title, snippet_latest_content(s.id))
+            WHERE s.id IN (SELECT DISTINCT snippet_id FROM changed);
+            RETURN NULL;
+        END
+        $$
+    """)
+    for event, transition in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        op.execute(f"""
+            CREATE TRIGGER changesets_{event.lower()}_search_vector
+            AFTER {event} ON changesets
+            REFERENCING {transition} TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION changesets_refresh_search_vector()
+        """)
+
+    # Compute the vectors of the existing snippets in batches, each in its
+    # own transaction, so that the rows are not locked for the whole duration
+    # of the migration. New and modified snippets are taken care of by the
+    # triggers at this point. The batches are picked by the primary key, so
+    # that every batch starts where the previous one has ended.
+    with op.get_context().autocommit_block():
+        last_updated = 0
+        while last_updated is not None:
+            last_updated = op.get_bind().execute(sa.text("""
+                WITH batch AS (
+                    SELECT id, search_vector IS NULL AS outdated
+                    FROM snippets
+                    WHERE id > :last_updated
+                    ORDER BY id
+                    LIMIT :batch_size
+                    FOR UPDATE
+                ), updated AS (
+                    UPDATE snippets s
+                    SET search_vector = snippet_search_vector(s.title,
+                                                              snippet_latest_content(s.id))
+                    FROM batch
+                    WHERE s.id = batch.id AND batch.outdated
+                )
+                SELECT max(id) FROM batch
+            """), {'last_updated': last_updated, 'batch_size': BATCH_SIZE}).scalar()
+
+    set_not_null('snippets', 'search_vector')
+
+    create_index_concurrently('snippets_search_vector', 'snippets', ['search_vector'],
+                              postgresql_using='gin')
+
+
+def downgrade():
+    drop_index_concurrently('snippets_search_vector', 'snippets')
+
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        op.execute(f'DROP TRIGGER changesets_{event.lower()}_search_vector ON changesets')
+    op.execute('DROP FUNCTION changesets_refresh_search_vector()')
+    op.execute('DROP TRIGGER snippets_search_vector ON snippets')
+    op.execute('DROP FUNCTION snippets_set_search_vector()')
+    op.execute('DROP FUNCTION snippet_latest_content(integer)')
+    op.execute('DROP FUNCTION snippet_search_vector(text, text)')
+
+    op.drop_column('snippets', 'search_vector')
@@ -0,0 +1,49 @@
+"""Indexes for filtered listing of snippets
+
+Revision ID: 5f3c1a9d2e7b
+Revises: 1bf4e4e7b24f
+Create Date: 2026-10-17 09:12:41.318204
+
+"""
+
+from alembic import op
+
+from online_ddl import create_index_concurrently, drop_index_concurrently
+
+
+revision = '5f3c1a9d2e7b'
+down_revision = '1bf4e4e7b24f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # trigram indexes support both equality and substring (LIKE/ILIKE) search
+    # on titles. The extension is not dropped on downgrade, as other objects
+    # might depend on it
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+    # pagination orders snippets by (created_at, id), not by (created_at, slug)
+    create_index_concurrently('snippets_created_at_id', 'snippets',
+                              ['created_at', 'id'])
+
+    # filtering by syntax is combined with pagination, so the index matches
+    # both the filter and the sort order, and no sorting is needed
+    create_index_concurrently('snippets_syntax_created_at_id', 'snippets',
+                              ['syntax', 'created_at', 'id'])
+
+    # uq_snippet_tag (snippet_id, value) can't be used to look up snippets by
+    # tag, because the tag value is not its leading column
+    create_index_concurrently('tags_value_snippet_id', 'tags',
+                              ['value', 'snippet_id'])
+
+    create_index_concurrently('snippets_title_trgm', 'snippets', ['title'],
+                              postgresql_using='gin',
+                              postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    drop_index_concurrently('snippets_title_trgm', 'snippets')
+    drop_index_concurrently('tags_value_snippet_id', 'tags')
+    drop_index_concurrently('snippets_syntax_created_at_id', 'snippets')
+    drop_index_concurrently('snippets_created_at_id', 'snippets')
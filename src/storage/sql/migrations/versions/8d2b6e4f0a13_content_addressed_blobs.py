@@ -0,0 +1,116 @@
+"""Content-addressed storage of changeset contents
+
+Revision ID: 8d2b6e4f0a13
+Revises: 5f3c1a9d2e7b
+Create Date: 2026-10-17 14:03:27.540912
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_ddl import (
+    add_constraint,
+    create_index_concurrently,
+    drop_index_concurrently,
+    set_not_null,
+)
+
+
+revision = '8d2b6e4f0a13'
+down_revision = '5f3c1a9d2e7b'
+branch_labels = None
+depends_on = None
+
+# the number of changesets moved to the blobs table per transaction
+BATCH_SIZE = 10000
+
+
+def upgrade():
+    op.create_table(
+        'blobs',
+
+        # SHA-256 of the UTF-8 encoded content
+        sa.Column('hash', sa.LargeBinary, primary_key=True),
+        sa.Column('content', sa.Text, nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True),
+                  server_default=sa.func.now(), nullable=False),
+
+        # sanity check: do not allow empty blobs
+        sa.CheckConstraint('LENGTH(content) > 0', name='check_not_empty'),
+    )
+
+    # Values larger than ~2KB are compressed by PostgreSQL transparently (and
+    # moved out of the main table, if they are still too large). lz4 is both
+    # faster and compresses better than the default pglz, but is only
+    # available in PostgreSQL 14+ built with lz4 support.
+    op.execute("""
+        DO $$
+        BEGIN
+            ALTER TABLE blobs ALTER COLUMN content SET COMPRESSION lz4;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'lz4 compression is not available: %', SQLERRM;
+        END
+        $$
+    """)
+
+    op.add_column('changesets', sa.Column('blob_hash', sa.LargeBinary, nullable=True))
+    op.alter_column('changesets', 'content', nullable=True)
+
+    # Move the existing contents in batches, each in its own transaction, so
+    # that the rows of changesets are not locked for the whole duration of
+    # the migration. The batches are picked by the primary key, so that every
+    # batch starts where the previous one has ended, instead of scanning past
+    # the rows that have already been moved.
+    with op.get_context().autocommit_block():
+        last_moved = 0
+        while last_moved is not None:
+            last_moved = op.get_bind().execute(sa.text("""
+                WITH batch AS (
+                    SELECT id, blob_hash, content,
+                           sha256(convert_to(content, 'UTF8')) AS hash
+                    FROM changesets
+                    WHERE id > :last_moved
+                    ORDER BY id
+                    LIMIT :batch_size
+                    FOR UPDATE
+                ), inserted AS (
+                    INSERT INTO blobs (hash, content)
+                    SELECT DISTINCT ON (hash) hash, content FROM batch
+                    WHERE blob_hash IS NULL
+                    ON CONFLICT (hash) DO NOTHING
+                ), moved AS (
+                    UPDATE changesets c
+                    SET blob_hash = batch.hash
+                    FROM batch
+                    WHERE c.id = batch.id AND batch.blob_hash IS NULL
+                )
+                SELECT max(id) FROM batch
+            """), {'last_moved': last_moved, 'batch_size': BATCH_SIZE}).scalar()
+
+    add_constraint('changesets', 'fk_blob', 'FOREIGN KEY (blob_hash) REFERENCES blobs (hash)')
+    set_not_null('changesets', 'blob_hash')
+
+    # dropping a column only changes the catalog; the space is reclaimed as
+    # the rows get updated or the table is rewritten (e.g. by VACUUM FULL)
+    op.drop_column('changesets', 'content')
+
+    # used to find out whether a blob is still referenced by any changeset
+    create_index_concurrently('changesets_blob_hash', 'changesets', ['blob_hash'])
+
+
+def downgrade():
+    drop_index_concurrently('changesets_blob_hash', 'changesets')
+
+    op.add_column('changesets', sa.Column('content', sa.Text, nullable=True))
+    op.execute("""
+        UPDATE changesets c
+        SET content = b.content
+        FROM blobs b
+        WHERE b.hash = c.blob_hash
+    """)
+    op.alter_column('changesets', 'content', nullable=False)
+    op.create_check_constraint('check_not_empty', 'changesets', 'LENGTH(content) > 0')
+
+    op.drop_column('changesets', 'blob_hash')
+    op.drop_table('blobs')
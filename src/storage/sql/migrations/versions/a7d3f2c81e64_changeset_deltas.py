@@ -0,0 +1,102 @@
+"""Store older changesets as deltas
+
+Revision ID: a7d3f2c81e64
+Revises: e41b7c9a3d25
+Create Date: 2026-10-17 21:12:40.318274
+
+"""
+
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_ddl import add_constraint
+
+
+revision = 'a7d3f2c81e64'
+down_revision = 'e41b7c9a3d25'
+branch_labels = None
+depends_on = None
+
+CONSTRAINT = 'check_content_or_delta'
+# exactly one of the two is set
+CONDITION = '(blob_hash IS NULL) <> (delta IS NULL)'
+
+
+def _partitions():
+    return op.get_bind().execute(sa.text("""
+        SELECT c.relname
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'changesets'::regclass
+        ORDER BY c.relname
+    """)).scalars().all()
+
+
+def _apply(base, delta):
+    # see storage::sql::delta. The ranges are byte offsets into UTF-8
+    base = base.encode('utf-8')
+    content = bytearray()
+    for op_ in delta:
+        if isinstance(op_, list):
+            start, length = op_
+            content += base[start:start + length]
+        else:
+            content += op_.encode('utf-8')
+
+    return content.decode('utf-8')
+
+
+def upgrade():
+    # A changeset is either stored in full (blob_hash) or as a delta against
+    # the following changeset of the same snippet (see storage::sql::delta).
+    # Both statements only change the catalog. They are committed before the
+    # constraints are added below, so they must be safe to re-run.
+    op.execute('ALTER TABLE changesets ADD COLUMN IF NOT EXISTS delta jsonb')
+    op.alter_column('changesets', 'blob_hash', nullable=True)
+
+    # A CHECK constraint added to a partitioned table is validated on all of
+    # its partitions while holding a lock that blocks reads and writes.
+    # Instead, the constraint is added to each partition and validated in
+    # transactions of their own (see online_ddl.add_constraint()), which
+    # don't block reads or writes for the duration of the scans. Then it's
+    # added to the table itself, where it's merged with the already
+    # validated constraints of the partitions without another scan. New
+    # partitions copy the constraint (see changesets_create_partitions()).
+    for partition in _partitions():
+        add_constraint(partition, CONSTRAINT, f'CHECK ({CONDITION})')
+    op.execute(f'ALTER TABLE changesets ADD CONSTRAINT {CONSTRAINT} CHECK ({CONDITION})')
+
+
+def downgrade():
+    # The deltas can't be applied in SQL, so the contents of the changesets
+    # stored as deltas are rebuilt here, one snippet at a time
+    conn = op.get_bind()
+    snippet_ids = conn.execute(sa.text(
+        'SELECT DISTINCT snippet_id FROM changesets WHERE delta IS NOT NULL')).scalars().all()
+    for snippet_id in snippet_ids:
+        rows = conn.execute(sa.text("""
+            SELECT c.id, b.content, c.delta
+            FROM changesets c LEFT JOIN blobs b ON b.hash = c.blob_hash
+            WHERE c.snippet_id = :snippet_id
+            ORDER BY c.version DESC
+        """), {'snippet_id': snippet_id}).all()
+
+        newer = None
+        for id_, content, delta in rows:
+            if content is None:
+                content = _apply(newer, delta)
+                hash_ = hashlib.sha256(content.encode('utf-8')).digest()
+                conn.execute(sa.text("""
+                    INSERT INTO blobs (hash, content) VALUES (:hash, :content)
+                    ON CONFLICT (hash) DO NOTHING
+                """), {'hash': hash_, 'content': content})
+                conn.execute(sa.text("""
+                    UPDATE changesets SET blob_hash = :hash, delta = NULL
+                    WHERE snippet_id = :snippet_id AND id = :id
+                """), {'hash': hash_, 'snippet_id': snippet_id, 'id': id_})
+            newer = content
+
+    op.drop_constraint(CONSTRAINT, 'changesets')
+    op.alter_column('changesets', 'blob_hash', nullable=False)
+    op.drop_column('changesets', 'delta')
@@ -0,0 +1,261 @@
+"""Partition changesets by snippet id
+
+Revision ID: e41b7c9a3d25
+Revises: 2c7e9f4a6b18
+Create Date: 2026-10-17 19:26:51.804317
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'e41b7c9a3d25'
+down_revision = '2c7e9f4a6b18'
+branch_labels = None
+depends_on = None
+
+# the number of snippet ids per partition of changesets
+PARTITION_SIZE = 100000
+# the number of empty partitions that are kept ready for new snippets
+PARTITIONS_AHEAD = 2
+# the number of changesets copied to the partitioned table per transaction
+BATCH_SIZE = 10000
+
+COLUMNS = 'id, snippet_id, version, created_at, updated_at, blob_hash'
+
+
+def _create_search_vector_triggers():
+    # see 2c7e9f4a6b18. Statement-level triggers of a partitioned table see
+    # the rows modified in all of its partitions
+    for event, transition in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        op.execute(f"""
+            CREATE TRIGGER changesets_{event.lower()}_search_vector
+            AFTER {event} ON changesets
+            REFERENCING {transition} TABLE AS changed
+            FOR EACH STATEMENT EXECUTE FUNCTION changesets_refresh_search_vector()
+        """)
+
+
+def upgrade():
+    # Changesets are partitioned by ranges of snippet ids rather than by
+    # created_at: all queries look changesets up by snippet id, so they only
+    # ever touch a single partition, and the changesets of a snippet never
+    # span partitions. Snippet ids are allocated sequentially, so the
+    # partitions are still ordered by the time the snippets were created
+    # (imported snippets keep their original created_at, but get new ids),
+    # and the old ones are rarely modified.
+    #
+    # Primary and unique keys of a partitioned table must include the
+    # partition key. Index names are unique per schema, so the ones of the
+    # new table get their final names once the old table is gone.
+    #
+    # Everything up to the swap of the tables is committed in steps, so the
+    # statements are idempotent, and a failed migration can be re-run.
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS changesets_partitioned (
+            id integer NOT NULL DEFAULT nextval('changesets_id_seq'),
+            snippet_id integer NOT NULL,
+            version integer NOT NULL DEFAULT 0,
+            created_at timestamp with time zone NOT NULL DEFAULT now(),
+            updated_at timestamp with time zone NOT NULL DEFAULT now(),
+            blob_hash bytea NOT NULL,
+
+            CONSTRAINT changesets_partitioned_pkey PRIMARY KEY (snippet_id, id),
+            CONSTRAINT uq_partitioned_version UNIQUE (snippet_id, version),
+            CONSTRAINT fk_snippet FOREIGN KEY (snippet_id)
+                REFERENCES snippets (id) ON DELETE CASCADE,
+            CONSTRAINT fk_blob FOREIGN KEY (blob_hash) REFERENCES blobs (hash),
+            CONSTRAINT check_non_negative_version CHECK (version >= 0)
+        ) PARTITION BY RANGE (snippet_id)
+    """)
+    op.execute('CREATE INDEX IF NOT EXISTS changesets_partitioned_blob_hash '
+               'ON changesets_partitioned (blob_hash)')
+
+    # partitions for all existing snippets and the ones that are about to be
+    # created. Nobody uses the new table yet, so creating them is cheap
+    last_id = op.get_bind().execute(
+        sa.text('SELECT coalesce(max(id), 0) FROM snippets')).scalar()
+    for lower in range(0, (last_id // PARTITION_SIZE + 1 + PARTITIONS_AHEAD) * PARTITION_SIZE,
+                       PARTITION_SIZE):
+        op.execute(f"""
+            CREATE TABLE IF NOT EXISTS changesets_p{lower // PARTITION_SIZE:05d}
+            PARTITION OF changesets_partitioned
+            FOR VALUES FROM ({lower}) TO ({lower + PARTITION_SIZE})
+        """)
+
+    # Keep the copy up to date while the existing rows are being copied.
+    # Updates are applied as delete + insert, as they could have happened to
+    # rows that have not been copied yet.
+    op.execute(f"""
+        CREATE OR REPLACE FUNCTION changesets_mirror() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM changesets_partitioned
+                WHERE snippet_id = OLD.snippet_id AND id = OLD.id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO changesets_partitioned ({COLUMNS})
+                VALUES (NEW.id, NEW.snippet_id, NEW.version,
+                        NEW.created_at, NEW.updated_at, NEW.blob_hash)
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END
+        $$
+    """)
+    op.execute("""
+        CREATE OR REPLACE TRIGGER changesets_mirror
+        AFTER INSERT OR UPDATE OR DELETE ON changesets
+        FOR EACH ROW EXECUTE FUNCTION changesets_mirror()
+    """)
+
+    # Copy the existing rows in batches, each in its own transaction, so that
+    # they are not locked for the whole duration of the migration. The rows
+    # of a batch are locked until it's committed, so that a concurrent delete
+    # either waits for the copy (and then deletes it too), or is seen by the
+    # copy (which then skips the row).
+    with op.get_context().autocommit_block():
+        last_copied = 0
+        while last_copied is not None:
+            last_copied = op.get_bind().execute(sa.text(f"""
+                WITH batch AS (
+                    SELECT {COLUMNS}
+                    FROM changesets
+                    WHERE id > :last_copied
+                    ORDER BY id
+                    LIMIT :batch_size
+                    FOR UPDATE
+                ), copied AS (
+                    INSERT INTO changesets_partitioned ({COLUMNS})
+                    SELECT {COLUMNS} FROM batch
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT max(id) FROM batch
+            """), {'last_copied': last_copied, 'batch_size': BATCH_SIZE}).scalar()
+
+    # The tables are swapped in a single transaction. The exclusive lock is
+    # only held for as long as it takes to update the catalog and unlink the
+    # files of the old table.
+    op.execute('LOCK TABLE changesets IN ACCESS EXCLUSIVE MODE')
+    # the sequence is owned by the id column of the old table, and would be
+    # dropped with it, but the new table still uses it
+    op.execute('ALTER SEQUENCE changesets_id_seq OWNED BY NONE')
+    op.execute('DROP TABLE changesets')
+    op.execute('DROP FUNCTION changesets_mirror()')
+    op.execute('ALTER TABLE changesets_partitioned RENAME TO changesets')
+    op.execute('ALTER SEQUENCE changesets_id_seq OWNED BY changesets.id')
+    op.execute('ALTER TABLE changesets RENAME CONSTRAINT changesets_partitioned_pkey '
+               'TO changesets_pkey')
+    op.execute('ALTER TABLE changesets RENAME CONSTRAINT uq_partitioned_version TO uq_version')
+    op.execute('ALTER INDEX changesets_partitioned_blob_hash RENAME TO changesets_blob_hash')
+    _create_search_vector_triggers()
+
+    # Creates the partitions for the snippets that are about to be created;
+    # called periodically by the application (see storage::sql). There is no
+    # default partition, because it would prevent old partitions from being
+    # detached concurrently, so a changeset of a snippet whose id is not
+    # covered by any partition can't be inserted. Hence, partitions are
+    # created well in advance.
+    #
+    # A partition is created as a standalone table and then attached, which,
+    # unlike CREATE TABLE ... PARTITION OF, only takes a SHARE UPDATE
+    # EXCLUSIVE lock on changesets, so it does not block the queries to the
+    # other partitions. The CHECK constraint spares the scan of the new table
+    # on ATTACH. However, the partition inherits the foreign keys of
+    # changesets, and adding them takes SHARE ROW EXCLUSIVE locks on snippets
+    # and blobs, which block the writes to those tables until the transaction
+    # ends. The new table is empty, so that's brief, but the function must be
+    # called in a transaction of its own and with a lock_timeout, so that it
+    # does not queue behind a long transaction and block the writes meanwhile
+    # (see storage::sql).
+    #
+    # Old partitions can be archived without blocking the reads, e.g.:
+    #
+    #   ALTER TABLE changesets DETACH PARTITION changesets_p00000 CONCURRENTLY;
+    #   pg_dump --table changesets_p00000 ...
+    #   SET lock_timeout = '1s';
+    #   DROP TABLE changesets_p00000;
+    #
+    # Dropping the table drops its foreign keys too, which, like the ATTACH,
+    # briefly blocks the writes to snippets and blobs.
+    op.execute(f"""
+        CREATE FUNCTION changesets_create_partitions() RETURNS void
+        LANGUAGE plpgsql
+        AS $$
+        DECLARE
+            partition_size CONSTANT integer := {PARTITION_SIZE};
+            partitions_ahead CONSTANT integer := {PARTITIONS_AHEAD};
+            upper_bound integer;
+            target integer;
+            partition text;
+        BEGIN
+            -- every instance of the application calls the function
+            PERFORM pg_advisory_xact_lock(hashtext('changesets_create_partitions'));
+
+            SELECT coalesce(max(substring(pg_get_expr(c.relpartbound, c.oid)
+                                          FROM 'TO \\((\\d+)\\)')::integer), 0)
+            INTO upper_bound
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'changesets'::regclass;
+
+            SELECT (coalesce(max(id), 0) / partition_size + 1 + partitions_ahead) * partition_size
+            INTO target
+            FROM snippets;
+
+            WHILE upper_bound < target LOOP
+                partition := format('changesets_p%s',
+                                    lpad((upper_bound / partition_size)::text, 5, '0'));
+                EXECUTE format('CREATE TABLE %I (LIKE changesets INCLUDING DEFAULTS '
+                               'INCLUDING CONSTRAINTS)', partition);
+                EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I '
+                               'CHECK (snippet_id >= %s AND snippet_id < %s)',
+                               partition, partition || '_bound',
+                               upper_bound, upper_bound + partition_size);
+                EXECUTE format('ALTER TABLE changesets ATTACH PARTITION %I '
+                               'FOR VALUES FROM (%s) TO (%s)',
+                               partition, upper_bound, upper_bound + partition_size);
+                EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I',
+                               partition, partition || '_bound');
+                upper_bound := upper_bound + partition_size;
+            END LOOP;
+        END
+        $$
+    """)
+    op.execute('SELECT changesets_create_partitions()')
+
+
+def downgrade():
+    op.execute('DROP FUNCTION changesets_create_partitions()')
+
+    # the downgrade copies the rows in a single transaction and blocks the
+    # writes for its whole duration
+    op.execute('SET LOCAL statement_timeout = 0')
+    op.execute('LOCK TABLE changesets IN SHARE MODE')
+    op.execute("""
+        CREATE TABLE changesets_unpartitioned (
+            id integer NOT NULL DEFAULT nextval('changesets_id_seq'),
+            snippet_id integer NOT NULL,
+            version integer NOT NULL DEFAULT 0,
+            created_at timestamp with time zone NOT NULL DEFAULT now(),
+            updated_at timestamp with time zone NOT NULL DEFAULT now(),
+            blob_hash bytea NOT NULL
+        )
+    """)
+    op.execute(f'INSERT INTO changesets_unpartitioned ({COLUMNS}) '
+               f'SELECT {COLUMNS} FROM changesets')
+
+    op.execute('ALTER SEQUENCE changesets_id_seq OWNED BY NONE')
+    op.execute('DROP TABLE changesets')
+    op.execute('ALTER TABLE changesets_unpartitioned RENAME TO changesets')
+    op.execute('ALTER SEQUENCE changesets_id_seq OWNED BY changesets.id')
+    op.create_primary_key('changesets_pkey', 'changesets', ['id'])
+    op.create_unique_constraint('uq_version', 'changesets', ['snippet_id', 'version'])
+    op.create_foreign_key('fk_snippet', 'changesets', 'snippets', ['snippet_id'], ['id'],
+                          ondelete='CASCADE')
+    op.create_foreign_key('fk_blob', 'changesets', 'blobs', ['blob_hash'], ['hash'])
+    op.create_check_constraint('check_non_negative_version', 'changesets', 'version >= 0')
+    op.create_index('changesets_blob_hash', 'changesets', ['blob_hash'])
+    _create_search_vector_triggers()
@@ -1,61 +1,970 @@
+#[cfg(test)]
+mod bench;
+mod delta;
+mod estimate;
+mod export;
 mod models;
+mod replicas;
 mod schema;
+mod search;
 
+use std::collections::{HashMap, HashSet};
 use std::convert::From;
-
-use diesel::pg::upsert;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::Arc;
+use std::time::{Duration, Instant};
+
+use chrono::{DateTime, Utc};
+use deadpool::managed::{Hook, HookError, Metrics};
+use deadpool::Runtime;
+use diesel::dsl::{sql, SqlTypeOf};
+use diesel::pg::Pg;
 use diesel::prelude::*;
 use diesel::result::{DatabaseErrorKind, Error::DatabaseError, Error::NotFound};
-use diesel_async::pooled_connection::deadpool::{BuildError, Pool, PoolError};
-use diesel_async::pooled_connection::AsyncDieselConnectionManager;
-use diesel_async::{AsyncConnection, AsyncPgConnection, RunQueryDsl};
-
-use super::{errors::StorageError, Direction, ListSnippetsQuery, Snippet, Storage};
-use schema::{changesets, snippets, tags};
+use diesel::sql_types::{Array, Bool, Float, Json, Nullable, Text};
+use diesel_async::pooled_connection::deadpool::{BuildError, Object, Pool, PoolError};
+use diesel_async::pooled_connection::{AsyncDieselConnectionManager, ManagerConfig};
+use diesel_async::{
+    AnsiTransactionManager, AsyncConnection, AsyncPgConnection, RunQueryDsl, SimpleAsyncConnection,
+    TransactionManager,
+};
+use futures_util::future::{self, BoxFuture, FutureExt};
+use futures_util::stream::{self, StreamExt, TryStreamExt};
+use rocket::tokio;
+use sha2::{Digest, Sha256};
+
+use super::{
+    errors::StorageError, Changeset, Checkpoint, Direction, ListSnippetsQuery, Marker, Page,
+    Position, Snippet, SnippetChanges, SnippetStream, Storage, View, PREVIEW_LENGTH,
+};
+use estimate::ExplainJson;
+use replicas::Replicas;
+use schema::{blobs, changesets, snippets, tags};
+use search::{OptionalSearchRank, SearchMatches, SearchRank};
+
+pub use replicas::ReplicaOptions;
 
 // deadpool's default pool size is # of CPUs * 4, which might be too low. Instead,
 // let's default to PostgreSQL's max_connections value (100) and reserve a small
 // buffer for "admin" connections (like periodic database backups or local sessions).
 const MAX_POOL_SIZE: usize = 96;
+// How often the connections that exceeded their idle time or lifetime are
+// closed, if those limits are set.
+const REAP_INTERVAL: Duration = Duration::from_secs(30);
+// How often the partitions of the changesets table are created ahead of the
+// snippets they are for (see the migration that partitioned the table).
+const PARTITION_MAINTENANCE_INTERVAL: Duration = Duration::from_secs(3600);
+// How long the creation of partitions waits for the locks it needs before
+// giving up (the next attempt will create the partitions that are missing).
+const PARTITION_LOCK_TIMEOUT: Duration = Duration::from_secs(1);
+// The maximum number of rows written by a single multi-row INSERT statement.
+// PostgreSQL allows at most 65535 bind parameters per statement, and each row
+// takes up to 5 of them.
+const INSERT_BATCH_SIZE: usize = 10000;
+// The maximum total size of contents written by a single INSERT into blobs.
+const INSERT_BATCH_BYTES: usize = 16 * 1024 * 1024;
+// Every KEYFRAME_INTERVAL-th changeset of a snippet is stored in full rather
+// than as a delta, so that rebuilding any version takes at most this many
+// changesets (see the delta module).
+const KEYFRAME_INTERVAL: i64 = 16;
+// The number of snippets fetched from the export cursor at once. Bounds the
+// memory taken by an export, as each snippet only has its latest changeset.
+const EXPORT_BATCH_SIZE: usize = 100;
+
+// Changesets and tags of a snippet are aggregated by correlated subqueries, so
+// that a snippet (or a page of snippets) can be fetched in a single round-trip.
+// Changesets are returned as a JSON array of objects (see models::ChangesetRow)
+// and tags as an array of values in the order they have been added. Older
+// changesets are stored as deltas, which are applied by the application.
+const CHANGESETS_JSON: &str = "COALESCE((\
+    SELECT json_agg(json_build_object(\
+        'version', c.version, \
+        'content', b.content, \
+        'delta', c.delta, \
+        'created_at', c.created_at, \
+        'updated_at', c.updated_at\
+    ) ORDER BY c.version) \
+    FROM changesets c LEFT JOIN blobs b ON b.hash = c.blob_hash \
+    WHERE c.snippet_id = snippets.id\
+), '[]')";
+// Blobs are shared between changesets, so they can only be deleted when they
+// are not referenced anymore.
+const BLOB_IS_UNREFERENCED: &str =
+    "NOT EXISTS (SELECT 1 FROM changesets c WHERE c.blob_hash = blobs.hash)";
+/// Like CHANGESETS_JSON, but only the latest changeset is selected. The
+/// latest changeset is always stored in full, and `content` is the
+/// expression its content is selected by (the blob is aliased as `b`).
+fn latest_changeset_json(content: &str) -> String {
+    format!(
+        "COALESCE((\
+            SELECT json_build_array(json_build_object(\
+                'version', c.version, \
+                'content', {}, \
+                'created_at', c.created_at, \
+                'updated_at', c.updated_at\
+            )) \
+            FROM changesets c JOIN blobs b ON b.hash = c.blob_hash \
+            WHERE c.snippet_id = snippets.id \
+            ORDER BY c.version DESC \
+            LIMIT 1\
+        ), '[]')",
+        content
+    )
+}
+/// Like latest_changeset_json, but the content is cut to PREVIEW_LENGTH + 1
+/// characters. substr() of a TOASTed value only fetches (and decompresses)
+/// the chunks the slice is in, so the cost does not depend on the size of
+/// the content.
+fn latest_changeset_preview_json() -> String {
+    latest_changeset_json(&format!("substr(b.content, 1, {})", PREVIEW_LENGTH + 1))
+}
+const TAGS_ARRAY: &str = "ARRAY(\
+    SELECT t.value FROM tags t WHERE t.snippet_id = snippets.id ORDER BY t.id\
+)";
+
+/// Returns true if a read that has failed on a replica should be retried on
+/// the primary: either the snippet has not been replicated yet, or the
+/// replica has become unavailable. Other errors would most likely recur on
+/// the primary, so retrying them would only double the load on it.
+fn retry_on_primary(error: &StorageError) -> bool {
+    match error {
+        StorageError::NotFound { .. } | StorageError::Unavailable(_) => true,
+        StorageError::InternalError(e) => {
+            e.downcast_ref::<PoolError>().is_some()
+                || matches!(
+                    e.downcast_ref::<diesel::result::Error>(),
+                    Some(DatabaseError(DatabaseErrorKind::ClosedConnection, _))
+                )
+        }
+        _ => false,
+    }
+}
+
+/// Returns the key of the given content in the blobs table.
+fn blob_hash(content: &str) -> Vec<u8> {
+    Sha256::digest(content.as_bytes()).to_vec()
+}
+
+/// Returns the delta that rebuilds the content of a changeset from the
+/// content of the following one, unless the changeset is a keyframe (its
+/// `position` among the changesets of the snippet, counting from 1, is a
+/// multiple of KEYFRAME_INTERVAL), or the delta would take more space than
+/// the content itself. The changeset is stored in full otherwise.
+fn compact_delta(position: i64, content: &str, newer: &str) -> Option<serde_json::Value> {
+    if position % KEYFRAME_INTERVAL == 0 {
+        return None;
+    }
+
+    let delta = serde_json::to_value(delta::diff(newer, content)?).ok()?;
+    if delta.to_string().len() < content.len() {
+        Some(delta)
+    } else {
+        None
+    }
+}
+
+/// The columns of snippets that are loaded into models::SnippetRow. The search
+/// vector is maintained by the database and is never loaded.
+type SnippetColumns = (
+    snippets::id,
+    snippets::slug,
+    snippets::title,
+    snippets::syntax,
+    snippets::created_at,
+    snippets::updated_at,
+);
+const SNIPPET_COLUMNS: SnippetColumns = (
+    snippets::id,
+    snippets::slug,
+    snippets::title,
+    snippets::syntax,
+    snippets::created_at,
+    snippets::updated_at,
+);
+
+type SnippetWithRelationsSqlType = (
+    SqlTypeOf<SnippetColumns>,
+    Json,
+    Array<Text>,
+    Nullable<Float>,
+);
+
+/// Returns a query that selects snippets along with their changesets and tags.
+/// Only the latest changeset is selected, and its content is truncated, if
+/// the summary view is requested. The relevance of the snippets to the search
+/// query is selected too, if there is one, so that the positions of the
+/// snippets can be returned to the caller.
+fn select_snippets<'a>(
+    view: View,
+    search: Option<String>,
+) -> snippets::BoxedQuery<'a, Pg, SnippetWithRelationsSqlType> {
+    let changesets = match view {
+        View::Full => sql::<Json>(CHANGESETS_JSON),
+        View::Summary => sql::<Json>(&latest_changeset_preview_json()),
+    };
+
+    snippets::table
+        .select((
+            SNIPPET_COLUMNS,
+            changesets,
+            sql::<Array<Text>>(TAGS_ARRAY),
+            OptionalSearchRank(search),
+        ))
+        .into_boxed()
+}
+
+/// Applies the filters of the given criteria (but not the pagination) to the
+/// query.
+fn filter_snippets<'a, ST>(
+    mut query: snippets::BoxedQuery<'a, Pg, ST>,
+    criteria: &ListSnippetsQuery,
+) -> snippets::BoxedQuery<'a, Pg, ST> {
+    if let Some(title) = criteria.title.clone() {
+        query = query.filter(snippets::title.eq(title));
+    }
+    if let Some(syntax) = criteria.syntax.clone() {
+        query = query.filter(snippets::syntax.eq(syntax));
+    }
+    if let Some(tags) = criteria.tags.clone() {
+        let snippet_ids = tags::table
+            .select(tags::snippet_id)
+            .filter(tags::value.eq_any(tags));
+
+        query = query.filter(snippets::id.eq_any(snippet_ids));
+    }
+    if let Some(search) = criteria.search.clone() {
+        query = query.filter(SearchMatches(search));
+    }
+
+    query
+}
+
+/// Returns a query that selects a page of snippets satisfying the given
+/// criteria. `marker` is the position of the marker snippet, if pagination
+/// criteria have one.
+fn list_snippets<'a>(
+    criteria: ListSnippetsQuery,
+    marker: Option<Position>,
+) -> snippets::BoxedQuery<'a, Pg, SnippetWithRelationsSqlType> {
+    let mut query = filter_snippets(
+        select_snippets(criteria.view, criteria.search.clone()),
+        &criteria,
+    );
+
+    // Search results are ordered by relevance first, and then by the same
+    // keys as regular pages. The marker's rank is computed by the very same
+    // expression, so comparing the ranks for equality is exact.
+    let rank = criteria.search.map(SearchRank);
+
+    // Pagination. marker_internal_id is used to resolve the ties because the value
+    // of created_at is not guaranteed to be unique. In practice, we use
+    // microsecond precision for datetime fields, so duplicates are only
+    // expected in tests and, potentially, in snippets imported from
+    // Mongo that have second precision
+    if let Some(marker) = marker {
+        let Position {
+            internal_id: marker_internal_id,
+            created_at: marker_created_at,
+            rank: marker_rank,
+        } = marker;
+
+        query = match criteria.pagination.direction {
+            Direction::Desc => {
+                let older = snippets::created_at
+                    .lt(marker_created_at)
+                    .or(snippets::created_at
+                        .eq(marker_created_at)
+                        .and(snippets::id.lt(marker_internal_id)));
+                match (rank.clone(), marker_rank) {
+                    (Some(rank), Some(marker_rank)) => query.filter(
+                        rank.clone()
+                            .lt(marker_rank)
+                            .or(rank.eq(marker_rank).and(older)),
+                    ),
+                    _ => query.filter(older),
+                }
+            }
+            Direction::Asc => {
+                let newer = snippets::created_at
+                    .gt(marker_created_at)
+                    .or(snippets::created_at
+                        .eq(marker_created_at)
+                        .and(snippets::id.gt(marker_internal_id)));
+                match (rank.clone(), marker_rank) {
+                    (Some(rank), Some(marker_rank)) => query.filter(
+                        rank.clone()
+                            .gt(marker_rank)
+                            .or(rank.eq(marker_rank).and(newer)),
+                    ),
+                    _ => query.filter(newer),
+                }
+            }
+        };
+    }
+
+    query = match criteria.pagination.direction {
+        Direction::Desc => {
+            if let Some(rank) = rank {
+                query = query.then_order_by(rank.desc());
+            }
+            query
+                .then_order_by(snippets::created_at.desc())
+                .then_order_by(snippets::id.desc())
+        }
+        Direction::Asc => {
+            if let Some(rank) = rank {
+                query = query.then_order_by(rank.asc());
+            }
+            query
+                .then_order_by(snippets::created_at.asc())
+                .then_order_by(snippets::id.asc())
+        }
+    };
+
+    query.limit(criteria.pagination.limit as i64)
+}
+
+/// Returns a query that selects all snippets created after the given
+/// position from older to newer ones, along with their latest changesets and
+/// tags. The order matches the one of list_snippets (in the ascending
+/// direction), so the same index is used.
+fn export_snippets<'a>(
+    after: Option<Position>,
+) -> snippets::BoxedQuery<'a, Pg, SnippetWithRelationsSqlType> {
+    let mut query = snippets::table
+        .select((
+            SNIPPET_COLUMNS,
+            sql::<Json>(&latest_changeset_json("b.content")),
+            sql::<Array<Text>>(TAGS_ARRAY),
+            OptionalSearchRank(None),
+        ))
+        .into_boxed();
+    if let Some(after) = after {
+        query = query.filter(
+            snippets::created_at
+                .gt(after.created_at)
+                .or(snippets::created_at
+                    .eq(after.created_at)
+                    .and(snippets::id.gt(after.internal_id))),
+        );
+    }
+
+    query
+        .order_by(snippets::created_at.asc())
+        .then_order_by(snippets::id.asc())
+}
+
+/// Fetches the next batch of snippets from the export cursor declared on the
+/// given connection. The transaction the cursor has been declared in is
+/// committed once the cursor is exhausted. If the stream of batches is
+/// dropped before that, the connection is discarded by the pool, as it's
+/// still in the transaction.
+async fn fetch_exported(
+    mut conn: Object<AsyncPgConnection>,
+) -> Result<Option<(Vec<Snippet>, Object<AsyncPgConnection>)>, StorageError> {
+    let rows = export::Fetch::<SnippetWithRelationsSqlType>::new(EXPORT_BATCH_SIZE)
+        .load::<models::SnippetWithRelations>(&mut *conn)
+        .await?;
+    if rows.is_empty() {
+        export::CloseCursor.execute(&mut *conn).await?;
+        AnsiTransactionManager::commit_transaction(&mut *conn).await?;
+        return Ok(None);
+    }
+
+    let snippets = rows
+        .into_iter()
+        .map(Snippet::try_from)
+        .collect::<Result<Vec<_>, _>>()?;
+    Ok(Some((snippets, conn)))
+}
+
+/// Returns the stream of snippets fetched from the export cursor declared on
+/// the given connection.
+fn exported_snippets(conn: Object<AsyncPgConnection>) -> SnippetStream {
+    stream::try_unfold(conn, fetch_exported)
+        .map_ok(|snippets| stream::iter(snippets.into_iter().map(Ok)))
+        .try_flatten()
+        .boxed()
+}
+
+/// Settings of the database connection pool. Limits set to None are not
+/// enforced.
+#[derive(Clone, Debug)]
+pub struct PoolOptions {
+    /// The maximum number of connections.
+    pub max_size: usize,
+    /// How long a request can wait for a connection to become available
+    /// before it fails with StorageError::Unavailable.
+    pub wait_timeout: Option<Duration>,
+    /// How long it can take to establish a new connection.
+    pub connect_timeout: Option<Duration>,
+    /// Connections older than this are closed (e.g. so that the connections
+    /// are rebalanced after a failover of the database).
+    pub max_lifetime: Option<Duration>,
+    /// Connections that have not been used for this long are closed.
+    pub max_idle: Option<Duration>,
+    /// Queries that run longer than this are cancelled by the database.
+    pub statement_timeout: Option<Duration>,
+    /// The number of idle connections opened in advance, so that the first
+    /// requests do not wait for them. Connections closed because of the
+    /// idle time or the lifetime limits, or checked out by the requests,
+    /// are replaced in the background (see REAP_INTERVAL).
+    pub min_idle: usize,
+}
+
+impl Default for PoolOptions {
+    fn default() -> Self {
+        Self {
+            max_size: MAX_POOL_SIZE,
+            wait_timeout: None,
+            connect_timeout: None,
+            max_lifetime: None,
+            max_idle: None,
+            statement_timeout: None,
+            min_idle: 0,
+        }
+    }
+}
+
+impl PoolOptions {
+    /// Returns true if the connection has exceeded its idle time or lifetime.
+    fn is_expired(&self, metrics: &Metrics) -> bool {
+        self.max_lifetime.is_some_and(|limit| metrics.age() > limit)
+            || self
+                .max_idle
+                .is_some_and(|limit| metrics.last_used() > limit)
+    }
+}
+
+/// Establish a new connection and apply the session settings to it.
+fn establish(
+    url: &str,
+    statement_timeout: Option<Duration>,
+) -> BoxFuture<'_, ConnectionResult<AsyncPgConnection>> {
+    async move {
+        let mut conn = AsyncPgConnection::establish(url).await?;
+        if let Some(timeout) = statement_timeout {
+            conn.batch_execute(&format!("SET statement_timeout = {}", timeout.as_millis()))
+                .await
+                .map_err(diesel::ConnectionError::CouldntSetupConfiguration)?;
+        }
+
+        Ok(conn)
+    }
+    .boxed()
+}
+
+/// Build a connection pool configured using the given options.
+///
+/// Must be called from within a Tokio runtime if either the maximum idle time
+/// or the lifetime of connections is limited.
+fn build_pool(
+    database_url: &str,
+    options: &PoolOptions,
+) -> Result<Pool<AsyncPgConnection>, StorageError> {
+    let mut config = ManagerConfig::default();
+    let statement_timeout = options.statement_timeout;
+    config.custom_setup = Box::new(move |url| establish(url, statement_timeout));
+    let manager = AsyncDieselConnectionManager::new_with_config(database_url, config);
+
+    // Expired connections are not handed out, even if they have not been
+    // closed by the reaper yet
+    let expiry = options.clone();
+    let pool = Pool::builder(manager)
+        .max_size(options.max_size)
+        .wait_timeout(options.wait_timeout)
+        .create_timeout(options.connect_timeout)
+        .runtime(Runtime::Tokio1)
+        .pre_recycle(Hook::sync_fn(move |_, metrics| {
+            if expiry.is_expired(metrics) {
+                Err(HookError::Message("Connection has expired".into()))
+            } else {
+                Ok(())
+            }
+        }))
+        .build()?;
+
+    if options.max_lifetime.is_some() || options.max_idle.is_some() || options.min_idle > 0 {
+        let pool = pool.clone();
+        let options = options.clone();
+        tokio::spawn(async move {
+            let mut ticker = tokio::time::interval(REAP_INTERVAL);
+            while !pool.is_closed() {
+                ticker.tick().await;
+                pool.retain(|_, metrics| !options.is_expired(&metrics));
+                if let Err(e) = fill_pool(&pool, options.min_idle).await {
+                    warn!("Failed to open idle database connections: {}", e);
+                }
+            }
+        });
+    }
+
+    Ok(pool)
+}
+
+/// Open new connections until at least `min_idle` of them are idle in the
+/// pool, or the pool is full. deadpool only opens a connection when there
+/// are no idle ones, so the idle connections are checked out as well while
+/// the new ones are opened, and all of them are returned to the pool at
+/// once. Hence, this is only done at startup and by the reaper, rather than
+/// on every request.
+async fn fill_pool(pool: &Pool<AsyncPgConnection>, min_idle: usize) -> Result<(), StorageError> {
+    let status = pool.status();
+    let missing = min_idle
+        .saturating_sub(status.available)
+        .min(status.max_size.saturating_sub(status.size));
+    if missing > 0 {
+        future::try_join_all((0..status.available + missing).map(|_| pool.get())).await?;
+    }
+
+    Ok(())
+}
+
+/// Creates the partitions of the changesets table for the snippets that are
+/// about to be created (see the migration that partitioned the table).
+///
+/// Attaching a partition briefly locks snippets and blobs against writes, so
+/// the function is run in a transaction of its own with a lock timeout: it
+/// gives up rather than queue behind a long transaction and block the writes
+/// that would queue behind it in turn.
+async fn create_partitions(conn: &mut AsyncPgConnection) -> Result<(), StorageError> {
+    conn.transaction::<_, StorageError, _>(async |conn| {
+        conn.batch_execute(&format!(
+            "SET LOCAL lock_timeout = {}; SELECT changesets_create_partitions()",
+            PARTITION_LOCK_TIMEOUT.as_millis()
+        ))
+        .await?;
+
+        Ok(())
+    })
+    .await
+}
+
+/// Returns true if a changeset could not be inserted, because there is no
+/// partition for the id of its snippet yet.
+fn missing_partition(error: &StorageError) -> bool {
+    match error {
+        StorageError::InternalError(e) => matches!(
+            e.downcast_ref::<diesel::result::Error>(),
+            Some(DatabaseError(DatabaseErrorKind::CheckViolation, info))
+                if info.message().starts_with("no partition of relation")
+        ),
+        _ => false,
+    }
+}
+
+/// Periodically create the partitions of the changesets table for the
+/// snippets that are about to be created. Every changeset must belong to a
+/// partition, so the partitions are created well in advance, and a failure
+/// is not fatal until the spare partitions are used up. Bulk imports can use
+/// them up faster than that, so they create the partitions they need
+/// themselves (see SqlStorage::import).
+fn spawn_partition_maintenance(pool: Pool<AsyncPgConnection>) {
+    tokio::spawn(async move {
+        let mut ticker = tokio::time::interval(PARTITION_MAINTENANCE_INTERVAL);
+        while !pool.is_closed() {
+            ticker.tick().await;
+            let result = match pool.get().await {
+                Ok(mut conn) => create_partitions(&mut conn).await,
+                Err(e) => Err(StorageError::from(e)),
+            };
+            if let Err(e) = result {
+                warn!("Failed to create partitions of changesets: {}", e);
+            }
+        }
+    });
+}
 
 /// A Storage implementation which persists snippets' data in a SQL database.
+///
+/// Writes always go to the primary database. Reads (`get`, `get_latest`,
+/// `get_version`, `list`, `estimate_count`, and `export`) go to a healthy
+/// read replica, if any are configured, unless the primary has been modified
+/// recently (see ReplicaOptions). A read that fails on a replica because a
+/// snippet has not been replicated yet, or because the replica has become
+/// unavailable, is retried on the primary (see retry_on_primary()).
 pub struct SqlStorage {
     pool: Pool<AsyncPgConnection>,
+    replicas: Replicas,
+    waits: PoolWaits,
+    min_idle: usize,
+}
+
+/// Counters of the connections checked out of the pool of the primary
+/// database. deadpool only reports how many requests are waiting right
+/// now, which says little about how long they have waited.
+#[derive(Clone, Debug, Default)]
+struct PoolWaits {
+    checkouts: Arc<AtomicU64>,
+    wait_time_us: Arc<AtomicU64>,
+}
+
+impl PoolWaits {
+    fn record(&self, waited: Duration) {
+        self.checkouts.fetch_add(1, Ordering::Relaxed);
+        self.wait_time_us.fetch_add(
+            u64::try_from(waited.as_micros()).unwrap_or(u64::MAX),
+            Ordering::Relaxed,
+        );
+    }
+}
+
+/// A handle to the state of the connection pool of a SqlStorage instance.
+///
+/// The handle shares the pool with the storage, so it can be handed out to
+/// the code that needs to report the state (e.g. the metrics endpoint).
+#[derive(Clone)]
+pub struct PoolStats {
+    pool: Pool<AsyncPgConnection>,
+    waits: PoolWaits,
+}
+
+impl PoolStats {
+    /// The maximum number of connections in the pool.
+    pub fn max_size(&self) -> usize {
+        self.pool.status().max_size
+    }
+
+    /// The number of connections currently in the pool (both idle and in use).
+    pub fn size(&self) -> usize {
+        self.pool.status().size
+    }
+
+    /// The number of idle connections.
+    pub fn available(&self) -> usize {
+        self.pool.status().available
+    }
+
+    /// The number of requests waiting for a connection.
+    pub fn waiting(&self) -> usize {
+        self.pool.status().waiting
+    }
+
+    /// The number of connections requested from the pool, including the
+    /// requests that have timed out.
+    pub fn checkouts(&self) -> u64 {
+        self.waits.checkouts.load(Ordering::Relaxed)
+    }
+
+    /// The total time spent waiting for connections.
+    pub fn wait_time(&self) -> Duration {
+        Duration::from_micros(self.waits.wait_time_us.load(Ordering::Relaxed))
+    }
+}
+
+/// A handle that checks whether the primary database can serve requests.
+///
+/// Like PoolStats, the handle shares the pool with the storage, so it can be
+/// handed out to the code that reports the health of the service (e.g. the
+/// readiness probe).
+#[derive(Clone)]
+pub struct HealthCheck {
+    pool: Pool<AsyncPgConnection>,
+    min_idle: usize,
+}
+
+impl HealthCheck {
+    /// Returns Ok if a query can be run on the primary database.
+    pub async fn check(&self) -> Result<(), StorageError> {
+        let mut conn = self.pool.get().await?;
+        conn.batch_execute("SELECT 1").await?;
+
+        Ok(())
+    }
+
+    /// Opens the minimum number of idle connections of the pool, so that the
+    /// first requests do not wait for them, and then checks the database
+    /// like check() does. Meant to be called once at startup: afterwards,
+    /// the idle connections are replenished in the background (see
+    /// REAP_INTERVAL).
+    pub async fn warm_up(&self) -> Result<(), StorageError> {
+        fill_pool(&self.pool, self.min_idle).await?;
+        self.check().await
+    }
 }
 
 impl SqlStorage {
     pub fn new(database_url: &str) -> Result<SqlStorage, StorageError> {
-        let manager = AsyncDieselConnectionManager::new(database_url);
-        let pool = Pool::builder(manager).max_size(MAX_POOL_SIZE).build()?;
+        Self::with_options(database_url, PoolOptions::default())
+    }
+
+    /// Returns a new SqlStorage whose connection pool is configured using the
+    /// given options.
+    ///
+    /// Must be called from within a Tokio runtime.
+    pub fn with_options(
+        database_url: &str,
+        options: PoolOptions,
+    ) -> Result<SqlStorage, StorageError> {
+        let pool = build_pool(database_url, &options)?;
+        spawn_partition_maintenance(pool.clone());
+
+        Ok(Self {
+            pool,
+            replicas: Replicas::default(),
+            waits: PoolWaits::default(),
+            min_idle: options.min_idle,
+        })
+    }
+
+    /// Returns a new SqlStorage that reads from the given replicas of the
+    /// database. The connection pool of each replica is configured using the
+    /// same options as the one of the primary.
+    ///
+    /// Must be called from within a Tokio runtime.
+    pub fn with_replicas(
+        database_url: &str,
+        options: PoolOptions,
+        replica_options: ReplicaOptions,
+    ) -> Result<SqlStorage, StorageError> {
+        let pools = replica_options
+            .urls
+            .iter()
+            .map(|url| build_pool(url, &options))
+            .collect::<Result<Vec<_>, _>>()?;
+        let replicas = Replicas::new(pools, replica_options.read_your_writes_window);
+        replicas.spawn_health_checks(replica_options.health_check_interval);
+
+        Ok(Self {
+            replicas,
+            ..Self::with_options(database_url, options)?
+        })
+    }
+
+    /// Returns a handle to the state of the connection pool.
+    pub fn pool_stats(&self) -> PoolStats {
+        PoolStats {
+            pool: self.pool.clone(),
+            waits: self.waits.clone(),
+        }
+    }
+
+    /// Returns a handle that checks the health of the primary database.
+    pub fn health_check(&self) -> HealthCheck {
+        HealthCheck {
+            pool: self.pool.clone(),
+            min_idle: self.min_idle,
+        }
+    }
+
+    /// Checks out a connection to the primary database, keeping track of how
+    /// long it took (see PoolStats).
+    async fn connection(&self) -> Result<Object<AsyncPgConnection>, StorageError> {
+        let started = Instant::now();
+        let conn = self.pool.get().await;
+        self.waits.record(started.elapsed());
 
-        Ok(Self { pool })
+        Ok(conn?)
     }
 
     async fn get_snippet(
         &self,
         conn: &mut AsyncPgConnection,
         id: &str,
-    ) -> Result<(i32, Snippet), StorageError> {
-        let result = snippets::table
+    ) -> Result<Snippet, StorageError> {
+        let result = select_snippets(View::Full, None)
             .filter(snippets::slug.eq(id))
-            .get_result::<models::SnippetRow>(conn)
+            .get_result::<models::SnippetWithRelations>(conn)
             .await;
-        let snippet = match result {
-            Ok(snippet) => snippet,
-            Err(diesel::NotFound) => return Err(StorageError::NotFound { id: id.to_owned() }),
-            Err(e) => return Err(StorageError::from(e)),
+        match result {
+            Ok(row) => Ok(Snippet::try_from(row)?),
+            Err(diesel::NotFound) => Err(StorageError::NotFound { id: id.to_owned() }),
+            Err(e) => Err(StorageError::from(e)),
+        }
+    }
+
+    /// Returns the position of the snippet that is used as a pagination
+    /// marker. The relevance of the snippet to the search query is only
+    /// computed if there is one.
+    async fn get_marker(
+        &self,
+        conn: &mut AsyncPgConnection,
+        id: &str,
+        search: Option<&str>,
+    ) -> Result<Position, StorageError> {
+        let query = snippets::table.filter(snippets::slug.eq(id));
+        let result = match search {
+            Some(search) => query
+                .select((
+                    snippets::id,
+                    snippets::created_at,
+                    SearchRank(search.to_owned()),
+                ))
+                .get_result::<(i32, DateTime<Utc>, f32)>(conn)
+                .await
+                .map(|(internal_id, created_at, rank)| Position {
+                    created_at,
+                    internal_id,
+                    rank: Some(rank),
+                }),
+            None => query
+                .select((snippets::id, snippets::created_at))
+                .get_result::<(i32, DateTime<Utc>)>(conn)
+                .await
+                .map(|(internal_id, created_at)| Position {
+                    created_at,
+                    internal_id,
+                    rank: None,
+                }),
+        };
+        match result {
+            Ok(marker) => Ok(marker),
+            Err(diesel::NotFound) => Err(StorageError::NotFound { id: id.to_owned() }),
+            Err(e) => Err(StorageError::from(e)),
+        }
+    }
+
+    async fn find_snippets(
+        &self,
+        conn: &mut AsyncPgConnection,
+        criteria: ListSnippetsQuery,
+    ) -> Result<Page, StorageError> {
+        // a position returned by a previous call is used as is, which spares
+        // the lookup of the marker snippet
+        let marker = match &criteria.pagination.marker {
+            Some(Marker::Id(id)) => Some(
+                self.get_marker(conn, id, criteria.search.as_deref())
+                    .await?,
+            ),
+            Some(Marker::Position(position)) => Some(*position),
+            None => None,
+        };
+
+        // changesets and tags are fetched by the same query, so there is no
+        // need for an explicit transaction to get a consistent view of them
+        let rows = list_snippets(criteria, marker)
+            .get_results::<models::SnippetWithRelations>(conn)
+            .await?;
+
+        let mut page = Page {
+            snippets: Vec::with_capacity(rows.len()),
+            positions: Vec::with_capacity(rows.len()),
         };
+        for row in rows {
+            page.positions.push(Position {
+                created_at: row.0.created_at,
+                internal_id: row.0.id,
+                rank: row.3,
+            });
+            page.snippets.push(Snippet::try_from(row)?);
+        }
+
+        Ok(page)
+    }
+
+    /// Returns the number of rows the planner expects the filtered query to
+    /// return. The estimate is based on the statistics of the tables, so the
+    /// cost does not depend on the number of matching snippets.
+    async fn estimate_snippets(
+        &self,
+        conn: &mut AsyncPgConnection,
+        criteria: &ListSnippetsQuery,
+    ) -> Result<u64, StorageError> {
+        let query = filter_snippets(snippets::table.select(snippets::id).into_boxed(), criteria);
+        let plan = ExplainJson(query)
+            .get_result::<serde_json::Value>(conn)
+            .await?;
+
+        Ok(estimate::plan_rows(&plan))
+    }
+
+    async fn get_latest_snippet(
+        &self,
+        conn: &mut AsyncPgConnection,
+        id: &str,
+    ) -> Result<Snippet, StorageError> {
+        // unlike CHANGESETS_JSON, the content is selected as is, so that it
+        // does not need to be escaped and parsed as JSON
+        let result = snippets::table
+            .left_join(changesets::table.inner_join(blobs::table))
+            .filter(snippets::slug.eq(id))
+            .order_by(changesets::version.desc())
+            .select((
+                SNIPPET_COLUMNS,
+                (
+                    changesets::version,
+                    blobs::content,
+                    changesets::created_at,
+                    changesets::updated_at,
+                )
+                    .nullable(),
+            ))
+            .first::<models::SnippetWithLatestChangeset>(conn)
+            .await;
+        match result {
+            Ok(row) => Ok(Snippet::from(row)),
+            Err(diesel::NotFound) => Err(StorageError::NotFound { id: id.to_owned() }),
+            Err(e) => Err(StorageError::from(e)),
+        }
+    }
 
-        let changesets = changesets::table
-            .filter(changesets::snippet_id.eq(snippet.id))
-            .get_results::<models::ChangesetRow>(conn)
+    async fn get_snippet_version(
+        &self,
+        conn: &mut AsyncPgConnection,
+        id: &str,
+        version: usize,
+    ) -> Result<Snippet, StorageError> {
+        let not_found = || StorageError::NotFound { id: id.to_owned() };
+        let version = i32::try_from(version).map_err(|_| not_found())?;
+
+        // A changeset stored as a delta is rebuilt from the ones that follow
+        // it, up to the nearest changeset stored in full. Every
+        // KEYFRAME_INTERVAL-th changeset is stored in full, so that many rows
+        // always include it
+        let rows = snippets::table
+            .inner_join(changesets::table.left_join(blobs::table))
+            .filter(snippets::slug.eq(id))
+            .filter(changesets::version.ge(version))
+            .order_by(changesets::version.asc())
+            .limit(KEYFRAME_INTERVAL)
+            .select((
+                SNIPPET_COLUMNS,
+                (
+                    changesets::version,
+                    blobs::content.nullable(),
+                    changesets::delta,
+                    changesets::created_at,
+                    changesets::updated_at,
+                ),
+            ))
+            .load::<models::SnippetWithChangeset>(conn)
             .await?;
-        let tags = tags::table
-            .filter(tags::snippet_id.eq(snippet.id))
-            .get_results::<models::TagRow>(conn)
+
+        models::snippet_version(rows, version as usize)?.ok_or_else(not_found)
+    }
+
+    /// Starts a transaction and declares the export cursor within it (see
+    /// the export module).
+    async fn declare_export(
+        &self,
+        conn: &mut AsyncPgConnection,
+        after: Option<&Checkpoint>,
+    ) -> Result<(), StorageError> {
+        AnsiTransactionManager::begin_transaction(conn).await?;
+
+        // The checkpoint snippet might have been deleted since, in which
+        // case the snippets created at the very same time are exported
+        // again. Import reports them as duplicates, so that's harmless
+        let position = match after {
+            Some(checkpoint) => Some(Position {
+                created_at: checkpoint.created_at,
+                internal_id: snippets::table
+                    .filter(snippets::slug.eq(&checkpoint.id))
+                    .filter(snippets::created_at.eq(checkpoint.created_at))
+                    .select(snippets::id)
+                    .get_result::<i32>(conn)
+                    .await
+                    .optional()?
+                    .unwrap_or(i32::MIN),
+                rank: None,
+            }),
+            None => None,
+        };
+        export::DeclareCursor(export_snippets(position))
+            .execute(conn)
             .await?;
 
-        Ok((snippet.id, Snippet::from((snippet, changesets, tags))))
+        Ok(())
     }
 
     async fn insert_snippet(
@@ -87,6 +996,217 @@ impl SqlStorage {
         }
     }
 
+    async fn import_snippets(
+        &self,
+        conn: &mut AsyncPgConnection,
+        snippets: &[Snippet],
+    ) -> Result<Vec<Result<(), StorageError>>, StorageError> {
+        let now = chrono::Utc::now();
+
+        // insert the snippet rows first to get the generated primary keys.
+        // Rows with slugs that already exist are skipped and reported as
+        // duplicates below
+        let mut inserted = HashMap::with_capacity(snippets.len());
+        for batch in snippets.chunks(INSERT_BATCH_SIZE / 5) {
+            let rows = diesel::insert_into(snippets::table)
+                .values(
+                    batch
+                        .iter()
+                        .map(|snippet| {
+                            (
+                                snippets::slug.eq(&snippet.id),
+                                snippets::title.eq(&snippet.title),
+                                snippets::syntax.eq(&snippet.syntax),
+                                snippets::created_at.eq(snippet.created_at.unwrap_or(now)),
+                                snippets::updated_at.eq(snippet.updated_at.unwrap_or(now)),
+                            )
+                        })
+                        .collect::<Vec<_>>(),
+                )
+                .on_conflict(snippets::slug)
+                .do_nothing()
+                .returning((snippets::id, snippets::slug))
+                .get_results::<(i32, String)>(conn)
+                .await?;
+            inserted.extend(rows.into_iter().map(|(id, slug)| (slug, id)));
+        }
+
+        let mut results = Vec::with_capacity(snippets.len());
+        let mut contents = Vec::new();
+        let mut changeset_rows = Vec::new();
+        let mut tag_rows = Vec::new();
+        for snippet in snippets {
+            // if the same slug is passed more than once, only its first
+            // occurrence has been inserted, so the entry is removed from the
+            // map to report the following ones as duplicates
+            match inserted.remove(&snippet.id) {
+                Some(snippet_id) => {
+                    for c in snippet.changesets.iter() {
+                        contents.push((blob_hash(&c.content), c.content.as_str()));
+                        changeset_rows.push((
+                            snippet_id,
+                            c.version as i32,
+                            snippet.created_at.unwrap_or(now),
+                        ));
+                    }
+                    tag_rows.extend(
+                        snippet
+                            .tags
+                            .iter()
+                            .map(|t| (tags::snippet_id.eq(snippet_id), tags::value.eq(t))),
+                    );
+                    results.push(Ok(()));
+                }
+                None => results.push(Err(StorageError::Duplicate {
+                    id: snippet.id.to_owned(),
+                })),
+            }
+        }
+
+        // changeset rows are aligned with the contents
+        self.insert_blobs(conn, &contents).await?;
+        let mut changeset_rows = changeset_rows.into_iter().zip(contents.iter()).map(
+            |((snippet_id, version, created_at), (hash, _))| {
+                (
+                    changesets::snippet_id.eq(snippet_id),
+                    changesets::version.eq(version),
+                    changesets::blob_hash.eq(hash),
+                    changesets::created_at.eq(created_at),
+                )
+            },
+        );
+        loop {
+            let batch = changeset_rows
+                .by_ref()
+                .take(INSERT_BATCH_SIZE / 4)
+                .collect::<Vec<_>>();
+            if batch.is_empty() {
+                break;
+            }
+
+            diesel::insert_into(changesets::table)
+                .values(batch)
+                .execute(conn)
+                .await?;
+        }
+
+        let mut tag_rows = tag_rows.into_iter();
+        loop {
+            let batch = tag_rows
+                .by_ref()
+                .take(INSERT_BATCH_SIZE / 2)
+                .collect::<Vec<_>>();
+            if batch.is_empty() {
+                break;
+            }
+
+            diesel::insert_into(tags::table)
+                .values(batch)
+                .on_conflict_do_nothing()
+                .execute(conn)
+                .await?;
+        }
+
+        Ok(results)
+    }
+
+    /// Insert the given contents into the blobs table. The contents that are
+    /// already stored are skipped, so that identical contents are stored once.
+    ///
+    /// All the blobs are locked until the end of the transaction, so that a
+    /// blob that is already stored can't be deleted by a concurrent
+    /// transaction (see delete_unreferenced_blobs()) before the changeset that
+    /// references it is inserted.
+    async fn insert_blobs(
+        &self,
+        conn: &mut AsyncPgConnection,
+        contents: &[(Vec<u8>, &str)],
+    ) -> Result<(), StorageError> {
+        let mut seen = HashSet::with_capacity(contents.len());
+        let mut batch = Vec::new();
+        let mut batch_bytes = 0;
+        for (i, (hash, content)) in contents.iter().enumerate() {
+            if seen.insert(hash) {
+                batch.push((hash, *content));
+                batch_bytes += content.len();
+            }
+
+            let is_last = i + 1 == contents.len();
+            if !batch.is_empty()
+                && (is_last
+                    || batch.len() == INSERT_BATCH_SIZE
+                    || batch_bytes >= INSERT_BATCH_BYTES)
+            {
+                self.insert_and_lock_blobs(conn, std::mem::take(&mut batch))
+                    .await?;
+                batch_bytes = 0;
+            }
+        }
+
+        Ok(())
+    }
+
+    /// Insert a batch of blobs, skipping the ones that are already stored,
+    /// and lock all of them FOR KEY SHARE. The lock does not conflict with
+    /// the transactions that reference the same blobs, but makes a delete
+    /// wait until the transaction ends.
+    async fn insert_and_lock_blobs(
+        &self,
+        conn: &mut AsyncPgConnection,
+        mut batch: Vec<(&Vec<u8>, &str)>,
+    ) -> Result<(), StorageError> {
+        while !batch.is_empty() {
+            diesel::insert_into(blobs::table)
+                .values(
+                    batch
+                        .iter()
+                        .map(|(hash, content)| (blobs::hash.eq(*hash), blobs::content.eq(*content)))
+                        .collect::<Vec<_>>(),
+                )
+                .on_conflict_do_nothing()
+                .execute(conn)
+                .await?;
+            let locked = blobs::table
+                .filter(blobs::hash.eq_any(batch.iter().map(|(hash, _)| hash.to_vec())))
+                .select(blobs::hash)
+                .for_key_share()
+                .load::<Vec<u8>>(conn)
+                .await?
+                .into_iter()
+                .collect::<HashSet<_>>();
+
+            // the blobs that have been deleted by a concurrent transaction
+            // after the insert skipped them must be inserted again
+            batch.retain(|(hash, _)| !locked.contains(*hash));
+        }
+
+        Ok(())
+    }
+
+    /// Delete the blobs with the given hashes, unless they are still referenced
+    /// by other changesets.
+    ///
+    /// This is best effort: if a concurrent transaction starts referencing one
+    /// of the blobs, the delete waits for the lock taken by insert_blobs(),
+    /// then the foreign key prevents the deletion, and the error is only
+    /// logged.
+    async fn delete_unreferenced_blobs(&self, conn: &mut AsyncPgConnection, hashes: Vec<Vec<u8>>) {
+        if hashes.is_empty() {
+            return;
+        }
+
+        let result = diesel::delete(
+            blobs::table
+                .filter(blobs::hash.eq_any(hashes))
+                .filter(sql::<Bool>(BLOB_IS_UNREFERENCED)),
+        )
+        .execute(conn)
+        .await;
+        if let Err(e) = result {
+            warn!("Failed to delete unreferenced blobs: {}", e);
+        }
+    }
+
     async fn update_snippet(
         &self,
         conn: &mut AsyncPgConnection,
@@ -112,40 +1232,115 @@ impl SqlStorage {
         }
     }
 
-    async fn upsert_changesets(
+    async fn insert_changesets(
         &self,
         conn: &mut AsyncPgConnection,
         snippet_id: i32,
         snippet: &Snippet,
     ) -> Result<(), StorageError> {
         let now = chrono::Utc::now();
+        let contents = snippet
+            .changesets
+            .iter()
+            .map(|c| (blob_hash(&c.content), c.content.as_str()))
+            .collect::<Vec<_>>();
+        self.insert_blobs(conn, &contents).await?;
+
         diesel::insert_into(changesets::table)
             .values(
                 snippet
                     .changesets
                     .iter()
-                    .map(|c| {
+                    .zip(contents.iter())
+                    .map(|(c, (hash, _))| {
                         (
                             changesets::snippet_id.eq(snippet_id),
                             changesets::version.eq(c.version as i32),
-                            changesets::content.eq(&c.content),
+                            changesets::blob_hash.eq(hash),
                             changesets::created_at.eq(snippet.created_at.unwrap_or(now)),
                         )
                     })
                     .collect::<Vec<_>>(),
             )
-            .on_conflict((changesets::snippet_id, changesets::version))
-            .do_update()
-            .set((
-                changesets::content.eq(upsert::excluded(changesets::content)),
-                changesets::updated_at.eq(snippet.updated_at.unwrap_or(now)),
-            ))
             .execute(conn)
             .await?;
 
         Ok(())
     }
 
+    /// Append the given changesets to the history of a snippet. The changesets
+    /// must be newer than the latest stored one, which is passed along with
+    /// its content (`latest`), and `count` is the number of the stored ones.
+    ///
+    /// Only the newest changeset is stored in full: the previous ones are
+    /// stored as deltas against the changesets that follow them (see
+    /// compact_delta), and the latest stored changeset is replaced by a delta
+    /// too. Returns the hash of the content it no longer references, if so.
+    async fn append_changesets(
+        &self,
+        conn: &mut AsyncPgConnection,
+        snippet_id: i32,
+        latest: Option<(i32, String)>,
+        count: i64,
+        changesets: &[&Changeset],
+    ) -> Result<Option<Vec<u8>>, StorageError> {
+        let first = match changesets.first() {
+            Some(first) => first,
+            None => return Ok(None),
+        };
+
+        let mut replaced = None;
+        if let Some((version, content)) = latest {
+            if let Some(delta) = compact_delta(count, &content, &first.content) {
+                diesel::update(
+                    changesets::table
+                        .filter(changesets::snippet_id.eq(snippet_id))
+                        .filter(changesets::version.eq(version)),
+                )
+                .set((
+                    changesets::blob_hash.eq(None::<Vec<u8>>),
+                    changesets::delta.eq(delta),
+                ))
+                .execute(conn)
+                .await?;
+                replaced = Some(blob_hash(&content));
+            }
+        }
+
+        let now = chrono::Utc::now();
+        let mut contents = Vec::new();
+        let mut rows = Vec::with_capacity(changesets.len());
+        for (i, changeset) in changesets.iter().enumerate() {
+            let delta = changesets.get(i + 1).and_then(|newer| {
+                compact_delta(count + 1 + i as i64, &changeset.content, &newer.content)
+            });
+            let hash = match delta {
+                Some(_) => None,
+                None => {
+                    let hash = blob_hash(&changeset.content);
+                    contents.push((hash.clone(), changeset.content.as_str()));
+                    Some(hash)
+                }
+            };
+
+            rows.push((
+                changesets::snippet_id.eq(snippet_id),
+                changesets::version.eq(changeset.version as i32),
+                changesets::blob_hash.eq(hash),
+                changesets::delta.eq(delta),
+                changesets::created_at.eq(now),
+                changesets::updated_at.eq(now),
+            ));
+        }
+        self.insert_blobs(conn, &contents).await?;
+        diesel::insert_into(changesets::table)
+            .values(rows)
+            .execute(conn)
+            .await?;
+
+        Ok(replaced)
+    }
+
     async fn upsert_tags(
         &self,
         conn: &mut AsyncPgConnection,
@@ -190,153 +1385,262 @@ impl SqlStorage {
 #[rocket::async_trait]
 impl Storage for SqlStorage {
     async fn create(&self, snippet: &Snippet) -> Result<Snippet, StorageError> {
-        let mut conn = self.pool.get().await?;
-        conn.transaction::<_, StorageError, _>(async |conn| {
-            // insert the new snippet row first to get the generated primary key
-            let snippet_id = self.insert_snippet(conn, snippet).await?;
-            // insert the associated changesets
-            self.upsert_changesets(conn, snippet_id, snippet).await?;
-            // insert the associated tags
-            self.upsert_tags(conn, snippet_id, snippet).await?;
-
-            Ok(())
-        })
-        .await?;
+        let mut conn = self.connection().await?;
+        let insert = async |conn: &mut AsyncPgConnection| {
+            conn.transaction::<_, StorageError, _>(async |conn| {
+                // insert the new snippet row first to get the generated primary key
+                let snippet_id = self.insert_snippet(conn, snippet).await?;
+                // insert the associated changesets
+                self.insert_changesets(conn, snippet_id, snippet).await?;
+                // insert the associated tags
+                self.upsert_tags(conn, snippet_id, snippet).await?;
+
+                Ok(())
+            })
+            .await
+        };
+        if let Err(e) = insert(&mut conn).await {
+            if !missing_partition(&e) {
+                return Err(e);
+            }
+
+            // the partitions created ahead of time have been used up (e.g.
+            // by a bulk import), and the periodic maintenance has not caught
+            // up yet
+            create_partitions(&mut conn).await?;
+            insert(&mut conn).await?;
+        }
+        self.replicas.written();
 
         // reconstruct the created snippet from the state persisted to the database
-        let (_, created) = self.get_snippet(&mut conn, &snippet.id).await?;
+        let created = self.get_snippet(&mut conn, &snippet.id).await?;
         Ok(created)
     }
 
-    async fn list(&self, criteria: ListSnippetsQuery) -> Result<Vec<Snippet>, StorageError> {
-        let mut conn = self.pool.get().await?;
-        conn.transaction::<_, StorageError, _>(async |conn| {
-            let mut query = snippets::table.into_boxed();
-
-            // Filters
-            if let Some(title) = criteria.title {
-                query = query.filter(snippets::title.eq(title));
-            }
-            if let Some(syntax) = criteria.syntax {
-                query = query.filter(snippets::syntax.eq(syntax));
-            }
-            if let Some(tags) = criteria.tags {
-                let snippet_ids = tags::table
-                    .select(tags::snippet_id)
-                    .filter(tags::value.eq_any(tags));
-
-                query = query.filter(snippets::id.eq_any(snippet_ids));
-            }
-
-            // Pagination. marker_internal_id is used to resolve the ties because the value
-            // of created_at is not guaranteed to be unique. In practice, we use
-            // microsecond precision for datetime fields, so duplicates are only
-            // expected in tests and, potentially, in snippets imported from
-            // Mongo that have second precision
-            if let Some(marker) = criteria.pagination.marker {
-                let (marker_internal_id, marker) = self.get_snippet(conn, &marker).await?;
-                if let Some(marker_created_at) = marker.created_at {
-                    query = match criteria.pagination.direction {
-                        Direction::Desc => query
-                            .filter(
-                                snippets::created_at
-                                    .lt(marker_created_at)
-                                    .or(snippets::created_at
-                                        .eq(marker_created_at)
-                                        .and(snippets::id.lt(marker_internal_id))),
-                            )
-                            .order_by(snippets::created_at.desc())
-                            .then_order_by(snippets::id.desc()),
-                        Direction::Asc => query
-                            .filter(
-                                snippets::created_at
-                                    .gt(marker_created_at)
-                                    .or(snippets::created_at
-                                        .eq(marker_created_at)
-                                        .and(snippets::id.gt(marker_internal_id))),
-                            )
-                            .order_by(snippets::created_at.asc())
-                            .then_order_by(snippets::id.asc()),
-                    };
-                }
-            } else {
-                query = match criteria.pagination.direction {
-                    Direction::Desc => query
-                        .order_by(snippets::created_at.desc())
-                        .then_order_by(snippets::id.desc()),
-                    Direction::Asc => query
-                        .order_by(snippets::created_at.asc())
-                        .then_order_by(snippets::id.asc()),
-                };
+    async fn import(
+        &self,
+        snippets: &[Snippet],
+    ) -> Result<Vec<Result<(), StorageError>>, StorageError> {
+        let mut conn = self.connection().await?;
+        // A bulk import can allocate snippet ids faster than the periodic
+        // maintenance creates the partitions for them, so every batch makes
+        // sure its partitions exist. This is cheap when they do, and a
+        // failure is not fatal, as long as there are spare partitions left.
+        if let Err(e) = create_partitions(&mut conn).await {
+            warn!("Failed to create partitions of changesets: {}", e);
+        }
+        let results = conn
+            .transaction::<_, StorageError, _>(async |conn| {
+                self.import_snippets(conn, snippets).await
+            })
+            .await?;
+        self.replicas.written();
+
+        Ok(results)
+    }
+
+    async fn list(&self, criteria: ListSnippetsQuery) -> Result<Page, StorageError> {
+        if let Some(mut conn) = self.replicas.connection().await {
+            match self.find_snippets(&mut conn, criteria.clone()).await {
+                Err(e) if retry_on_primary(&e) => {}
+                result => return result,
             }
-            query = query.limit(criteria.pagination.limit as i64);
+        }
 
-            let snippets = query.get_results::<models::SnippetRow>(conn).await?;
-            let snippet_ids = snippets
-                .iter()
-                .map(|snippet| snippet.id)
-                .collect::<Vec<i32>>();
-            let changesets = changesets::table
-                .filter(changesets::snippet_id.eq_any(&snippet_ids))
-                .get_results::<models::ChangesetRow>(conn)
-                .await?;
-            let tags = tags::table
-                .filter(tags::snippet_id.eq_any(&snippet_ids))
-                .get_results::<models::TagRow>(conn)
-                .await?;
+        let mut conn = self.connection().await?;
+        self.find_snippets(&mut conn, criteria).await
+    }
 
-            Ok(models::combine_rows(snippets, changesets, tags))
-        })
-        .await
+    async fn estimate_count(&self, criteria: &ListSnippetsQuery) -> Result<u64, StorageError> {
+        if let Some(mut conn) = self.replicas.connection().await {
+            match self.estimate_snippets(&mut conn, criteria).await {
+                Err(e) if retry_on_primary(&e) => {}
+                result => return result,
+            }
+        }
+
+        let mut conn = self.connection().await?;
+        self.estimate_snippets(&mut conn, criteria).await
+    }
+
+    async fn export(&self, after: Option<Checkpoint>) -> Result<SnippetStream, StorageError> {
+        // A long export on a replica might be cancelled by a conflict with
+        // the replication, but then it can be resumed from the checkpoint,
+        // whereas on the primary it would hold back the vacuum all along
+        if let Some(mut conn) = self.replicas.connection().await {
+            let declared = self.declare_export(&mut conn, after.as_ref()).await;
+            match declared {
+                Ok(_) => return Ok(exported_snippets(conn)),
+                Err(e) if retry_on_primary(&e) => {}
+                Err(e) => return Err(e),
+            }
+        }
+
+        let mut conn = self.connection().await?;
+        self.declare_export(&mut conn, after.as_ref()).await?;
+        Ok(exported_snippets(conn))
     }
 
     async fn get(&self, id: &str) -> Result<Snippet, StorageError> {
-        let mut conn = self.pool.get().await?;
-        let (_, snippet) = self.get_snippet(&mut conn, id).await?;
-        Ok(snippet)
+        if let Some(mut conn) = self.replicas.connection().await {
+            match self.get_snippet(&mut conn, id).await {
+                Err(e) if retry_on_primary(&e) => {}
+                result => return result,
+            }
+        }
+
+        let mut conn = self.connection().await?;
+        self.get_snippet(&mut conn, id).await
     }
 
-    #[allow(dead_code)]
-    async fn update(&self, snippet: &Snippet) -> Result<Snippet, StorageError> {
-        // load the snippet from the db to check if we need to update anything
-        let persisted_state = self.get(&snippet.id).await?;
-        if persisted_state == *snippet {
-            // if not, simply return the current state
-            Ok(persisted_state)
-        } else {
-            // otherwise, potentially update the title and the syntax
-            let mut conn = self.pool.get().await?;
-            conn.transaction::<_, StorageError, _>(async |conn| {
-                let snippet_id = self.update_snippet(conn, snippet).await?;
-                // insert new changesets and tags
-                self.upsert_changesets(conn, snippet_id, snippet).await?;
-                self.upsert_tags(conn, snippet_id, snippet).await?;
-                // and delete the removed tags
-                self.trim_removed_tags(conn, snippet_id, snippet).await?;
+    async fn get_latest(&self, id: &str) -> Result<Snippet, StorageError> {
+        if let Some(mut conn) = self.replicas.connection().await {
+            match self.get_latest_snippet(&mut conn, id).await {
+                Err(e) if retry_on_primary(&e) => {}
+                result => return result,
+            }
+        }
 
-                Ok(())
+        let mut conn = self.connection().await?;
+        self.get_latest_snippet(&mut conn, id).await
+    }
+
+    async fn get_version(&self, id: &str, version: usize) -> Result<Snippet, StorageError> {
+        if let Some(mut conn) = self.replicas.connection().await {
+            match self.get_snippet_version(&mut conn, id, version).await {
+                Err(e) if retry_on_primary(&e) => {}
+                result => return result,
+            }
+        }
+
+        let mut conn = self.connection().await?;
+        self.get_snippet_version(&mut conn, id, version).await
+    }
+
+    async fn update(&self, id: &str, changes: &SnippetChanges) -> Result<Snippet, StorageError> {
+        // Replicas might lag behind, so the primary is always used
+        let mut conn = self.connection().await?;
+        let replaced = conn
+            .transaction::<_, StorageError, _>(async |conn| {
+                // the snippet row is locked, so that concurrent updates are
+                // applied one after another, each to the state left by the
+                // previous one
+                let (snippet_id, title, syntax) = snippets::table
+                    .filter(snippets::slug.eq(id))
+                    .select((snippets::id, snippets::title, snippets::syntax))
+                    .for_update()
+                    .get_result::<(i32, Option<String>, Option<String>)>(conn)
+                    .await
+                    .optional()?
+                    .ok_or_else(|| StorageError::NotFound { id: id.to_owned() })?;
+                let tags = tags::table
+                    .filter(tags::snippet_id.eq(snippet_id))
+                    .select(tags::value)
+                    .load::<String>(conn)
+                    .await?;
+                let latest = changesets::table
+                    .inner_join(blobs::table)
+                    .filter(changesets::snippet_id.eq(snippet_id))
+                    .order_by(changesets::version.desc())
+                    .select((changesets::version, blobs::content))
+                    .first::<(i32, String)>(conn)
+                    .await
+                    .optional()?;
+
+                // The changes are applied to the locked state of the snippet,
+                // so the fields that are not changed keep the values written
+                // by the concurrent updates. The stored changesets are never
+                // modified: a changed content is appended as a new version
+                let new_changeset = match (&changes.content, &latest) {
+                    (Some(content), Some((version, latest))) if content != latest => {
+                        Some(Changeset::new(*version as usize + 1, content.clone()))
+                    }
+                    (Some(content), None) => Some(Changeset::new(0, content.clone())),
+                    _ => None,
+                };
+                let updated = Snippet {
+                    id: id.to_owned(),
+                    title: changes.title.clone().unwrap_or_else(|| title.clone()),
+                    syntax: changes.syntax.clone().unwrap_or_else(|| syntax.clone()),
+                    changesets: new_changeset.into_iter().collect(),
+                    tags: changes.tags.clone().unwrap_or_else(|| tags.clone()),
+                    ..Default::default()
+                };
+                if updated.changesets.is_empty()
+                    && title == updated.title
+                    && syntax == updated.syntax
+                    && tags.iter().collect::<HashSet<_>>() == updated.tags.iter().collect()
+                {
+                    // nothing to update
+                    return Ok(None);
+                }
+
+                // potentially update the title and the syntax
+                self.update_snippet(conn, &updated).await?;
+                // append the new changeset
+                let count = if latest.is_some() {
+                    changesets::table
+                        .filter(changesets::snippet_id.eq(snippet_id))
+                        .count()
+                        .get_result::<i64>(conn)
+                        .await?
+                } else {
+                    0
+                };
+                let new_changesets = updated.changesets.iter().collect::<Vec<_>>();
+                let replaced = self
+                    .append_changesets(conn, snippet_id, latest, count, &new_changesets)
+                    .await?;
+                // insert new tags and delete the removed ones
+                self.upsert_tags(conn, snippet_id, &updated).await?;
+                self.trim_removed_tags(conn, snippet_id, &updated).await?;
+
+                Ok(Some(replaced))
             })
             .await?;
 
-            // reconstruct the updated snippet from the state persisted to the database
-            // (e.g. so that updated_at fields are correctly populated)
-            let (_, updated) = self.get_snippet(&mut conn, &snippet.id).await?;
-            Ok(updated)
+        if let Some(replaced) = replaced {
+            self.replicas.written();
+            // the content of the changeset that has been replaced by a delta
+            // might not be needed anymore
+            self.delete_unreferenced_blobs(&mut conn, replaced.into_iter().collect())
+                .await;
         }
+
+        // reconstruct the updated snippet from the state persisted to the database
+        // (e.g. so that updated_at fields are correctly populated)
+        let updated = self.get_snippet(&mut conn, id).await?;
+        Ok(updated)
     }
 
     async fn delete(&self, id: &str) -> Result<(), StorageError> {
         // CASCADE on foreign keys will take care of deleting associated changesets and
-        // tags
-        let mut conn = self.pool.get().await?;
-        let deleted_rows = diesel::delete(snippets::table.filter(snippets::slug.eq(id)))
-            .execute(&mut conn)
+        // tags. Blobs might be shared with other snippets, so they are deleted
+        // separately, once they are not referenced anymore
+        let mut conn = self.connection().await?;
+        let hashes = conn
+            .transaction::<_, StorageError, _>(async |conn| {
+                let hashes = changesets::table
+                    .inner_join(snippets::table)
+                    .filter(snippets::slug.eq(id))
+                    .select(changesets::blob_hash)
+                    .load::<Option<Vec<u8>>>(conn)
+                    .await?;
+                let deleted_rows = diesel::delete(snippets::table.filter(snippets::slug.eq(id)))
+                    .execute(conn)
+                    .await?;
+                if deleted_rows == 0 {
+                    Err(StorageError::NotFound { id: id.to_owned() })
+                } else {
+                    Ok(hashes)
+                }
+            })
             .await?;
-        if deleted_rows == 0 {
-            Err(StorageError::NotFound { id: id.to_owned() })
-        } else {
-            Ok(())
-        }
+        self.replicas.written();
+        self.delete_unreferenced_blobs(&mut conn, hashes.into_iter().flatten().collect())
+            .await;
+
+        Ok(())
     }
 }
 
@@ -356,6 +1660,18 @@ impl From<diesel::ConnectionError> for StorageError {
 
 impl From<PoolError> for StorageError {
     fn from(error: PoolError) -> Self {
+        match error {
+            // all connections are busy or the database does not respond in
+            // time: the request must fail fast, so that the clients can back
+            // off, instead of piling up
+            PoolError::Timeout(_) | PoolError::Closed => StorageError::Unavailable(Box::new(error)),
+            _ => StorageError::InternalError(Box::new(error)),
+        }
+    }
+}
+
+impl From<serde_json::Error> for StorageError {
+    fn from(error: serde_json::Error) -> Self {
         StorageError::InternalError(Box::new(error))
     }
 }
@@ -371,6 +1687,8 @@ mod tests {
     use std::collections::HashSet;
     use std::future::Future;
 
+    use diesel::query_builder::{AstPass, Query, QueryFragment, QueryId};
+
     use super::super::Changeset;
     use super::*;
 
@@ -393,8 +1711,8 @@ mod tests {
         }
     }
 
-    /// A fixture that creates a DB connection when ROCKET_DATABASE_URL is set.
-    /// The connection is then passed to the given test function. If the url is
+    /// A fixture that creates a DB connection pool when ROCKET_DATABASE_URL is
+    /// set. The pool is then passed to the given test function. If the url is
     /// not set, the test is skipped.
     ///
     /// The test function is run within a database transaction that is never
@@ -403,7 +1721,7 @@ mod tests {
     /// are never seen by other transactions, so multiple tests can operate
     /// on the same tables in parallel, as if they had exclusive access to
     /// the database.
-    async fn with_storage<R, F: FnOnce(Box<dyn Storage>) -> R>(test_function: F)
+    async fn with_pool<R, F: FnOnce(Pool<AsyncPgConnection>) -> R>(test_function: F)
     where
         R: Future<Output = ()>,
     {
@@ -437,6 +1755,10 @@ mod tests {
                     .execute(&mut conn)
                     .await
                     .expect("could not delete changesets");
+                diesel::delete(blobs::table)
+                    .execute(&mut conn)
+                    .await
+                    .expect("could not delete blobs");
                 diesel::delete(snippets::table)
                     .execute(&mut conn)
                     .await
@@ -448,12 +1770,55 @@ mod tests {
                 // the test function below
             }
 
-            test_function(Box::new(SqlStorage { pool }));
+            test_function(pool).await;
         } else {
             error!("ROCKET_DATABASE_URL is not set, skipping the test");
         }
     }
 
+    /// Same as with_pool, but passes a Storage instance to the test function.
+    async fn with_storage<R, F: FnOnce(Box<dyn Storage>) -> R>(test_function: F)
+    where
+        R: Future<Output = ()>,
+    {
+        with_pool(|pool| {
+            test_function(Box::new(SqlStorage {
+                pool,
+                replicas: Replicas::default(),
+                waits: PoolWaits::default(),
+                min_idle: 0,
+            }))
+        })
+        .await;
+    }
+
+    /// Wraps a query into EXPLAIN, so that tests can check its plan.
+    #[derive(QueryId)]
+    struct Explain<Q>(Q);
+
+    impl<Q: QueryFragment<Pg>> QueryFragment<Pg> for Explain<Q> {
+        fn walk_ast<'b>(&'b self, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+            out.push_sql("EXPLAIN ");
+            self.0.walk_ast(out.reborrow())
+        }
+    }
+
+    impl<Q> Query for Explain<Q> {
+        type SqlType = Text;
+    }
+
+    /// Returns the plan of the given query as text.
+    async fn explain<Q>(conn: &mut AsyncPgConnection, query: Q) -> String
+    where
+        Q: QueryFragment<Pg> + QueryId + Send + 'static,
+    {
+        Explain(query)
+            .load::<String>(conn)
+            .await
+            .expect("Failed to explain a query")
+            .join("\n")
+    }
+
     fn reference_snippets(created_at: Option<chrono::DateTime<chrono::Utc>>) -> Vec<Snippet> {
         let mut snippets = vec![
             Snippet::new(
@@ -524,8 +1889,17 @@ mod tests {
             assert_eq!(new_snippet, retrieved_snippet);
 
             // try to update the snippet state somehow
+            let changes = SnippetChanges {
+                title: Some(updated_reference.title.clone()),
+                content: updated_reference
+                    .changesets
+                    .last()
+                    .map(|c| c.content.clone()),
+                tags: Some(updated_reference.tags.clone()),
+                ..Default::default()
+            };
             let updated_snippet = storage
-                .update(&updated_reference)
+                .update(&reference.id, &changes)
                 .await
                 .expect("Failed to update a snippet");
             compare_snippets(&updated_reference, &updated_snippet);
@@ -545,6 +1919,46 @@ mod tests {
         .await;
     }
 
+    #[tokio::test]
+    async fn get_latest() {
+        with_storage(|storage| async move {
+            let mut reference = Snippet::new(
+                Some("Hello world!".to_string()),
+                Some("python".to_string()),
+                vec![
+                    Changeset::new(1, "print('Hello')".to_string()),
+                    Changeset::new(2, "print('Hello, World!')".to_string()),
+                ],
+                vec!["spam".to_string(), "foo".to_string()],
+            );
+            reference.id = "spam".to_string();
+            let new_snippet = storage
+                .create(&reference)
+                .await
+                .expect("Failed to create a snippet");
+
+            // only the latest changeset is returned, and tags are omitted
+            let latest = storage
+                .get_latest(&new_snippet.id)
+                .await
+                .expect("Failed to retrieve a snippet");
+            assert_eq!(
+                latest,
+                Snippet {
+                    changesets: vec![new_snippet.changesets[1].clone()],
+                    tags: vec![],
+                    ..new_snippet
+                }
+            );
+
+            assert!(match storage.get_latest("eggs").await {
+                Err(StorageError::NotFound { id }) => id == "eggs",
+                _ => false,
+            });
+        })
+        .await;
+    }
+
     #[tokio::test]
     async fn list() {
         with_storage(|storage| async move {
@@ -553,7 +1967,8 @@ mod tests {
                 storage
                     .list(ListSnippetsQuery::default())
                     .await
-                    .expect("Failed to list snippets"),
+                    .expect("Failed to list snippets")
+                    .snippets,
                 vec![]
             );
 
@@ -570,14 +1985,19 @@ mod tests {
             let result = storage
                 .list(default_filters)
                 .await
-                .expect("Failed to list snippets");
+                .expect("Failed to list snippets")
+                .snippets;
             for (actual, expected) in result.iter().rev().zip(reference.iter()) {
                 compare_snippets(expected, actual);
             }
 
             let mut by_tag = ListSnippetsQuery::default();
             by_tag.tags = Some(vec!["spam".to_string(), "foo".to_string()]);
-            let result = storage.list(by_tag).await.expect("Failed to list snippets");
+            let result = storage
+                .list(by_tag)
+                .await
+                .expect("Failed to list snippets")
+                .snippets;
             assert_eq!(result.len(), 2);
             for (actual, expected) in result.iter().rev().zip(reference.iter()) {
                 compare_snippets(expected, actual);
@@ -588,7 +2008,8 @@ mod tests {
             let result = storage
                 .list(by_title)
                 .await
-                .expect("Failed to list snippets");
+                .expect("Failed to list snippets")
+                .snippets;
             assert_eq!(result.len(), 1);
             compare_snippets(
                 reference
@@ -604,7 +2025,8 @@ mod tests {
             let result = storage
                 .list(by_syntax)
                 .await
-                .expect("Failed to list snippets");
+                .expect("Failed to list snippets")
+                .snippets;
             assert_eq!(result.len(), 1);
             compare_snippets(
                 reference
@@ -618,6 +2040,188 @@ mod tests {
         .await;
     }
 
+    #[tokio::test]
+    async fn list_summary() {
+        with_storage(|storage| async move {
+            let mut reference = reference_snippets(None);
+            reference[0]
+                .changesets
+                .push(Changeset::new(3, "x".repeat(PREVIEW_LENGTH * 4)));
+            for snippet in reference.iter() {
+                storage
+                    .create(snippet)
+                    .await
+                    .expect("Failed to create a snippet");
+            }
+
+            let summary = ListSnippetsQuery {
+                view: View::Summary,
+                ..Default::default()
+            };
+            let result = storage
+                .list(summary)
+                .await
+                .expect("Failed to list snippets")
+                .snippets;
+            assert_eq!(result.len(), reference.len());
+            for (actual, expected) in result.iter().rev().zip(reference.iter()) {
+                let latest = expected.changesets.last().unwrap();
+                let preview: String = latest.content.chars().take(PREVIEW_LENGTH + 1).collect();
+
+                // only the latest changeset is loaded, and its content is
+                // just long enough to tell whether it's truncated
+                assert_eq!(actual.changesets.len(), 1);
+                assert_eq!(actual.changesets[0].version, latest.version);
+                assert_eq!(actual.changesets[0].content, preview);
+
+                compare_snippets(
+                    &Snippet {
+                        changesets: vec![],
+                        ..expected.clone()
+                    },
+                    actual,
+                );
+            }
+        })
+        .await;
+    }
+
+    #[tokio::test]
+    async fn search() {
+        with_storage(|storage| async move {
+            let search = |query: &str| ListSnippetsQuery {
+                search: Some(query.to_string()),
+                ..Default::default()
+            };
+            let ids = |snippets: Vec<Snippet>| {
+                snippets
+                    .into_iter()
+                    .map(|snippet| snippet.id)
+                    .collect::<Vec<_>>()
+            };
+
+            let in_title = Snippet::new(
+                Some("Spam".to_string()),
+                None,
+                vec![Changeset::new(1, "eggs = 42".to_string())],
+                vec![],
+            );
+            let in_content = Snippet::new(
+                Some("Eggs".to_string()),
+                None,
+                vec![Changeset::new(1, "spam = 42".to_string())],
+                vec![],
+            );
+            let other = Snippet::new(
+                Some("Foo".to_string()),
+                None,
+                vec![Changeset::new(1, "bar".to_string())],
+                vec![],
+            );
+            for snippet in [&in_title, &in_content, &other] {
+                storage
+                    .create(snippet)
+                    .await
+                    .expect("Failed to create a snippet");
+            }
+
+            // matches in titles rank higher than matches in contents, even
+            // though the latter snippet is newer
+            let result = storage
+                .list(search("spam"))
+                .await
+                .expect("Failed to list snippets")
+                .snippets;
+            assert_eq!(
+                ids(result),
+                vec![in_title.id.clone(), in_content.id.clone()]
+            );
+
+            // the web search syntax is supported
+            let result = storage
+                .list(search("SPAM -eggs"))
+                .await
+                .expect("Failed to list snippets")
+                .snippets;
+            assert_eq!(ids(result), Vec::<String>::new());
+
+            // pagination goes through the results in the order of relevance,
+            // and then in the order of creation dates for equally relevant
+            // snippets
+            for (query, expected) in [
+                ("spam", vec![&in_title.id, &in_content.id]),
+                ("42", vec![&in_content.id, &in_title.id]),
+            ] {
+                let mut criteria = search(query);
+                criteria.pagination.limit = 1;
+
+                let first = storage
+                    .list(criteria.clone())
+                    .await
+                    .expect("Failed to list snippets")
+                    .snippets;
+                assert_eq!(ids(first), vec![expected[0].clone()], "{}", query);
+
+                criteria.pagination.marker = Some(Marker::Id(expected[0].clone()));
+                let second = storage
+                    .list(criteria.clone())
+                    .await
+                    .expect("Failed to list snippets")
+                    .snippets;
+                assert_eq!(ids(second), vec![expected[1].clone()], "{}", query);
+
+                criteria.pagination.marker = Some(Marker::Id(expected[1].clone()));
+                let last = storage
+                    .list(criteria.clone())
+                    .await
+                    .expect("Failed to list snippets")
+                    .snippets;
+                assert_eq!(ids(last), Vec::<String>::new(), "{}", query);
+
+                criteria.pagination.direction = Direction::Asc;
+                let previous = storage
+                    .list(criteria)
+                    .await
+                    .expect("Failed to list snippets")
+                    .snippets;
+                assert_eq!(ids(previous), vec![expected[0].clone()], "{}", query);
+            }
+
+            // the search vectors are kept up to date with the titles and the
+            // latest changesets
+            let changes = SnippetChanges {
+                content: Some("ham = 1".to_string()),
+                ..Default::default()
+            };
+            storage
+                .update(&in_content.id, &changes)
+                .await
+                .expect("Failed to update a snippet");
+            let changes = SnippetChanges {
+                title: Some(Some("More spam".to_string())),
+                ..Default::default()
+            };
+            storage
+                .update(&other.id, &changes)
+                .await
+                .expect("Failed to update a snippet");
+
+            let result = storage
+                .list(search("spam"))
+                .await
+                .expect("Failed to list snippets")
+                .snippets;
+            assert_eq!(ids(result), vec![other.id.clone(), in_title.id.clone()]);
+            let result = storage
+                .list(search("ham"))
+                .await
+                .expect("Failed to list snippets")
+                .snippets;
+            assert_eq!(ids(result), vec![in_content.id.clone()]);
+        })
+        .await;
+    }
+
     async fn pagination(reference: Vec<Snippet>) {
         with_storage(|storage| async move {
             for snippet in reference.iter() {
@@ -633,7 +2237,8 @@ mod tests {
             let result = storage
                 .list(pagination)
                 .await
-                .expect("Failed to list snippets");
+                .expect("Failed to list snippets")
+                .snippets;
             assert_eq!(result.len(), 2);
             for (actual, expected) in result.iter().zip(reference.iter()) {
                 compare_snippets(expected, actual);
@@ -641,11 +2246,12 @@ mod tests {
 
             let mut with_marker = ListSnippetsQuery::default();
             with_marker.pagination.direction = Direction::Asc;
-            with_marker.pagination.marker = Some(result.last().unwrap().id.clone());
+            with_marker.pagination.marker = Some(Marker::Id(result.last().unwrap().id.clone()));
             let result = storage
                 .list(with_marker)
                 .await
-                .expect("Failed to list snippets");
+                .expect("Failed to list snippets")
+                .snippets;
             assert_eq!(result.len(), 1);
             for (actual, expected) in result.iter().skip(1).zip(reference.iter()) {
                 compare_snippets(expected, actual);
@@ -654,11 +2260,13 @@ mod tests {
             let mut with_marker_backward = ListSnippetsQuery::default();
             with_marker_backward.pagination.direction = Direction::Desc;
             with_marker_backward.pagination.limit = 2;
-            with_marker_backward.pagination.marker = Some(result.last().unwrap().id.clone());
+            with_marker_backward.pagination.marker =
+                Some(Marker::Id(result.last().unwrap().id.clone()));
             let result = storage
                 .list(with_marker_backward)
                 .await
-                .expect("Failed to list snippets");
+                .expect("Failed to list snippets")
+                .snippets;
             assert_eq!(result.len(), 2);
             for (actual, expected) in result.iter().skip(1).take(2).zip(reference.iter()) {
                 compare_snippets(expected, actual);
@@ -676,4 +2284,722 @@ mod tests {
     async fn pagination_with_identical_created_at() {
         pagination(reference_snippets(Some(chrono::Utc::now()))).await;
     }
+
+    #[tokio::test]
+    async fn pagination_with_positions() {
+        with_storage(|storage| async move {
+            for snippet in reference_snippets(Some(chrono::Utc::now())) {
+                storage
+                    .create(&snippet)
+                    .await
+                    .expect("Failed to create a snippet");
+            }
+
+            let mut criteria = ListSnippetsQuery::default();
+            criteria.pagination.limit = 1;
+            let first = storage
+                .list(criteria.clone())
+                .await
+                .expect("Failed to list snippets");
+            assert_eq!(first.snippets.len(), 1);
+            assert_eq!(first.positions.len(), 1);
+            assert_eq!(first.positions[0].rank, None);
+
+            // the position of a snippet is an equivalent of its id
+            criteria.pagination.marker = Some(Marker::Id(first.snippets[0].id.clone()));
+            let by_id = storage
+                .list(criteria.clone())
+                .await
+                .expect("Failed to list snippets");
+            criteria.pagination.marker = Some(Marker::Position(first.positions[0]));
+            let by_position = storage
+                .list(criteria.clone())
+                .await
+                .expect("Failed to list snippets");
+            assert_eq!(by_id.snippets.len(), 1);
+            assert_eq!(by_id, by_position);
+
+            // the position of a snippet remains valid after its deletion
+            storage
+                .delete(&by_id.snippets[0].id)
+                .await
+                .expect("Failed to delete a snippet");
+            criteria.pagination.marker = Some(Marker::Position(by_id.positions[0]));
+            let last = storage
+                .list(criteria.clone())
+                .await
+                .expect("Failed to list snippets");
+            assert_eq!(last.snippets.len(), 1);
+            assert_ne!(last.snippets[0].id, by_id.snippets[0].id);
+            assert_ne!(last.snippets[0].id, first.snippets[0].id);
+        })
+        .await;
+    }
+
+    #[tokio::test]
+    async fn estimate_count() {
+        with_pool(|pool| async move {
+            let storage = SqlStorage {
+                pool: pool.clone(),
+                replicas: Replicas::default(),
+                waits: PoolWaits::default(),
+                min_idle: 0,
+            };
+            for snippet in reference_snippets(None) {
+                storage
+                    .create(&snippet)
+                    .await
+                    .expect("Failed to create a snippet");
+            }
+
+            // the estimates are based on the statistics of the tables
+            diesel::sql_query("ANALYZE snippets")
+                .execute(&mut pool.get().await.expect("Failed to get a connection"))
+                .await
+                .expect("Failed to analyze snippets");
+
+            let count = storage
+                .estimate_count(&ListSnippetsQuery::default())
+                .await
+                .expect("Failed to estimate the count");
+            assert_eq!(count, 3);
+
+            let by_syntax = ListSnippetsQuery {
+                syntax: Some("rust".to_string()),
+                ..Default::default()
+            };
+            let count = storage
+                .estimate_count(&by_syntax)
+                .await
+                .expect("Failed to estimate the count");
+            assert!(count <= 3, "{}", count);
+        })
+        .await;
+    }
+
+    /// Returns all snippets exported after the given checkpoint.
+    async fn export_all(storage: &dyn Storage, after: Option<Checkpoint>) -> Vec<Snippet> {
+        storage
+            .export(after)
+            .await
+            .expect("Failed to start an export")
+            .try_collect::<Vec<_>>()
+            .await
+            .expect("Failed to export snippets")
+    }
+
+    #[tokio::test]
+    async fn export() {
+        with_storage(|storage| async move {
+            // the ties of created_at are resolved by the order of insertion
+            let reference = reference_snippets(Some(chrono::Utc::now()));
+            for result in storage
+                .import(&reference)
+                .await
+                .expect("Failed to import snippets")
+            {
+                result.expect("Failed to import a snippet");
+            }
+
+            let exported = export_all(&*storage, None).await;
+            assert_eq!(exported.len(), reference.len());
+            for (actual, expected) in exported.iter().zip(reference.iter()) {
+                // only the latest changeset is exported
+                assert_eq!(
+                    actual
+                        .changesets
+                        .iter()
+                        .map(|c| (c.version, c.content.as_str()))
+                        .collect::<Vec<_>>(),
+                    expected
+                        .changesets
+                        .last()
+                        .map(|c| (c.version, c.content.as_str()))
+                        .into_iter()
+                        .collect::<Vec<_>>()
+                );
+                compare_snippets(
+                    &Snippet {
+                        changesets: vec![],
+                        ..expected.clone()
+                    },
+                    actual,
+                );
+            }
+
+            let checkpoint = |snippet: &Snippet| {
+                Some(Checkpoint {
+                    created_at: snippet.created_at.unwrap(),
+                    id: snippet.id.clone(),
+                })
+            };
+            assert_eq!(
+                export_all(&*storage, checkpoint(&exported[0])).await,
+                exported[1..]
+            );
+            assert_eq!(
+                export_all(&*storage, checkpoint(&exported[2])).await,
+                vec![]
+            );
+
+            // if the checkpoint snippet is gone, the snippets created at the
+            // same time are exported again
+            storage
+                .delete(&exported[1].id)
+                .await
+                .expect("Failed to delete a snippet");
+            assert_eq!(
+                export_all(&*storage, checkpoint(&exported[1])).await,
+                vec![exported[0].clone(), exported[2].clone()]
+            );
+        })
+        .await;
+    }
+
+    #[tokio::test]
+    async fn pool_stats() {
+        with_pool(|pool| async move {
+            let storage = SqlStorage {
+                pool,
+                replicas: Replicas::default(),
+                waits: PoolWaits::default(),
+                min_idle: 0,
+            };
+            let stats = storage.pool_stats();
+            assert_eq!(stats.checkouts(), 0);
+            assert_eq!(stats.wait_time(), Duration::ZERO);
+
+            storage
+                .list(ListSnippetsQuery::default())
+                .await
+                .expect("Failed to list snippets");
+            storage
+                .get("spam")
+                .await
+                .expect_err("Snippet must not exist");
+            assert_eq!(stats.checkouts(), 2);
+            assert_eq!(stats.size(), 1);
+        })
+        .await;
+    }
+
+    #[tokio::test]
+    async fn list_uses_indexes() {
+        with_pool(|pool| async move {
+            let storage = SqlStorage {
+                pool: pool.clone(),
+                replicas: Replicas::default(),
+                waits: PoolWaits::default(),
+                min_idle: 0,
+            };
+            for snippet in reference_snippets(None) {
+                storage
+                    .create(&snippet)
+                    .await
+                    .expect("Failed to create a snippet");
+            }
+            let newest = storage
+                .list(ListSnippetsQuery::default())
+                .await
+                .expect("Failed to list snippets")
+                .snippets;
+
+            let mut conn = pool.get().await.expect("Failed to get a connection");
+            // the tables are tiny, so sequential scans would always win
+            // otherwise. Disabling them makes the planner pick the cheapest
+            // index, if there is a usable one
+            diesel::sql_query("SET LOCAL enable_seqscan = off")
+                .execute(&mut conn)
+                .await
+                .expect("Failed to disable sequential scans");
+            let marker = Some(
+                storage
+                    .get_marker(&mut conn, &newest[0].id, None)
+                    .await
+                    .expect("Failed to get a marker"),
+            );
+
+            let by_syntax = ListSnippetsQuery {
+                syntax: Some("python".to_string()),
+                ..Default::default()
+            };
+            let by_tag = ListSnippetsQuery {
+                tags: Some(vec!["spam".to_string()]),
+                ..Default::default()
+            };
+            let by_search = ListSnippetsQuery {
+                search: Some("hello".to_string()),
+                ..Default::default()
+            };
+            for (criteria, marker, index) in [
+                (ListSnippetsQuery::default(), None, "snippets_created_at_id"),
+                (
+                    ListSnippetsQuery::default(),
+                    marker,
+                    "snippets_created_at_id",
+                ),
+                (by_syntax.clone(), None, "snippets_syntax_created_at_id"),
+                (by_syntax, marker, "snippets_syntax_created_at_id"),
+                (by_tag, None, "tags_value_snippet_id"),
+                (by_search, None, "snippets_search_vector"),
+            ] {
+                let plan = explain(&mut conn, list_snippets(criteria.clone(), marker)).await;
+                assert!(plan.contains(index), "{:?}:\n{}", criteria, plan);
+            }
+
+            let plan = explain(
+                &mut conn,
+                snippets::table
+                    .select(snippets::id)
+                    .filter(snippets::title.ilike("%world%")),
+            )
+            .await;
+            assert!(plan.contains("snippets_title_trgm"), "{}", plan);
+        })
+        .await;
+    }
+
+    #[tokio::test]
+    async fn partitioned_changesets() {
+        with_pool(|pool| async move {
+            let storage = SqlStorage {
+                pool: pool.clone(),
+                replicas: Replicas::default(),
+                waits: PoolWaits::default(),
+                min_idle: 0,
+            };
+            for snippet in reference_snippets(None) {
+                storage
+                    .create(&snippet)
+                    .await
+                    .expect("Failed to create a snippet");
+            }
+
+            let mut conn = pool.get().await.expect("Failed to get a connection");
+            // partitions are created ahead of time, so calling the function
+            // again is a no-op
+            let count_partitions = async |conn: &mut AsyncPgConnection| {
+                diesel::select(sql::<diesel::sql_types::BigInt>(
+                    "(SELECT count(*) FROM pg_inherits \
+                     WHERE inhparent = 'changesets'::regclass)",
+                ))
+                .get_result::<i64>(conn)
+                .await
+                .expect("Failed to count partitions")
+            };
+            let partitions = count_partitions(&mut conn).await;
+            assert!(partitions > 0);
+            diesel::sql_query("SELECT changesets_create_partitions()")
+                .execute(&mut conn)
+                .await
+                .expect("Failed to create partitions");
+            assert_eq!(count_partitions(&mut conn).await, partitions);
+
+            // all changesets of a snippet are stored in the same partition,
+            // and lookups by snippet id only scan that partition
+            let plan = explain(
+                &mut conn,
+                changesets::table
+                    .select(changesets::version)
+                    .filter(changesets::snippet_id.eq(1)),
+            )
+            .await;
+            assert!(plan.contains("changesets_p00000"), "{}", plan);
+            assert!(!plan.contains("changesets_p00001"), "{}", plan);
+        })
+        .await;
+    }
+
+    #[tokio::test]
+    async fn deduplicated_blobs() {
+        with_pool(|pool| async move {
+            let storage = SqlStorage {
+                pool: pool.clone(),
+                replicas: Replicas::default(),
+                waits: PoolWaits::default(),
+                min_idle: 0,
+            };
+            let count_blobs = || async {
+                blobs::table
+                    .count()
+                    .get_result::<i64>(&mut pool.get().await.expect("Failed to get a connection"))
+                    .await
+                    .expect("Failed to count blobs")
+            };
+
+            // identical contents are stored once
+            let reference = reference_snippets(None);
+            let mut copy = reference[0].clone();
+            copy.id = Snippet::random_id(8);
+            for snippet in [&reference[0], &copy] {
+                storage
+                    .create(snippet)
+                    .await
+                    .expect("Failed to create a snippet");
+            }
+            assert_eq!(count_blobs().await, 2);
+
+            let mut copies = reference.clone();
+            for snippet in copies.iter_mut() {
+                snippet.id = Snippet::random_id(8);
+            }
+            let results = storage
+                .import(&copies)
+                .await
+                .expect("Failed to import snippets");
+            assert!(results.iter().all(|r| r.is_ok()));
+            assert_eq!(count_blobs().await, 4);
+
+            // new contents are stored once too
+            let changes = SnippetChanges {
+                content: Some("print('Hi')".to_string()),
+                ..Default::default()
+            };
+            let updated = storage
+                .update(&copy.id, &changes)
+                .await
+                .expect("Failed to update a snippet");
+            assert_eq!(count_blobs().await, 5);
+            assert_eq!(
+                storage.get(&updated.id).await.unwrap().changesets[2].content,
+                "print('Hi')"
+            );
+
+            // the blobs are deleted together with the last snippet that
+            // references them
+            storage.delete(&updated.id).await.unwrap();
+            assert_eq!(count_blobs().await, 4);
+            storage.delete(&reference[0].id).await.unwrap();
+            assert_eq!(count_blobs().await, 4);
+            for snippet in copies.iter() {
+                storage.delete(&snippet.id).await.unwrap();
+            }
+            assert_eq!(count_blobs().await, 0);
+        })
+        .await;
+    }
+
+    #[tokio::test]
+    async fn delete_concurrently_with_create() {
+        if let Ok(database_url) = std::env::var("ROCKET_DATABASE_URL") {
+            // the transactions must see each other's changes, so, unlike
+            // with_pool(), the changes are committed
+            let storage = SqlStorage::with_options(
+                &database_url,
+                PoolOptions {
+                    max_size: 2,
+                    ..Default::default()
+                },
+            )
+            .unwrap();
+
+            let content = format!("print('{}')", Snippet::random_id(16));
+            let hash = blob_hash(&content);
+            let original =
+                Snippet::new(None, None, vec![Changeset::new(0, content.clone())], vec![]);
+            storage.create(&original).await.unwrap();
+
+            // a copy of the snippet is created, and the original is deleted
+            // after the blob has been found to be stored already, but before
+            // the changeset of the copy that references it is inserted
+            let copy_id = Snippet::random_id(8);
+            let mut conn = storage.pool.get().await.unwrap();
+            let create = conn.transaction::<_, StorageError, _>(async |conn| {
+                storage
+                    .insert_blobs(conn, &[(hash.clone(), content.as_str())])
+                    .await?;
+                tokio::time::sleep(Duration::from_millis(200)).await;
+
+                let snippet_id = diesel::insert_into(snippets::table)
+                    .values(snippets::slug.eq(&copy_id))
+                    .returning(snippets::id)
+                    .get_result::<i32>(conn)
+                    .await?;
+                diesel::insert_into(changesets::table)
+                    .values((
+                        changesets::snippet_id.eq(snippet_id),
+                        changesets::version.eq(0),
+                        changesets::blob_hash.eq(&hash),
+                    ))
+                    .execute(conn)
+                    .await?;
+                Ok(())
+            });
+            let delete = async {
+                tokio::time::sleep(Duration::from_millis(100)).await;
+                storage.delete(&original.id).await
+            };
+            let (created, deleted) = future::join(create, delete).await;
+            created.unwrap();
+            deleted.unwrap();
+            drop(conn);
+
+            assert_eq!(
+                storage.get(&copy_id).await.unwrap().changesets[0].content,
+                content
+            );
+            storage.delete(&copy_id).await.unwrap();
+        }
+    }
+
+    #[tokio::test]
+    async fn versions() {
+        with_pool(|pool| async move {
+            let storage = SqlStorage {
+                pool: pool.clone(),
+                replicas: Replicas::default(),
+                waits: PoolWaits::default(),
+                min_idle: 0,
+            };
+            let content = |version: usize| {
+                (0..50)
+                    .map(|i| {
+                        if i == version {
+                            format!("print('v{}')\n", version)
+                        } else {
+                            format!("print({})\n", i)
+                        }
+                    })
+                    .collect::<String>()
+            };
+
+            let snippet = Snippet::new(None, None, vec![Changeset::new(0, content(0))], vec![]);
+            storage
+                .create(&snippet)
+                .await
+                .expect("Failed to create a snippet");
+            // every new content is appended as a new version
+            for version in 1..40 {
+                let changes = SnippetChanges {
+                    content: Some(content(version)),
+                    ..Default::default()
+                };
+                let updated = storage
+                    .update(&snippet.id, &changes)
+                    .await
+                    .expect("Failed to update a snippet");
+                assert_eq!(updated.changesets.len(), version + 1);
+            }
+
+            // every version is rebuilt from the deltas
+            let stored = storage.get(&snippet.id).await.unwrap();
+            for (version, changeset) in stored.changesets.iter().enumerate() {
+                assert_eq!(changeset.version, version);
+                assert_eq!(changeset.content, content(version));
+                assert_eq!(
+                    storage
+                        .get_version(&snippet.id, version)
+                        .await
+                        .unwrap()
+                        .changesets,
+                    vec![changeset.clone()]
+                );
+            }
+            assert!(match storage.get_version(&snippet.id, 40).await {
+                Err(StorageError::NotFound { id }) => id == snippet.id,
+                _ => false,
+            });
+
+            // only the keyframes and the latest version are stored in full,
+            // and the contents replaced by deltas are deleted
+            let mut conn = pool.get().await.expect("Failed to get a connection");
+            let full = changesets::table
+                .filter(changesets::blob_hash.is_not_null())
+                .select(changesets::version)
+                .order_by(changesets::version)
+                .load::<i32>(&mut conn)
+                .await
+                .expect("Failed to load changesets");
+            assert_eq!(full, vec![15, 31, 39]);
+            assert_eq!(
+                blobs::table
+                    .count()
+                    .get_result::<i64>(&mut conn)
+                    .await
+                    .expect("Failed to count blobs"),
+                3
+            );
+            drop(conn);
+
+            // the same content does not add a version, and the other fields
+            // can be updated without adding one
+            let changes = SnippetChanges {
+                title: Some(Some("spam".to_string())),
+                content: Some(content(39)),
+                ..Default::default()
+            };
+            let updated = storage
+                .update(&snippet.id, &changes)
+                .await
+                .expect("Failed to update a snippet");
+            assert_eq!(updated.title.as_deref(), Some("spam"));
+            assert_eq!(updated.changesets, stored.changesets);
+
+            // the fields that are not changed keep their latest values
+            let changes = SnippetChanges {
+                tags: Some(vec!["eggs".to_string()]),
+                ..Default::default()
+            };
+            let updated = storage
+                .update(&snippet.id, &changes)
+                .await
+                .expect("Failed to update a snippet");
+            assert_eq!(updated.title.as_deref(), Some("spam"));
+            assert_eq!(updated.tags, vec!["eggs".to_string()]);
+            assert_eq!(updated.changesets, stored.changesets);
+
+            assert!(match storage.update("eggs", &changes).await {
+                Err(StorageError::NotFound { id }) => id == "eggs",
+                _ => false,
+            });
+        })
+        .await;
+    }
+
+    #[tokio::test]
+    async fn pool_options() {
+        if let Ok(database_url) = std::env::var("ROCKET_DATABASE_URL") {
+            let storage = SqlStorage::with_options(
+                &database_url,
+                PoolOptions {
+                    max_size: 1,
+                    wait_timeout: Some(Duration::from_millis(50)),
+                    statement_timeout: Some(Duration::from_secs(5)),
+                    ..Default::default()
+                },
+            )
+            .unwrap();
+
+            let mut conn = storage.pool.get().await.unwrap();
+            let statement_timeout =
+                diesel::select(sql::<Text>("current_setting('statement_timeout')"))
+                    .get_result::<String>(&mut conn)
+                    .await
+                    .unwrap();
+            assert_eq!(statement_timeout, "5s");
+
+            // the only connection is busy, so the request must fail fast
+            let started = std::time::Instant::now();
+            match storage.get("spam").await {
+                Err(StorageError::Unavailable(_)) => {}
+                _ => panic!("unexpected result"),
+            };
+            assert!(started.elapsed() < Duration::from_secs(1));
+
+            drop(conn);
+            match storage.get("spam").await {
+                Err(StorageError::NotFound { id }) => assert_eq!(id, "spam"),
+                _ => panic!("unexpected result"),
+            };
+        }
+    }
+
+    #[tokio::test]
+    async fn health_check() {
+        // nothing listens on port 1
+        let storage = SqlStorage::with_options(
+            "postgres://127.0.0.1:1/spam",
+            PoolOptions {
+                connect_timeout: Some(Duration::from_millis(500)),
+                min_idle: 2,
+                ..Default::default()
+            },
+        )
+        .unwrap();
+        assert!(storage.health_check().check().await.is_err());
+        assert!(storage.health_check().warm_up().await.is_err());
+
+        if let Ok(database_url) = std::env::var("ROCKET_DATABASE_URL") {
+            let storage = SqlStorage::with_options(
+                &database_url,
+                PoolOptions {
+                    max_size: 4,
+                    min_idle: 2,
+                    ..Default::default()
+                },
+            )
+            .unwrap();
+
+            storage.health_check().warm_up().await.unwrap();
+            storage.health_check().check().await.unwrap();
+            // the connections that were opened are idle
+            let stats = storage.pool_stats();
+            assert!(stats.available() >= 2);
+        }
+    }
+
+    #[test]
+    fn replica_errors_retried_on_primary() {
+        let database_error =
+            |kind| StorageError::from(DatabaseError(kind, Box::new(String::from("spam"))));
+
+        assert!(retry_on_primary(&StorageError::NotFound {
+            id: "spam".to_string()
+        }));
+        assert!(retry_on_primary(&StorageError::Unavailable(Box::new(
+            PoolError::Closed
+        ))));
+        assert!(retry_on_primary(&database_error(
+            DatabaseErrorKind::ClosedConnection
+        )));
+
+        assert!(!retry_on_primary(&database_error(
+            DatabaseErrorKind::Unknown
+        )));
+        assert!(!retry_on_primary(&StorageError::InternalError(Box::new(
+            NotFound
+        ))));
+    }
+
+    #[test]
+    fn missing_partition_detected() {
+        let database_error = |kind, message: &str| {
+            StorageError::from(DatabaseError(kind, Box::new(message.to_string())))
+        };
+
+        assert!(missing_partition(&database_error(
+            DatabaseErrorKind::CheckViolation,
+            "no partition of relation \"changesets\" found for row"
+        )));
+
+        assert!(!missing_partition(&database_error(
+            DatabaseErrorKind::CheckViolation,
+            "new row for relation \"changesets\" violates check constraint"
+        )));
+        assert!(!missing_partition(&database_error(
+            DatabaseErrorKind::UniqueViolation,
+            "no partition of relation \"changesets\" found for row"
+        )));
+        assert!(!missing_partition(&StorageError::NotFound {
+            id: "spam".to_string()
+        }));
+    }
+
+    #[tokio::test]
+    async fn unavailable_replica() {
+        if let Ok(database_url) = std::env::var("ROCKET_DATABASE_URL") {
+            // nothing listens on port 1, so connections to the replica fail
+            let storage = SqlStorage::with_replicas(
+                &database_url,
+                PoolOptions {
+                    connect_timeout: Some(Duration::from_millis(500)),
+                    ..Default::default()
+                },
+                ReplicaOptions {
+                    urls: vec!["postgres://127.0.0.1:1/spam".to_string()],
+                    ..Default::default()
+                },
+            )
+            .unwrap();
+
+            // reads fall back to the primary
+            for _ in 0..2 {
+                match storage.get("spam").await {
+                    Err(StorageError::NotFound { id }) => assert_eq!(id, "spam"),
+                    _ => panic!("unexpected result"),
+                };
+            }
+            assert!(storage.replicas.connection().await.is_none());
+        }
+    }
 }
@@ -1,8 +1,9 @@
-use std::collections::BTreeMap;
-use std::convert::From;
+use std::convert::TryFrom;
 
 use chrono::{DateTime, Utc};
+use serde::Deserialize;
 
+use super::delta::{self, Op};
 use crate::storage::models::{Changeset, Snippet};
 
 #[derive(Queryable)]
@@ -15,52 +16,101 @@ pub struct SnippetRow {
     pub updated_at: DateTime<Utc>,
 }
 
-#[derive(Queryable)]
+/// A changeset row aggregated into a JSON object by the database. The
+/// content is not set if the changeset is stored as a delta.
+#[derive(Deserialize)]
 pub struct ChangesetRow {
-    #[allow(dead_code)]
-    pub id: i32,
-    pub snippet_id: i32,
     pub version: i32,
-    pub content: String,
+    pub content: Option<String>,
+    pub delta: Option<Vec<Op>>,
     pub created_at: DateTime<Utc>,
     pub updated_at: DateTime<Utc>,
 }
 
-#[derive(Queryable)]
-pub struct TagRow {
-    #[allow(dead_code)]
-    pub id: i32,
-    pub snippet_id: i32,
-    pub value: String,
+/// Returns the changesets of the given rows sorted by version. The contents
+/// of the changesets stored as deltas are rebuilt from the following ones,
+/// so the last row must be stored in full.
+pub fn rebuild_changesets(
+    mut rows: Vec<ChangesetRow>,
+) -> Result<Vec<Changeset>, serde_json::Error> {
+    rows.sort_by_key(|row| std::cmp::Reverse(row.version));
+
+    let mut changesets: Vec<Changeset> = Vec::with_capacity(rows.len());
+    for row in rows {
+        let content = match (row.content, row.delta) {
+            (Some(content), _) => content,
+            (None, Some(delta)) => changesets
+                .last()
+                .and_then(|newer| delta::apply(&newer.content, &delta))
+                .ok_or_else(|| {
+                    <serde_json::Error as serde::de::Error>::custom(format!(
+                        "Failed to rebuild the content of version {}",
+                        row.version
+                    ))
+                })?,
+            (None, None) => {
+                return Err(serde::de::Error::custom(format!(
+                    "Changeset {} has neither content nor delta",
+                    row.version
+                )))
+            }
+        };
+
+        let mut changeset = Changeset::new(row.version as usize, content);
+        changeset.updated_at = Some(row.updated_at);
+        changeset.created_at = Some(row.created_at);
+        changesets.push(changeset);
+    }
+    changesets.reverse(); // by version, ascending
+
+    Ok(changesets)
 }
 
-impl From<(SnippetRow, Vec<ChangesetRow>, Vec<TagRow>)> for Snippet {
-    fn from(parts: (SnippetRow, Vec<ChangesetRow>, Vec<TagRow>)) -> Self {
-        let (snippet_row, changeset_rows, tag_rows) = parts;
+/// A snippet row along with a JSON array of its changesets, the list of its
+/// tags, and its relevance to the search query (if there is one).
+pub type SnippetWithRelations = (SnippetRow, serde_json::Value, Vec<String>, Option<f32>);
+
+impl TryFrom<SnippetWithRelations> for Snippet {
+    type Error = serde_json::Error;
+
+    fn try_from(parts: SnippetWithRelations) -> Result<Self, Self::Error> {
+        let (snippet_row, changeset_rows, tags, _) = parts;
+
+        let changesets =
+            rebuild_changesets(serde_json::from_value::<Vec<ChangesetRow>>(changeset_rows)?)?;
+
+        let mut snippet = Snippet::new(snippet_row.title, snippet_row.syntax, changesets, tags);
+        snippet.id = snippet_row.slug;
+        snippet.created_at = Some(snippet_row.created_at);
+        snippet.updated_at = Some(snippet_row.updated_at);
 
-        let tags: Vec<String> = tag_rows.into_iter().map(|t| t.value).collect();
-        let mut changesets: Vec<Changeset> = changeset_rows
+        Ok(snippet)
+    }
+}
+
+/// The version, the content, and the creation and modification dates of a
+/// changeset.
+pub type ChangesetTuple = (i32, String, DateTime<Utc>, DateTime<Utc>);
+
+/// A snippet row along with its latest changeset (if there is one).
+pub type SnippetWithLatestChangeset = (SnippetRow, Option<ChangesetTuple>);
+
+impl From<SnippetWithLatestChangeset> for Snippet {
+    fn from(parts: SnippetWithLatestChangeset) -> Self {
+        let (snippet_row, changeset) = parts;
+
+        let changesets = changeset
+            .map(|(version, content, created_at, updated_at)| {
+                let mut changeset = Changeset::new(version as usize, content);
+                changeset.created_at = Some(created_at);
+                changeset.updated_at = Some(updated_at);
+
+                changeset
+            })
             .into_iter()
-            .map(
-                |ChangesetRow {
-                     id: _,
-                     snippet_id: _,
-                     version,
-                     content,
-                     created_at,
-                     updated_at,
-                 }| {
-                    let mut changeset = Changeset::new(version as usize, content);
-                    changeset.updated_at = Some(updated_at);
-                    changeset.created_at = Some(created_at);
-
-                    changeset
-                },
-            )
             .collect();
-        changesets.sort(); // by version, ascending
 
-        let mut snippet = Snippet::new(snippet_row.title, snippet_row.syntax, changesets, tags);
+        let mut snippet = Snippet::new(snippet_row.title, snippet_row.syntax, changesets, vec![]);
         snippet.id = snippet_row.slug;
         snippet.created_at = Some(snippet_row.created_at);
         snippet.updated_at = Some(snippet_row.updated_at);
@@ -69,40 +119,58 @@ impl From<(SnippetRow, Vec<ChangesetRow>, Vec<TagRow>)> for Snippet {
     }
 }
 
-pub fn combine_rows(
-    snippets: Vec<SnippetRow>,
-    changesets: Vec<ChangesetRow>,
-    tags: Vec<TagRow>,
-) -> Vec<Snippet> {
-    let mut changesets_by_snippet_id = BTreeMap::new();
-    for changeset in changesets {
-        changesets_by_snippet_id
-            .entry(changeset.snippet_id)
-            .or_insert_with(Vec::new)
-            .push(changeset);
-    }
+/// The version, the content (or the delta), and the creation and
+/// modification dates of a changeset.
+pub type ChangesetVersionTuple = (
+    i32,
+    Option<String>,
+    Option<serde_json::Value>,
+    DateTime<Utc>,
+    DateTime<Utc>,
+);
 
-    let mut tags_by_snippet_id = BTreeMap::new();
-    for tag in tags {
-        tags_by_snippet_id
-            .entry(tag.snippet_id)
-            .or_insert_with(Vec::new)
-            .push(tag);
+/// A snippet row along with one of its changesets.
+pub type SnippetWithChangeset = (SnippetRow, ChangesetVersionTuple);
+
+/// Returns the snippet with only the changeset of the given version and
+/// without tags. The rows must include the changesets that follow the
+/// version up to the first one stored in full, so that its content can be
+/// rebuilt. Returns None if there is no such version among the rows.
+pub fn snippet_version(
+    rows: Vec<SnippetWithChangeset>,
+    version: usize,
+) -> Result<Option<Snippet>, serde_json::Error> {
+    let mut snippet_row = None;
+    let mut changeset_rows = Vec::with_capacity(rows.len());
+    for (row, (version, content, delta, created_at, updated_at)) in rows {
+        changeset_rows.push(ChangesetRow {
+            version,
+            content,
+            delta: delta.map(serde_json::from_value).transpose()?,
+            created_at,
+            updated_at,
+        });
+        snippet_row = Some(row);
     }
 
-    snippets
+    let snippet_row = match snippet_row {
+        Some(snippet_row) => snippet_row,
+        None => return Ok(None),
+    };
+    let changesets = rebuild_changesets(changeset_rows)?
         .into_iter()
-        .map(|snippet| {
-            let snippet_id = snippet.id;
-            Snippet::from((
-                snippet,
-                changesets_by_snippet_id
-                    .remove(&snippet_id)
-                    .unwrap_or_default(),
-                tags_by_snippet_id.remove(&snippet_id).unwrap_or_default(),
-            ))
-        })
-        .collect()
+        .filter(|changeset| changeset.version == version)
+        .collect::<Vec<_>>();
+    if changesets.is_empty() {
+        return Ok(None);
+    }
+
+    let mut snippet = Snippet::new(snippet_row.title, snippet_row.syntax, changesets, vec![]);
+    snippet.id = snippet_row.slug;
+    snippet.created_at = Some(snippet_row.created_at);
+    snippet.updated_at = Some(snippet_row.updated_at);
+
+    Ok(Some(snippet))
 }
 
 #[cfg(test)]
@@ -110,11 +178,11 @@ mod tests {
     use super::*;
 
     #[test]
-    fn test_from() {
+    fn test_try_from() {
         let dt1 = chrono::DateTime::parse_from_rfc3339("2020-08-09T10:39:57+00:00")
             .unwrap()
             .with_timezone(&Utc);
-        let dt2 = chrono::DateTime::parse_from_rfc3339("2020-08-10T10:39:57+00:00")
+        let dt2 = chrono::DateTime::parse_from_rfc3339("2020-08-10T10:39:57.123456+00:00")
             .unwrap()
             .with_timezone(&Utc);
 
@@ -126,38 +194,24 @@ mod tests {
             created_at: dt1,
             updated_at: dt2,
         };
-        let changeset_rows = vec![
-            ChangesetRow {
-                id: 2,
-                snippet_id: 42,
-                version: 2,
-                content: "print('Hello, World!')".to_string(),
-                created_at: dt2,
-                updated_at: dt2,
-            },
-            ChangesetRow {
-                id: 1,
-                snippet_id: 42,
-                version: 1,
-                content: "print('Hello!')".to_string(),
-                created_at: dt1,
-                updated_at: dt1,
-            },
-        ];
-        let tag_rows = vec![
-            TagRow {
-                id: 1,
-                snippet_id: 42,
-                value: "spam".to_string(),
+        // this is how PostgreSQL serializes the rows to JSON
+        let changeset_rows = serde_json::json!([
+            {
+                "version": 2,
+                "content": "print('Hello, World!')",
+                "created_at": "2020-08-10T13:39:57.123456+03:00",
+                "updated_at": "2020-08-10T10:39:57.123456+00:00",
             },
-            TagRow {
-                id: 2,
-                snippet_id: 42,
-                value: "eggs".to_string(),
+            {
+                "version": 1,
+                "content": "print('Hello!')",
+                "created_at": "2020-08-09T10:39:57+00:00",
+                "updated_at": "2020-08-09T10:39:57+00:00",
             },
-        ];
+        ]);
+        let tags = vec!["spam".to_string(), "eggs".to_string()];
 
-        let actual = Snippet::from((snippet_row, changeset_rows, tag_rows));
+        let actual = Snippet::try_from((snippet_row, changeset_rows, tags, None)).unwrap();
         let expected = Snippet {
             id: "spam".to_string(),
             title: Some("Hello".to_string()),
@@ -185,145 +239,103 @@ mod tests {
     }
 
     #[test]
-    fn test_combine_rows() {
-        let dt1 = chrono::DateTime::parse_from_rfc3339("2020-08-09T10:39:57+00:00")
+    fn test_try_from_malformed_changesets() {
+        let dt = chrono::DateTime::parse_from_rfc3339("2020-08-09T10:39:57+00:00")
             .unwrap()
             .with_timezone(&Utc);
-        let dt2 = chrono::DateTime::parse_from_rfc3339("2020-08-10T10:39:57+00:00")
+
+        let snippet_row = SnippetRow {
+            id: 42,
+            slug: "spam".to_string(),
+            title: None,
+            syntax: None,
+            created_at: dt,
+            updated_at: dt,
+        };
+        let changeset_rows = serde_json::json!([{"version": 1}]);
+
+        assert!(Snippet::try_from((snippet_row, changeset_rows, vec![], None)).is_err());
+    }
+
+    #[test]
+    fn test_try_from_deltas() {
+        let dt = chrono::DateTime::parse_from_rfc3339("2020-08-09T10:39:57+00:00")
             .unwrap()
             .with_timezone(&Utc);
+        let snippet_row = || SnippetRow {
+            id: 42,
+            slug: "spam".to_string(),
+            title: None,
+            syntax: None,
+            created_at: dt,
+            updated_at: dt,
+        };
 
-        let snippet_rows = vec![
-            SnippetRow {
-                id: 42,
-                slug: "spam".to_string(),
-                title: Some("Hello".to_string()),
-                syntax: Some("python".to_string()),
-                created_at: dt1,
-                updated_at: dt2,
-            },
-            SnippetRow {
-                id: 43,
-                slug: "eggs".to_string(),
-                title: Some("Foo".to_string()),
-                syntax: Some("rust".to_string()),
-                created_at: dt1,
-                updated_at: dt2,
-            },
-            SnippetRow {
-                id: 44,
-                slug: "bar".to_string(),
-                title: Some("Bar".to_string()),
-                syntax: Some("cpp".to_string()),
-                created_at: dt1,
-                updated_at: dt2,
-            },
-        ];
-        let changeset_rows = vec![
-            ChangesetRow {
-                id: 4,
-                snippet_id: 44,
-                version: 1,
-                content: "std::cout << 42;".to_string(),
-                created_at: dt1,
-                updated_at: dt1,
-            },
-            ChangesetRow {
-                id: 2,
-                snippet_id: 42,
-                version: 2,
-                content: "print('Hello, World!')".to_string(),
-                created_at: dt2,
-                updated_at: dt2,
+        // each delta is applied to the content of the following version
+        let changeset_rows = serde_json::json!([
+            {
+                "version": 3,
+                "content": "print('Hello')\nprint('World')\n",
+                "created_at": "2020-08-09T10:39:57+00:00",
+                "updated_at": "2020-08-09T10:39:57+00:00",
             },
-            ChangesetRow {
-                id: 1,
-                snippet_id: 42,
-                version: 1,
-                content: "print('Hello!')".to_string(),
-                created_at: dt1,
-                updated_at: dt1,
+            {
+                "version": 1,
+                "delta": [[7, 15]],
+                "created_at": "2020-08-09T10:39:57+00:00",
+                "updated_at": "2020-08-09T10:39:57+00:00",
             },
-            ChangesetRow {
-                id: 3,
-                snippet_id: 43,
-                version: 1,
-                content: "println!(42);".to_string(),
-                created_at: dt1,
-                updated_at: dt1,
+            {
+                "version": 2,
+                "delta": ["# spam\n", [0, 15]],
+                "created_at": "2020-08-09T10:39:57+00:00",
+                "updated_at": "2020-08-09T10:39:57+00:00",
             },
-        ];
-        let tag_rows = vec![
-            TagRow {
-                id: 1,
-                snippet_id: 42,
-                value: "spam".to_string(),
-            },
-            TagRow {
-                id: 2,
-                snippet_id: 42,
-                value: "eggs".to_string(),
-            },
-            TagRow {
-                id: 3,
-                snippet_id: 44,
-                value: "bar".to_string(),
-            },
-        ];
-
-        let actual = combine_rows(snippet_rows, changeset_rows, tag_rows);
-        let expected = vec![
-            Snippet {
-                id: "spam".to_string(),
-                title: Some("Hello".to_string()),
-                syntax: Some("python".to_string()),
-                changesets: vec![
-                    Changeset {
-                        version: 1,
-                        content: "print('Hello!')".to_string(),
-                        created_at: Some(dt1),
-                        updated_at: Some(dt1),
-                    },
-                    Changeset {
-                        version: 2,
-                        content: "print('Hello, World!')".to_string(),
-                        created_at: Some(dt2),
-                        updated_at: Some(dt2),
-                    },
-                ],
-                tags: vec!["spam".to_string(), "eggs".to_string()],
-                created_at: Some(dt1),
-                updated_at: Some(dt2),
-            },
-            Snippet {
-                id: "eggs".to_string(),
-                title: Some("Foo".to_string()),
-                syntax: Some("rust".to_string()),
-                changesets: vec![Changeset {
-                    version: 1,
-                    content: "println!(42);".to_string(),
-                    created_at: Some(dt1),
-                    updated_at: Some(dt1),
-                }],
-                tags: vec![],
-                created_at: Some(dt1),
-                updated_at: Some(dt2),
-            },
-            Snippet {
-                id: "bar".to_string(),
-                title: Some("Bar".to_string()),
-                syntax: Some("cpp".to_string()),
-                changesets: vec![Changeset {
-                    version: 1,
-                    content: "std::cout << 42;".to_string(),
-                    created_at: Some(dt1),
-                    updated_at: Some(dt1),
-                }],
-                tags: vec!["bar".to_string()],
-                created_at: Some(dt1),
-                updated_at: Some(dt2),
-            },
-        ];
-        assert_eq!(actual, expected);
+        ]);
+        let actual = Snippet::try_from((snippet_row(), changeset_rows, vec![], None)).unwrap();
+        assert_eq!(
+            actual
+                .changesets
+                .iter()
+                .map(|c| (c.version, c.content.as_str()))
+                .collect::<Vec<_>>(),
+            vec![
+                (1, "print('Hello')\n"),
+                (2, "# spam\nprint('Hello')\n"),
+                (3, "print('Hello')\nprint('World')\n"),
+            ]
+        );
+
+        // the latest version must be stored in full
+        let changeset_rows = serde_json::json!([{
+            "version": 1,
+            "delta": [[0, 15]],
+            "created_at": "2020-08-09T10:39:57+00:00",
+            "updated_at": "2020-08-09T10:39:57+00:00",
+        }]);
+        assert!(Snippet::try_from((snippet_row(), changeset_rows, vec![], None)).is_err());
+
+        // a single version is rebuilt from the ones that follow it
+        let rows = || {
+            vec![
+                (
+                    snippet_row(),
+                    (2, None, Some(serde_json::json!(["eggs"])), dt, dt),
+                ),
+                (snippet_row(), (3, Some("spam".to_string()), None, dt, dt)),
+            ]
+        };
+        let snippet = snippet_version(rows(), 2).unwrap().unwrap();
+        assert_eq!(
+            snippet.changesets,
+            vec![{
+                let mut changeset = Changeset::new(2, "eggs".to_string());
+                changeset.created_at = Some(dt);
+                changeset.updated_at = Some(dt);
+                changeset
+            }]
+        );
+        assert_eq!(snippet_version(rows(), 1).unwrap(), None);
+        assert_eq!(snippet_version(vec![], 1).unwrap(), None);
     }
 }
@@ -0,0 +1,229 @@
+//! Routing of read-only queries to read replicas of the database.
+//!
+//! Replicas lag behind the primary, so a client that has just modified a
+//! snippet could read its previous state back from a replica. To prevent
+//! that, all reads go to the primary for a short window after every write.
+//! The storage has no notion of a client session, so the window is global.
+
+use std::sync::atomic::{AtomicBool, AtomicUsize, Ordering};
+use std::sync::{Arc, Mutex};
+use std::time::{Duration, Instant};
+
+use diesel::prelude::*;
+use diesel::sql_types::Integer;
+use diesel_async::pooled_connection::deadpool::{Object, Pool, PoolError};
+use diesel_async::{AsyncPgConnection, RunQueryDsl};
+use rocket::tokio;
+
+/// How long a health check may take before the replica is considered
+/// unhealthy.
+const HEALTH_CHECK_TIMEOUT: Duration = Duration::from_secs(1);
+
+/// Settings of read replicas of the database.
+#[derive(Clone, Debug)]
+pub struct ReplicaOptions {
+    /// Connection strings of the replicas.
+    pub urls: Vec<String>,
+    /// Reads go to the primary for this long after a write.
+    pub read_your_writes_window: Duration,
+    /// How often the replicas are checked for availability.
+    pub health_check_interval: Duration,
+}
+
+impl Default for ReplicaOptions {
+    fn default() -> Self {
+        Self {
+            urls: Vec::new(),
+            read_your_writes_window: Duration::from_secs(2),
+            health_check_interval: Duration::from_secs(5),
+        }
+    }
+}
+
+struct Replica {
+    pool: Pool<AsyncPgConnection>,
+    healthy: AtomicBool,
+}
+
+/// A set of read replicas. Reads are spread across the healthy replicas in a
+/// round-robin fashion.
+pub(super) struct Replicas {
+    replicas: Arc<Vec<Replica>>,
+    next: AtomicUsize,
+    read_your_writes_window: Duration,
+    last_write: Mutex<Option<Instant>>,
+}
+
+impl Default for Replicas {
+    fn default() -> Self {
+        Replicas::new(Vec::new(), Duration::ZERO)
+    }
+}
+
+impl Replicas {
+    /// Returns a new set of replicas. All of them are assumed to be healthy
+    /// until proven otherwise.
+    pub fn new(pools: Vec<Pool<AsyncPgConnection>>, read_your_writes_window: Duration) -> Self {
+        let replicas = pools
+            .into_iter()
+            .map(|pool| Replica {
+                pool,
+                healthy: AtomicBool::new(true),
+            })
+            .collect();
+
+        Self {
+            replicas: Arc::new(replicas),
+            next: AtomicUsize::new(0),
+            read_your_writes_window,
+            last_write: Mutex::new(None),
+        }
+    }
+
+    /// Periodically check if the replicas accept connections and queries, and
+    /// take the ones that don't out of rotation until they recover. Must be
+    /// called from within a Tokio runtime.
+    pub fn spawn_health_checks(&self, interval: Duration) {
+        if self.replicas.is_empty() {
+            return;
+        }
+
+        let replicas = Arc::clone(&self.replicas);
+        tokio::spawn(async move {
+            let mut ticker = tokio::time::interval(interval);
+            while !replicas.iter().all(|replica| replica.pool.is_closed()) {
+                ticker.tick().await;
+                for (index, replica) in replicas.iter().enumerate() {
+                    let healthy = tokio::time::timeout(HEALTH_CHECK_TIMEOUT, check(&replica.pool))
+                        .await
+                        .unwrap_or(false);
+                    if replica.healthy.swap(healthy, Ordering::Relaxed) != healthy {
+                        if healthy {
+                            info!(replica = index, "Database replica is back in rotation");
+                        } else {
+                            warn!(replica = index, "Database replica is taken out of rotation");
+                        }
+                    }
+                }
+            }
+        });
+    }
+
+    /// Record that the primary has been modified.
+    pub fn written(&self) {
+        if !self.replicas.is_empty() {
+            *self
+                .last_write
+                .lock()
+                .unwrap_or_else(|poisoned| poisoned.into_inner()) = Some(Instant::now());
+        }
+    }
+
+    /// Returns the index of the replica the next read should go to, or None
+    /// if it must go to the primary.
+    fn pick(&self) -> Option<usize> {
+        let last_write = *self
+            .last_write
+            .lock()
+            .unwrap_or_else(|poisoned| poisoned.into_inner());
+        if last_write.is_some_and(|at| at.elapsed() < self.read_your_writes_window) {
+            return None;
+        }
+
+        let start = self.next.fetch_add(1, Ordering::Relaxed);
+        (0..self.replicas.len())
+            .map(|offset| (start + offset) % self.replicas.len())
+            .find(|index| self.replicas[*index].healthy.load(Ordering::Relaxed))
+    }
+
+    /// Returns a connection to a healthy replica, or None if the read must go
+    /// to the primary instead.
+    pub async fn connection(&self) -> Option<Object<AsyncPgConnection>> {
+        let index = self.pick()?;
+        let replica = &self.replicas[index];
+        match replica.pool.get().await {
+            Ok(conn) => Some(conn),
+            // a busy replica is still healthy, but it's better to serve the
+            // request from the primary than to make the client wait
+            Err(PoolError::Timeout(_)) => None,
+            Err(e) => {
+                warn!(
+                    replica = index,
+                    "Database replica is taken out of rotation: {}", e
+                );
+                replica.healthy.store(false, Ordering::Relaxed);
+                None
+            }
+        }
+    }
+}
+
+/// Returns true if the database accepts connections and queries.
+async fn check(pool: &Pool<AsyncPgConnection>) -> bool {
+    match pool.get().await {
+        Ok(mut conn) => diesel::select(1.into_sql::<Integer>())
+            .get_result::<i32>(&mut conn)
+            .await
+            .is_ok(),
+        Err(_) => false,
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use diesel_async::pooled_connection::AsyncDieselConnectionManager;
+
+    use super::*;
+
+    fn replicas(count: usize, read_your_writes_window: Duration) -> Replicas {
+        // pools do not connect until a connection is requested
+        let pools = (0..count)
+            .map(|_| {
+                Pool::builder(AsyncDieselConnectionManager::new(
+                    "postgres://localhost/spam",
+                ))
+                .build()
+                .unwrap()
+            })
+            .collect();
+
+        Replicas::new(pools, read_your_writes_window)
+    }
+
+    #[test]
+    fn no_replicas() {
+        let replicas = Replicas::default();
+        assert_eq!(replicas.pick(), None);
+
+        replicas.written();
+        assert_eq!(replicas.pick(), None);
+    }
+
+    #[test]
+    fn round_robin() {
+        let replicas = replicas(3, Duration::from_secs(60));
+        let picked: Vec<_> = (0..4).map(|_| replicas.pick()).collect();
+        assert_eq!(picked, vec![Some(0), Some(1), Some(2), Some(0)]);
+
+        // unhealthy replicas are skipped
+        replicas.replicas[1].healthy.store(false, Ordering::Relaxed);
+        let picked: Vec<_> = (0..3).map(|_| replicas.pick()).collect();
+        assert_eq!(picked, vec![Some(2), Some(2), Some(0)]);
+
+        replicas.replicas[0].healthy.store(false, Ordering::Relaxed);
+        replicas.replicas[2].healthy.store(false, Ordering::Relaxed);
+        assert_eq!(replicas.pick(), None);
+    }
+
+    #[test]
+    fn read_your_writes() {
+        let replicas = replicas(1, Duration::from_millis(50));
+        assert_eq!(replicas.pick(), Some(0));
+
+        replicas.written();
+        assert_eq!(replicas.pick(), None);
+
+        std::thread::sleep(Duration::from_millis(60));
+        assert_eq!(replicas.pick(), Some(0));
+    }
+}
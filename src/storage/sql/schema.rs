@@ -1,17 +1,35 @@
 // @generated automatically by Diesel CLI.
 
+pub mod sql_types {
+    #[derive(diesel::query_builder::QueryId, Clone, diesel::sql_types::SqlType)]
+    #[diesel(postgres_type(name = "tsvector", schema = "pg_catalog"))]
+    pub struct Tsvector;
+}
+
+diesel::table! {
+    blobs (hash) {
+        hash -> Bytea,
+        content -> Text,
+        created_at -> Timestamptz,
+    }
+}
+
 diesel::table! {
-    changesets (id) {
+    changesets (snippet_id, id) {
         id -> Int4,
         snippet_id -> Int4,
         version -> Int4,
-        content -> Text,
         created_at -> Timestamptz,
         updated_at -> Timestamptz,
+        blob_hash -> Nullable<Bytea>,
+        delta -> Nullable<Jsonb>,
     }
 }
 
 diesel::table! {
+    use diesel::sql_types::*;
+    use super::sql_types::Tsvector;
+
     snippets (id) {
         id -> Int4,
         slug -> Varchar,
@@ -19,6 +37,7 @@ diesel::table! {
         syntax -> Nullable<Text>,
         created_at -> Timestamptz,
         updated_at -> Timestamptz,
+        search_vector -> Tsvector,
     }
 }
 
@@ -30,7 +49,8 @@ diesel::table! {
     }
 }
 
+diesel::joinable!(changesets -> blobs (blob_hash));
 diesel::joinable!(changesets -> snippets (snippet_id));
 diesel::joinable!(tags -> snippets (snippet_id));
 
-diesel::allow_tables_to_appear_in_same_query!(changesets, snippets, tags,);
+diesel::allow_tables_to_appear_in_same_query!(blobs, changesets, snippets, tags,);
@@ -0,0 +1,162 @@
+//! Expressions for full-text search of snippets.
+//!
+//! The search vector of a snippet (snippets.search_vector) is maintained by
+//! the database (see the migration that added it). Search queries are
+//! accepted in the syntax of web search engines (e.g. `"quoted phrase" -not
+//! or`), which never fails to parse, unlike the raw tsquery syntax.
+
+use diesel::expression::{
+    is_aggregate, AppearsOnTable, Expression, SelectableExpression, ValidGrouping,
+};
+use diesel::pg::Pg;
+use diesel::query_builder::{AstPass, QueryFragment, QueryId};
+use diesel::sql_types::{Bool, Float, Nullable, Text};
+use diesel::QueryResult;
+
+use super::schema::snippets;
+
+/// Appends the search query converted to tsquery. The text search
+/// configuration must match the one used to build the search vectors.
+fn push_tsquery<'b>(query: &'b str, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+    out.push_sql("websearch_to_tsquery('simple', ");
+    out.push_bind_param::<Text, _>(query)?;
+    out.push_sql(")");
+
+    Ok(())
+}
+
+/// Appends the relevance of a snippet to the search query.
+fn push_rank<'b>(query: &'b str, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+    out.push_sql("ts_rank_cd(");
+    snippets::search_vector.walk_ast(out.reborrow())?;
+    out.push_sql(", ");
+    push_tsquery(query, out.reborrow())?;
+    out.push_sql(")");
+
+    Ok(())
+}
+
+/// True if a snippet matches the search query. Can be answered by the GIN
+/// index on snippets.search_vector.
+#[derive(Clone, Debug)]
+pub struct SearchMatches(pub String);
+
+impl Expression for SearchMatches {
+    type SqlType = Bool;
+}
+
+impl QueryFragment<Pg> for SearchMatches {
+    fn walk_ast<'b>(&'b self, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+        snippets::search_vector.walk_ast(out.reborrow())?;
+        out.push_sql(" @@ ");
+        push_tsquery(&self.0, out)
+    }
+}
+
+/// The relevance of a snippet to the search query. Snippets that match the
+/// query in their titles rank higher than the ones that only match it in
+/// their contents.
+#[derive(Clone, Debug)]
+pub struct SearchRank(pub String);
+
+impl Expression for SearchRank {
+    type SqlType = Float;
+}
+
+impl QueryFragment<Pg> for SearchRank {
+    fn walk_ast<'b>(&'b self, out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+        push_rank(&self.0, out)
+    }
+}
+
+/// Same as SearchRank, but NULL if there is no search query. Allows for
+/// selecting the rank by the queries that are shared by search and regular
+/// listing.
+#[derive(Clone, Debug)]
+pub struct OptionalSearchRank(pub Option<String>);
+
+impl Expression for OptionalSearchRank {
+    type SqlType = Nullable<Float>;
+}
+
+impl QueryFragment<Pg> for OptionalSearchRank {
+    fn walk_ast<'b>(&'b self, mut out: AstPass<'_, 'b, Pg>) -> QueryResult<()> {
+        match &self.0 {
+            Some(query) => push_rank(query, out),
+            None => {
+                out.push_sql("NULL::real");
+                Ok(())
+            }
+        }
+    }
+}
+
+// The query is passed as a bind parameter, so the expressions can't have a
+// static query id.
+impl QueryId for SearchMatches {
+    type QueryId = ();
+    const HAS_STATIC_QUERY_ID: bool = false;
+}
+
+impl AppearsOnTable<snippets::table> for SearchMatches {}
+
+impl SelectableExpression<snippets::table> for SearchMatches {}
+
+impl<GB> ValidGrouping<GB> for SearchMatches {
+    type IsAggregate = is_aggregate::Never;
+}
+
+impl QueryId for SearchRank {
+    type QueryId = ();
+    const HAS_STATIC_QUERY_ID: bool = false;
+}
+
+impl AppearsOnTable<snippets::table> for SearchRank {}
+
+impl SelectableExpression<snippets::table> for SearchRank {}
+
+impl<GB> ValidGrouping<GB> for SearchRank {
+    type IsAggregate = is_aggregate::Never;
+}
+
+impl QueryId for OptionalSearchRank {
+    type QueryId = ();
+    const HAS_STATIC_QUERY_ID: bool = false;
+}
+
+impl AppearsOnTable<snippets::table> for OptionalSearchRank {}
+
+impl SelectableExpression<snippets::table> for OptionalSearchRank {}
+
+impl<GB> ValidGrouping<GB> for OptionalSearchRank {
+    type IsAggregate = is_aggregate::Never;
+}
+
+#[cfg(test)]
+mod tests {
+    use diesel::debug_query;
+    use diesel::prelude::*;
+
+    use super::*;
+
+    #[test]
+    fn to_sql() {
+        let query = snippets::table
+            .select(SearchRank("spam eggs".to_string()))
+            .filter(SearchMatches("spam eggs".to_string()));
+
+        assert_eq!(
+            debug_query::<Pg, _>(&query).to_string(),
+            "SELECT ts_rank_cd(\"snippets\".\"search_vector\", \
+             websearch_to_tsquery('simple', $1)) FROM \"snippets\" \
+             WHERE \"snippets\".\"search_vector\" @@ websearch_to_tsquery('simple', $2) \
+             -- binds: [\"spam eggs\", \"spam eggs\"]"
+        );
+
+        let query = snippets::table.select(OptionalSearchRank(None));
+        assert_eq!(
+            debug_query::<Pg, _>(&query).to_string(),
+            "SELECT NULL::real FROM \"snippets\" -- binds: []"
+        );
+    }
+}
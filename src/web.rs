@@ -1,9 +1,18 @@
 mod auth;
+mod conditional;
 mod content;
+mod cursor;
+mod encoding;
+mod metrics;
 mod tracing;
 
-pub use crate::web::auth::{AuthValidator, BearerAuth, JwtValidator};
+pub use crate::web::auth::{AuthValidator, BearerAuth, JwtStats, JwtValidator};
+pub use crate::web::conditional::{Conditional, Preconditions, Validators};
 pub use crate::web::content::{
-    DoNotAcceptAny, Input, NegotiatedContentType, Output, PaginationLimit, WithHttpHeaders,
+    DoNotAcceptAny, Input, InputStream, NegotiatedContentType, Output, OutputStream,
+    PaginationLimit, WithHttpHeaders,
 };
+pub use crate::web::cursor::Cursors;
+pub use crate::web::encoding::{Compression, MIN_COMPRESSED_SIZE};
+pub use crate::web::metrics::{Metrics, RequestMetrics};
 pub use crate::web::tracing::RequestIdHeader;
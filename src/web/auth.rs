@@ -6,9 +6,9 @@ use rocket::http::Status;
 use rocket::request::{self, FromRequest, Outcome, Request};
 use serde::Deserialize;
 
-pub use jwt::JwtValidator;
+pub use jwt::{JwtStats, JwtValidator};
 
-#[derive(Debug, PartialEq, Eq, Deserialize)]
+#[derive(Clone, Debug, PartialEq, Eq, Deserialize)]
 pub enum Permission {
     /// Allows users to import snippets (i.e. to create new snippets and set
     /// the values of some protected Snippet fields like `id` or `created_at`).
@@ -16,7 +16,7 @@ pub enum Permission {
     Import,
 }
 
-#[derive(Debug, PartialEq, Eq)]
+#[derive(Clone, Debug, PartialEq, Eq)]
 pub enum User {
     /// Authenticated user. Can create, retrieve, update, and delete private
     /// snippets. May have additional permissions.
@@ -40,6 +40,17 @@ impl User {
             false
         }
     }
+
+    /// Returns true if the user is allowed to update snippets (i.e. to change
+    /// their fields and to add new versions of their content).
+    pub fn can_update_snippets(&self) -> bool {
+        matches!(self, User::Authenticated { .. })
+    }
+
+    /// Returns true if the user is allowed to export all snippets at once.
+    pub fn can_export_snippets(&self) -> bool {
+        matches!(self, User::Authenticated { .. })
+    }
 }
 
 #[derive(Debug)]
@@ -66,9 +77,10 @@ impl error::Error for Error {}
 pub type Result<T> = std::result::Result<T, Error>;
 
 /// A common interface for validation of user tokens.
+#[rocket::async_trait]
 pub trait AuthValidator: Send + Sync {
     /// Validate a given token value and determine permissions of the user.
-    fn validate(&self, token: &str) -> Result<User>;
+    async fn validate(&self, token: &str) -> Result<User>;
 }
 
 /// A guard that performs authorization using the Bearer token passed in the
@@ -89,7 +101,7 @@ impl<'r> FromRequest<'r> for BearerAuth {
                         .await
                         .succeeded()
                     {
-                        match validator.validate(token) {
+                        match validator.validate(token).await {
                             Ok(user) => Outcome::Success(BearerAuth(user)),
                             Err(err) => {
                                 debug!("{}", err);
@@ -140,4 +152,28 @@ mod tests {
         assert!(!user.can_import_snippets());
         assert!(importer.can_import_snippets());
     }
+
+    #[test]
+    fn can_update_snippets() {
+        let guest = User::Guest;
+        let user = User::Authenticated {
+            name: String::from("user"),
+            permissions: vec![],
+        };
+
+        assert!(!guest.can_update_snippets());
+        assert!(user.can_update_snippets());
+    }
+
+    #[test]
+    fn can_export_snippets() {
+        let guest = User::Guest;
+        let user = User::Authenticated {
+            name: String::from("user"),
+            permissions: vec![],
+        };
+
+        assert!(!guest.can_export_snippets());
+        assert!(user.can_export_snippets());
+    }
 }
@@ -0,0 +1,347 @@
+use std::hash::{Hash, Hasher};
+
+use rocket::http::Status;
+use rocket::outcome::Outcome;
+use rocket::request::{self, FromRequest, Request};
+use rocket::response::{self, Responder, Response};
+
+use crate::storage::{DateTime, Snippet};
+
+/// The format of HTTP dates (IMF-fixdate in terms of RFC 9110)
+const HTTP_DATE_FORMAT: &str = "%a, %d %b %Y %H:%M:%S GMT";
+
+/// 64-bit FNV-1a hash function.
+///
+/// Entity tags must not change between restarts of the service or differ
+/// between its instances behind a load balancer, so we can't use the
+/// DefaultHasher of the standard library, whose algorithm is unspecified.
+struct Fnv1a(u64);
+
+impl Default for Fnv1a {
+    fn default() -> Self {
+        Fnv1a(0xcbf2_9ce4_8422_2325)
+    }
+}
+
+impl Hasher for Fnv1a {
+    fn write(&mut self, bytes: &[u8]) {
+        for byte in bytes {
+            self.0 ^= u64::from(*byte);
+            self.0 = self.0.wrapping_mul(0x0000_0100_0000_01b3);
+        }
+    }
+
+    fn finish(&self) -> u64 {
+        self.0
+    }
+}
+
+/// Validators of the representation of a resource, i.e. the values of the
+/// ETag and Last-Modified response headers.
+#[derive(Debug, Clone, PartialEq, Eq)]
+pub struct Validators {
+    /// Strong entity tag (including the surrounding double quotes)
+    pub etag: String,
+    /// Timestamp of the most recent modification
+    pub last_modified: Option<DateTime>,
+}
+
+impl Validators {
+    /// Compute the validators of a representation of the given snippets.
+    ///
+    /// Snippets can only be changed by adding a new changeset, which also
+    /// bumps the value of `updated_at`, so the version of the most recent
+    /// changeset and `updated_at` of each snippet are sufficient to identify
+    /// the state of the snippets. `variant` must list everything else the
+    /// representation depends on (e.g. the media type or the Link header).
+    pub fn for_snippets(snippets: &[Snippet], variant: &[&str]) -> Self {
+        let mut hasher = Fnv1a::default();
+        variant.hash(&mut hasher);
+        for snippet in snippets {
+            snippet.id.hash(&mut hasher);
+            snippet
+                .updated_at
+                .map(|updated_at| updated_at.timestamp_micros())
+                .hash(&mut hasher);
+            snippet
+                .changesets
+                .last()
+                .map(|changeset| changeset.version)
+                .hash(&mut hasher);
+        }
+
+        Validators {
+            etag: format!("\"{:016x}\"", hasher.finish()),
+            last_modified: snippets.iter().filter_map(|s| s.updated_at).max(),
+        }
+    }
+}
+
+/// Compare two entity tags using the weak comparison function (RFC 9110,
+/// section 8.8.3.2), i.e. two tags match if their opaque parts are identical,
+/// regardless of either or both being tagged as weak.
+fn weak_eq(a: &str, b: &str) -> bool {
+    a.trim_start_matches("W/") == b.trim_start_matches("W/")
+}
+
+/// A request guard that keeps the preconditions of a conditional GET request,
+/// i.e. the values of the If-None-Match and If-Modified-Since headers.
+#[derive(Debug, Default)]
+pub struct Preconditions {
+    /// Comma-separated list of entity tags (or "*")
+    if_none_match: Option<String>,
+    if_modified_since: Option<DateTime>,
+}
+
+impl Preconditions {
+    /// Returns true if the client already has the representation identified by
+    /// the given validators.
+    ///
+    /// If-Modified-Since is only evaluated when If-None-Match is not present,
+    /// as required by RFC 9110, section 13.2.2.
+    fn is_not_modified(&self, validators: &Validators) -> bool {
+        if let Some(if_none_match) = &self.if_none_match {
+            if_none_match
+                .split(',')
+                .map(str::trim)
+                .any(|etag| etag == "*" || weak_eq(etag, &validators.etag))
+        } else if let (Some(if_modified_since), Some(last_modified)) =
+            (self.if_modified_since, validators.last_modified)
+        {
+            // HTTP dates have the precision of one second
+            last_modified.timestamp() <= if_modified_since.timestamp()
+        } else {
+            false
+        }
+    }
+
+    /// Wrap the given responder, so that the response includes the validators,
+    /// and the body is only generated if the preconditions allow it.
+    pub fn respond<R>(&self, validators: Validators, responder: R) -> Conditional<R> {
+        if self.is_not_modified(&validators) {
+            Conditional(validators, None)
+        } else {
+            Conditional(validators, Some(responder))
+        }
+    }
+}
+
+#[rocket::async_trait]
+impl<'r> FromRequest<'r> for Preconditions {
+    type Error = ();
+
+    async fn from_request(request: &'r Request<'_>) -> request::Outcome<Self, Self::Error> {
+        let headers = request.headers();
+
+        let if_none_match = headers.get("If-None-Match").collect::<Vec<_>>();
+        // invalid dates must be ignored
+        let if_modified_since = headers
+            .get_one("If-Modified-Since")
+            .and_then(|value| chrono::DateTime::parse_from_rfc2822(value).ok())
+            .map(|value| value.with_timezone(&chrono::Utc));
+
+        Outcome::Success(Preconditions {
+            if_none_match: if if_none_match.is_empty() {
+                None
+            } else {
+                Some(if_none_match.join(","))
+            },
+            if_modified_since,
+        })
+    }
+}
+
+/// A Rocket responder that adds the ETag and Last-Modified headers to the
+/// response, or responds with 304 Not Modified (and no body) if the
+/// wrapped responder is not set.
+pub struct Conditional<R>(pub Validators, pub Option<R>);
+
+impl<'r, 'o: 'r, R: Responder<'r, 'o>> Responder<'r, 'o> for Conditional<R> {
+    fn respond_to(self, request: &'r Request<'_>) -> response::Result<'o> {
+        let Conditional(validators, responder) = self;
+        let mut build = Response::build();
+
+        match responder {
+            Some(responder) => build.merge(responder.respond_to(request)?),
+            None => build.status(Status::NotModified),
+        };
+
+        build.raw_header("ETag", validators.etag);
+        if let Some(last_modified) = validators.last_modified {
+            build.raw_header(
+                "Last-Modified",
+                last_modified.format(HTTP_DATE_FORMAT).to_string(),
+            );
+        }
+
+        build.ok()
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use crate::storage::Changeset;
+
+    fn snippet(version: usize, updated_at: &str) -> Snippet {
+        let updated_at = chrono::DateTime::parse_from_rfc3339(updated_at)
+            .unwrap()
+            .with_timezone(&chrono::Utc);
+
+        Snippet {
+            id: "spam".to_string(),
+            changesets: vec![Changeset::new(version, "print(42)".to_string())],
+            updated_at: Some(updated_at),
+            ..Default::default()
+        }
+    }
+
+    #[test]
+    fn test_fnv1a() {
+        let mut hasher = Fnv1a::default();
+        hasher.write(b"foobar");
+        assert_eq!(hasher.finish(), 0x85944171f73967e8);
+    }
+
+    #[test]
+    fn test_validators() {
+        let reference = snippet(0, "2020-08-09T10:39:57.123456+00:00");
+        let validators = Validators::for_snippets(&[reference], &["application/json"]);
+
+        assert_eq!(validators.etag.len(), 18);
+        assert!(validators.etag.starts_with('"') && validators.etag.ends_with('"'));
+        assert_eq!(
+            validators.last_modified.map(|v| v.to_rfc3339()),
+            Some("2020-08-09T10:39:57.123456+00:00".to_string())
+        );
+
+        // the validators must be deterministic
+        assert_eq!(
+            validators,
+            Validators::for_snippets(
+                &[snippet(0, "2020-08-09T10:39:57.123456+00:00")],
+                &["application/json"]
+            )
+        );
+
+        // and reflect changes of the snippet state and the representation
+        for (snippets, variant) in [
+            (
+                vec![snippet(1, "2020-08-09T10:39:57.123456+00:00")],
+                "application/json",
+            ),
+            (
+                vec![snippet(0, "2020-08-09T10:39:57.123457+00:00")],
+                "application/json",
+            ),
+            (
+                vec![snippet(0, "2020-08-09T10:39:57.123456+00:00")],
+                "text/plain",
+            ),
+            (vec![], "application/json"),
+        ] {
+            assert_ne!(
+                validators.etag,
+                Validators::for_snippets(&snippets, &[variant]).etag
+            );
+        }
+    }
+
+    #[test]
+    fn test_last_modified_of_multiple_snippets() {
+        let snippets = vec![
+            snippet(0, "2020-08-09T10:39:57+00:00"),
+            snippet(0, "2020-08-10T10:39:57+00:00"),
+            snippet(0, "2020-08-08T10:39:57+00:00"),
+        ];
+
+        assert_eq!(
+            Validators::for_snippets(&snippets, &[])
+                .last_modified
+                .map(|v| v.to_rfc3339()),
+            Some("2020-08-10T10:39:57+00:00".to_string())
+        );
+        assert_eq!(Validators::for_snippets(&[], &[]).last_modified, None);
+    }
+
+    #[test]
+    fn test_if_none_match() {
+        let validators = Validators {
+            etag: "\"0123456789abcdef\"".to_string(),
+            last_modified: None,
+        };
+
+        for (value, expected) in [
+            ("\"0123456789abcdef\"", true),
+            ("W/\"0123456789abcdef\"", true),
+            ("\"spam\", \"0123456789abcdef\"", true),
+            ("*", true),
+            ("\"fedcba9876543210\"", false),
+            ("0123456789abcdef", false),
+            ("", false),
+        ] {
+            let preconditions = Preconditions {
+                if_none_match: Some(value.to_string()),
+                if_modified_since: None,
+            };
+            assert_eq!(
+                preconditions.is_not_modified(&validators),
+                expected,
+                "{}",
+                value
+            );
+        }
+    }
+
+    #[test]
+    fn test_if_modified_since() {
+        let validators =
+            Validators::for_snippets(&[snippet(0, "2020-08-09T10:39:57.5+00:00")], &[]);
+        let date = |value| {
+            Some(
+                chrono::DateTime::parse_from_rfc2822(value)
+                    .unwrap()
+                    .with_timezone(&chrono::Utc),
+            )
+        };
+
+        for (value, expected) in [
+            ("Sun, 09 Aug 2020 10:39:57 GMT", true),
+            ("Sun, 09 Aug 2020 10:39:58 GMT", true),
+            ("Sun, 09 Aug 2020 10:39:56 GMT", false),
+        ] {
+            let preconditions = Preconditions {
+                if_none_match: None,
+                if_modified_since: date(value),
+            };
+            assert_eq!(
+                preconditions.is_not_modified(&validators),
+                expected,
+                "{}",
+                value
+            );
+        }
+
+        // If-None-Match takes precedence over If-Modified-Since
+        let preconditions = Preconditions {
+            if_none_match: Some("\"spam\"".to_string()),
+            if_modified_since: date("Sun, 09 Aug 2020 10:39:58 GMT"),
+        };
+        assert!(!preconditions.is_not_modified(&validators));
+
+        // and nothing matches when there are no preconditions
+        assert!(!Preconditions::default().is_not_modified(&validators));
+    }
+
+    #[test]
+    fn test_http_date_format() {
+        let last_modified = snippet(0, "2020-08-09T10:39:57.5+00:00")
+            .updated_at
+            .unwrap();
+
+        assert_eq!(
+            last_modified.format(HTTP_DATE_FORMAT).to_string(),
+            "Sun, 09 Aug 2020 10:39:57 GMT"
+        );
+    }
+}
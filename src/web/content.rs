@@ -1,13 +1,21 @@
+use std::fmt::Display;
+use std::io;
+use std::pin::Pin;
+use std::task::{ready, Context, Poll};
+
+use futures_util::stream::{Stream, StreamExt};
 use serde::de::DeserializeOwned;
 use serde::Serialize;
 
-use rocket::data::{self, Data, FromData, ToByteUnit};
+use rocket::data::{self, Data, DataStream, FromData, ToByteUnit};
 use rocket::form::{self, FromFormField, ValueField};
 use rocket::http::{Accept, ContentType, HeaderMap, QMediaType, Status};
 use rocket::outcome::Outcome::*;
 use rocket::request::{self, FromRequest, Request};
 use rocket::response::{self, Responder, Response};
 use rocket::serde::json::Json;
+use rocket::serde::msgpack::{self, MsgPack};
+use rocket::tokio::io::{AsyncBufReadExt, AsyncRead, AsyncReadExt, BufReader, ReadBuf, Take};
 
 use crate::errors::ApiError;
 use crate::storage::Pagination;
@@ -15,11 +23,19 @@ use crate::storage::Pagination;
 /// The default limit for the request size (to prevent DoS attacks). Can be
 /// overridden in the config by setting `max_request_size` to a different value
 const MAX_REQUEST_SIZE: u64 = 1024 * 1024;
-/// The list of supported formats. When changed, the implementation of
-/// Input::from_data() must be updated accordingly.
-const SUPPORTED_MEDIA_TYPES: [ContentType; 1] = [ContentType::JSON];
-const SUPPORTED_MEDIA_TYPES_ERROR: &str = "Support media types: application/json";
+/// The default limit for the size of requests that carry multiple items (e.g.
+/// bulk import of snippets). Can be overridden in the config by setting
+/// `max_bulk_request_size` to a different value
+const MAX_BULK_REQUEST_SIZE: u64 = 256 * 1024 * 1024;
+/// The list of supported formats. When changed, the implementations of
+/// Input::from_data() and Output::respond_to() must be updated accordingly.
+const SUPPORTED_MEDIA_TYPES: [ContentType; 2] = [ContentType::JSON, ContentType::MsgPack];
+const SUPPORTED_MEDIA_TYPES_ERROR: &str =
+    "Support media types: application/json, application/msgpack";
 const PREFERRED_MEDIA_TYPE: ContentType = ContentType::JSON;
+const SUPPORTED_STREAM_MEDIA_TYPES_ERROR: &str =
+    "Support media types: application/json, application/x-ndjson";
+const PAYLOAD_TOO_LARGE_ERROR: &str = "Payload too large";
 // Pagination limit boundaries. Values outside of the boundary are not allowed
 // and will fail the request.
 const PAGINATION_LIMIT_MIN: usize = 1;
@@ -27,8 +43,8 @@ const PAGINATION_LIMIT_MAX: usize = 20;
 
 /// A wrapper struct that implements [`FromData`], allowing to accept data
 /// serialized into different formats. The value of the Content-Type request
-/// header is used to choose the deserializer. The default (and the only
-/// supported at the moment) content type is application/json.
+/// header is used to choose the deserializer: either JSON (application/json,
+/// the default), or MessagePack (application/msgpack).
 ///
 /// 400 Bad Request is returned if data deserialization fails for any reason.
 /// 415 Unsupported Media Type is returned if a client has requested an
@@ -51,12 +67,12 @@ where
             .get("max_request_size")
             .unwrap_or_else(|| MAX_REQUEST_SIZE.bytes());
 
-        let input = match data.open(size_limit).into_string().await {
-            Ok(string) if string.is_complete() => string.into_inner(),
+        let input = match data.open(size_limit).into_bytes().await {
+            Ok(bytes) if bytes.is_complete() => bytes.into_inner(),
             Ok(_) => {
                 return Error((
                     Status::PayloadTooLarge,
-                    ApiError::BadRequest("Payload too large".to_string()),
+                    ApiError::PayloadTooLarge(PAYLOAD_TOO_LARGE_ERROR.to_string()),
                 ))
             }
             Err(e) => {
@@ -72,18 +88,14 @@ where
             .cloned()
             .unwrap_or(PREFERRED_MEDIA_TYPE);
         if content_type == ContentType::JSON {
-            match serde_json::from_str(&input) {
+            match serde_json::from_slice(&input) {
                 Ok(v) => Success(Input(v)),
-                Err(e) => {
-                    if e.is_syntax() {
-                        Error((
-                            Status::BadRequest,
-                            ApiError::BadRequest("Invalid JSON".to_string()),
-                        ))
-                    } else {
-                        Error((Status::BadRequest, ApiError::BadRequest(e.to_string())))
-                    }
-                }
+                Err(e) => Error((Status::BadRequest, json_error(e))),
+            }
+        } else if content_type == ContentType::MsgPack {
+            match msgpack::from_slice(&input) {
+                Ok(v) => Success(Input(v)),
+                Err(e) => Error((Status::BadRequest, msgpack_error(e))),
             }
         } else {
             Error((
@@ -94,6 +106,331 @@ where
     }
 }
 
+/// Convert a deserialization error to the ApiError reported to the client.
+fn json_error(e: serde_json::Error) -> ApiError {
+    if e.is_syntax() {
+        ApiError::BadRequest("Invalid JSON".to_string())
+    } else {
+        ApiError::BadRequest(e.to_string())
+    }
+}
+
+/// Convert a MessagePack deserialization error to the ApiError reported to the
+/// client.
+fn msgpack_error(e: msgpack::Error) -> ApiError {
+    match e {
+        msgpack::Error::InvalidMarkerRead(_)
+        | msgpack::Error::InvalidDataRead(_)
+        | msgpack::Error::LengthMismatch(_) => {
+            ApiError::BadRequest("Invalid MessagePack".to_string())
+        }
+        e => ApiError::BadRequest(e.to_string()),
+    }
+}
+
+/// The request body of [`InputStream`]. It's opened with a limit one byte
+/// larger than the actual one, and then capped by Take, so that a body that
+/// exceeds the limit can be told from a body that ends right at the limit.
+type Body<'r> = BufReader<Take<Pin<Box<DataStream<'r>>>>>;
+
+enum InputFormat {
+    /// Items of a JSON array. The items are split on the fly, and each one is
+    /// deserialized on its own, so the array is never loaded in full.
+    /// `started` tells whether any items have been read yet
+    Array { started: bool, finished: bool },
+    /// Lines of a newline-delimited JSON document
+    Lines,
+}
+
+/// A struct that implements [`FromData`], allowing to accept a sequence of
+/// items, that can be processed in batches. The value of the Content-Type
+/// request header is used to choose the format: either a JSON array
+/// (application/json), or newline-delimited JSON (application/x-ndjson).
+/// Both are streamed, i.e. the request body is never loaded into memory in
+/// full.
+///
+/// Unlike [`Input`], a malformed item does not fail the whole request: the
+/// error is reported for that particular item instead.
+///
+/// 400 Bad Request is returned if the body is not a JSON array.
+/// 413 Payload Too Large is returned if Content-Length exceeds the limit.
+/// 415 Unsupported Media Type is returned if a client has requested an
+/// unsupported format.
+pub struct InputStream<'r> {
+    body: Body<'r>,
+    format: InputFormat,
+    /// The error that has interrupted the previous batch. It's returned by
+    /// the next call to next_batch(), so that the items read before the
+    /// error can still be processed.
+    error: Option<ApiError>,
+}
+
+impl InputStream<'_> {
+    /// Read and deserialize up to `size` next items. An empty vector is
+    /// returned when there are no items left.
+    ///
+    /// An error is returned if the body can't be read any further (e.g. it's
+    /// larger than the limit, or a JSON array is not terminated). The items
+    /// that precede the error are returned by the previous call first.
+    pub async fn next_batch<T: DeserializeOwned>(
+        &mut self,
+        size: usize,
+    ) -> Result<Vec<Result<T, ApiError>>, ApiError> {
+        if let Some(e) = self.error.take() {
+            return Err(e);
+        }
+
+        let mut batch = Vec::with_capacity(size);
+        while batch.len() < size {
+            match self.next_item().await {
+                Ok(Some(item)) => batch.push(serde_json::from_slice(&item).map_err(json_error)),
+                Ok(None) => break,
+                Err(e) if !batch.is_empty() => {
+                    self.error = Some(e);
+                    break;
+                }
+                Err(e) => return Err(e),
+            }
+        }
+
+        Ok(batch)
+    }
+
+    /// Read the serialized representation of the next item, or None if there
+    /// are no items left.
+    async fn next_item(&mut self) -> Result<Option<Vec<u8>>, ApiError> {
+        match self.format {
+            InputFormat::Array { finished: true, .. } => {
+                // nothing but whitespace may follow the array
+                read_array_end(&mut self.body).await?;
+                Ok(None)
+            }
+            InputFormat::Array {
+                started,
+                finished: false,
+            } => {
+                let (item, finished) = read_array_item(&mut self.body).await?;
+                // only the closing bracket of an empty array may follow no
+                // item, e.g. a trailing comma is not valid JSON
+                let blank = item.iter().all(u8::is_ascii_whitespace);
+                if blank && (started || !finished) {
+                    return Err(ApiError::BadRequest("Invalid JSON".to_string()));
+                }
+                self.format = InputFormat::Array {
+                    started: true,
+                    finished,
+                };
+                if blank {
+                    read_array_end(&mut self.body).await?;
+                    return Ok(None);
+                }
+
+                Ok(Some(item))
+            }
+            InputFormat::Lines => loop {
+                let mut line = Vec::new();
+                let read = self
+                    .body
+                    .read_until(b'\n', &mut line)
+                    .await
+                    .map_err(read_error)?;
+                // a line cut off by the limit must not be taken for an item
+                if !line.ends_with(b"\n") && limit_exceeded(&mut self.body).await? {
+                    return Err(ApiError::PayloadTooLarge(
+                        PAYLOAD_TOO_LARGE_ERROR.to_string(),
+                    ));
+                }
+                if read == 0 {
+                    return Ok(None);
+                }
+                if !line.iter().all(u8::is_ascii_whitespace) {
+                    return Ok(Some(line));
+                }
+            },
+        }
+    }
+}
+
+/// Read the next item of a JSON array, whose opening bracket has already been
+/// consumed, up to the comma or the closing bracket that follows it. The item
+/// is not validated beyond tracking the nesting of objects, arrays and
+/// strings, which is enough to tell where it ends. Returns the item and
+/// whether it was the last one.
+async fn read_array_item(body: &mut Body<'_>) -> Result<(Vec<u8>, bool), ApiError> {
+    let mut item = Vec::new();
+    let mut depth = 0usize;
+    let mut in_string = false;
+    let mut escaped = false;
+    loop {
+        let buf = body.fill_buf().await.map_err(read_error)?;
+        if buf.is_empty() {
+            return Err(if limit_exceeded(body).await? {
+                ApiError::PayloadTooLarge(PAYLOAD_TOO_LARGE_ERROR.to_string())
+            } else {
+                ApiError::BadRequest("Invalid JSON".to_string())
+            });
+        }
+
+        let mut end = None;
+        for (i, byte) in buf.iter().enumerate() {
+            if in_string {
+                match byte {
+                    _ if escaped => escaped = false,
+                    b'\\' => escaped = true,
+                    b'"' => in_string = false,
+                    _ => {}
+                }
+                continue;
+            }
+            match byte {
+                b'"' => in_string = true,
+                b'[' | b'{' => depth += 1,
+                b']' | b'}' if depth > 0 => depth -= 1,
+                b',' | b']' if depth == 0 => {
+                    end = Some((i, *byte == b']'));
+                    break;
+                }
+                _ => {}
+            }
+        }
+
+        match end {
+            Some((i, finished)) => {
+                item.extend_from_slice(&buf[..i]);
+                body.consume(i + 1);
+                return Ok((item, finished));
+            }
+            None => {
+                let len = buf.len();
+                item.extend_from_slice(buf);
+                body.consume(len);
+            }
+        }
+    }
+}
+
+/// Returns true if the request body is larger than the limit it's read with.
+/// Must only be called once the body has been read up to the limit or to its
+/// end, whichever comes first.
+async fn limit_exceeded(body: &mut Body<'_>) -> Result<bool, ApiError> {
+    let capped = body.get_mut();
+    if capped.limit() > 0 {
+        return Ok(false);
+    }
+
+    let mut byte = [0u8; 1];
+    let read = capped.get_mut().read(&mut byte).await.map_err(read_error)?;
+    Ok(read > 0)
+}
+
+/// Convert an error of reading the request body to the ApiError reported to
+/// the client.
+fn read_error(e: io::Error) -> ApiError {
+    ApiError::BadRequest(e.to_string())
+}
+
+#[rocket::async_trait]
+impl<'r> FromData<'r> for InputStream<'r> {
+    type Error = ApiError;
+
+    async fn from_data(request: &'r Request<'_>, data: Data<'r>) -> data::Outcome<'r, Self> {
+        let size_limit = request
+            .limits()
+            .get("max_bulk_request_size")
+            .unwrap_or_else(|| MAX_BULK_REQUEST_SIZE.bytes());
+
+        // reject the body upfront if it's known to be too large, rather than
+        // after some of the items have already been processed
+        let content_length = request
+            .headers()
+            .get_one("Content-Length")
+            .and_then(|value| value.parse::<u64>().ok());
+        if content_length.is_some_and(|length| length > size_limit.as_u64()) {
+            return Error((
+                Status::PayloadTooLarge,
+                ApiError::PayloadTooLarge(PAYLOAD_TOO_LARGE_ERROR.to_string()),
+            ));
+        }
+
+        let content_type = request
+            .content_type()
+            .cloned()
+            .unwrap_or(PREFERRED_MEDIA_TYPE);
+        let format = if content_type == ContentType::JSON {
+            InputFormat::Array {
+                started: false,
+                finished: false,
+            }
+        } else if content_type.top() == "application" && content_type.sub() == "x-ndjson" {
+            InputFormat::Lines
+        } else {
+            return Error((
+                Status::UnsupportedMediaType,
+                ApiError::UnsupportedMediaType(SUPPORTED_STREAM_MEDIA_TYPES_ERROR),
+            ));
+        };
+
+        let stream = Box::pin(data.open(size_limit.as_u64().saturating_add(1).bytes()));
+        let mut body = BufReader::new(stream.take(size_limit.as_u64()));
+
+        if let InputFormat::Array { .. } = format {
+            // consume the opening bracket, so that a body that is not an
+            // array at all fails the whole request
+            if let Err(e) = read_array_start(&mut body).await {
+                return Error((e.status(), e));
+            }
+        }
+
+        Success(InputStream {
+            body,
+            format,
+            error: None,
+        })
+    }
+}
+
+/// Skip the whitespace that precedes the opening bracket of a JSON array, and
+/// the bracket itself.
+async fn read_array_start(body: &mut Body<'_>) -> Result<(), ApiError> {
+    loop {
+        let buf = body.fill_buf().await.map_err(read_error)?;
+        match buf.iter().position(|byte| !byte.is_ascii_whitespace()) {
+            Some(i) if buf[i] == b'[' => {
+                body.consume(i + 1);
+                return Ok(());
+            }
+            Some(_) => return Err(ApiError::BadRequest("Expected a JSON array".to_string())),
+            None if buf.is_empty() => return Err(ApiError::BadRequest("Invalid JSON".to_string())),
+            None => {
+                let len = buf.len();
+                body.consume(len);
+            }
+        }
+    }
+}
+
+/// Check that nothing but whitespace follows the closing bracket of a JSON
+/// array, which has already been consumed.
+async fn read_array_end(body: &mut Body<'_>) -> Result<(), ApiError> {
+    loop {
+        let buf = body.fill_buf().await.map_err(read_error)?;
+        if buf.is_empty() {
+            if limit_exceeded(body).await? {
+                return Err(ApiError::PayloadTooLarge(
+                    PAYLOAD_TOO_LARGE_ERROR.to_string(),
+                ));
+            }
+            return Ok(());
+        }
+        if !buf.iter().all(u8::is_ascii_whitespace) {
+            return Err(ApiError::BadRequest("Invalid JSON".to_string()));
+        }
+
+        let len = buf.len();
+        body.consume(len);
+    }
+}
+
 /// A wrapper struct that implements [`Responder`], allowing to serialize the
 /// response to the format negotiated with the client via the provided request
 /// headers.
@@ -107,6 +444,10 @@ impl<'r, 'o: 'r, T: Serialize> Responder<'r, 'o> for Output<T> {
 
         if content_type == &ContentType::JSON {
             Json(value).respond_to(request)
+        } else if content_type == &ContentType::MsgPack {
+            // fields are serialized by name (as a map), just like in JSON, so
+            // that clients do not depend on the order of the fields
+            MsgPack(value).respond_to(request)
         } else {
             // this shouldn't be possible as by this point content negotiation has already
             // succeeded
@@ -116,6 +457,80 @@ impl<'r, 'o: 'r, T: Serialize> Responder<'r, 'o> for Output<T> {
     }
 }
 
+/// A wrapper struct that implements [`Responder`], allowing to stream a
+/// sequence of items as newline-delimited JSON (application/x-ndjson). The
+/// items are serialized one at a time as they are produced, so the response
+/// body is never held in memory in full.
+///
+/// The status and the headers are sent before the first item, so an error
+/// produced by the stream can't be reported to the client. The connection is
+/// aborted instead, so that the client can tell a truncated response from a
+/// complete one.
+pub struct OutputStream<S>(pub S);
+
+impl<'r, 'o: 'r, S, T, E> Responder<'r, 'o> for OutputStream<S>
+where
+    S: Stream<Item = Result<T, E>> + Send + Unpin + 'o,
+    T: Serialize,
+    E: Display,
+{
+    fn respond_to(self, _request: &'r Request) -> response::Result<'o> {
+        Response::build()
+            .header(ContentType::new("application", "x-ndjson"))
+            .streamed_body(NdjsonReader {
+                items: self.0,
+                line: Vec::new(),
+                position: 0,
+            })
+            .ok()
+    }
+}
+
+/// Reads the items of a stream serialized as newline-delimited JSON.
+struct NdjsonReader<S> {
+    items: S,
+    /// The serialized item that is being read
+    line: Vec<u8>,
+    /// The number of bytes of `line` that have been read
+    position: usize,
+}
+
+impl<S, T, E> AsyncRead for NdjsonReader<S>
+where
+    S: Stream<Item = Result<T, E>> + Unpin,
+    T: Serialize,
+    E: Display,
+{
+    fn poll_read(
+        mut self: Pin<&mut Self>,
+        cx: &mut Context<'_>,
+        buf: &mut ReadBuf<'_>,
+    ) -> Poll<io::Result<()>> {
+        let this = &mut *self;
+        while this.position == this.line.len() {
+            match ready!(this.items.poll_next_unpin(cx)) {
+                Some(Ok(item)) => {
+                    this.line.clear();
+                    this.position = 0;
+                    serde_json::to_writer(&mut this.line, &item)?;
+                    this.line.push(b'\n');
+                }
+                Some(Err(e)) => {
+                    error!("Failed to stream the response: {}", e);
+                    return Poll::Ready(Err(io::Error::other(e.to_string())));
+                }
+                // no bytes read signals the end of the body
+                None => return Poll::Ready(Ok(())),
+            }
+        }
+
+        let len = buf.remaining().min(this.line.len() - this.position);
+        buf.put_slice(&this.line[this.position..this.position + len]);
+        this.position += len;
+        Poll::Ready(Ok(()))
+    }
+}
+
 /// A Rocket responder that generates response with extra HTTP headers.
 pub struct WithHttpHeaders<'h, R>(pub HeaderMap<'h>, pub Option<R>);
 
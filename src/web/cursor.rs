@@ -0,0 +1,211 @@
+//! Opaque pagination cursors.
+//!
+//! A cursor carries the position of the last snippet on a page (see
+//! storage::Position), so that the storage can seek to the next page right
+//! away instead of looking the marker snippet up first. The position is
+//! internal to the storage, so the cursor is signed, and a cursor that has
+//! been tampered with is never trusted.
+//!
+//! Layout (before base64url encoding):
+//!
+//!   version (1) | created_at, µs since the epoch (8) | internal id (4) |
+//!   has rank (1) | rank (4, only if present) | slug (UTF-8) | tag (16)
+//!
+//! The tag is a truncated HMAC-SHA256 of the rest of the cursor and of the
+//! search query the cursor has been issued for. A cursor that can't be
+//! verified (e.g. it has been signed with a different secret, or comes from
+//! a different search) falls back to the slug it carries, and anything that
+//! does not look like a cursor at all is treated as a slug, which is what
+//! the clients used to pass before.
+
+use base64::engine::general_purpose::URL_SAFE_NO_PAD;
+use base64::Engine;
+use chrono::TimeZone;
+use hmac::{Hmac, Mac};
+use sha2::Sha256;
+
+use crate::storage::{Marker, Position};
+
+const VERSION: u8 = 1;
+/// The length of the truncated HMAC tag. 128 bits are plenty for a value
+/// that only lets a client skip a lookup.
+const TAG_LENGTH: usize = 16;
+/// The length of the fixed-size part of the payload (version, created_at,
+/// internal id, and the rank flag).
+const HEADER_LENGTH: usize = 1 + 8 + 4 + 1;
+
+/// Issues and verifies pagination cursors.
+///
+/// The secret must be shared by all instances of the service behind a load
+/// balancer, or the cursors issued by one instance will be resolved by the
+/// slower path (a lookup of the marker snippet) on the others.
+pub struct Cursors {
+    secret: Vec<u8>,
+}
+
+impl Cursors {
+    pub fn new(secret: &[u8]) -> Self {
+        Cursors {
+            secret: secret.to_vec(),
+        }
+    }
+
+    /// Returns a new instance with a random secret. The cursors issued by
+    /// the instance are only verified by the same instance.
+    pub fn random() -> Self {
+        Cursors::new(&rand::random::<[u8; 32]>())
+    }
+
+    fn mac(&self, payload: &[u8], search: Option<&str>) -> Hmac<Sha256> {
+        // HMAC accepts keys of any length
+        let mut mac =
+            Hmac::<Sha256>::new_from_slice(&self.secret).expect("HMAC can take a key of any size");
+        mac.update(payload);
+        if let Some(search) = search {
+            mac.update(search.as_bytes());
+        }
+
+        mac
+    }
+
+    /// Returns a cursor pointing at the snippet with the given slug and
+    /// position. `search` is the full-text search query of the listing, if
+    /// there is one.
+    pub fn encode(&self, position: &Position, slug: &str, search: Option<&str>) -> String {
+        let mut payload = Vec::with_capacity(HEADER_LENGTH + 4 + slug.len() + TAG_LENGTH);
+        payload.push(VERSION);
+        payload.extend_from_slice(&position.created_at.timestamp_micros().to_be_bytes());
+        payload.extend_from_slice(&position.internal_id.to_be_bytes());
+        match position.rank {
+            Some(rank) => {
+                payload.push(1);
+                payload.extend_from_slice(&rank.to_be_bytes());
+            }
+            None => payload.push(0),
+        }
+        payload.extend_from_slice(slug.as_bytes());
+
+        let tag = self.mac(&payload, search).finalize().into_bytes();
+        payload.extend_from_slice(&tag[..TAG_LENGTH]);
+
+        URL_SAFE_NO_PAD.encode(payload)
+    }
+
+    /// Returns the pagination marker the given value of the `marker` query
+    /// parameter stands for. Never fails: values that are not valid cursors
+    /// are treated as slugs.
+    pub fn decode(&self, marker: &str, search: Option<&str>) -> Marker {
+        let cursor = match URL_SAFE_NO_PAD.decode(marker) {
+            Ok(cursor) if cursor.len() > HEADER_LENGTH + TAG_LENGTH => cursor,
+            _ => return Marker::Id(marker.to_owned()),
+        };
+        let (payload, tag) = cursor.split_at(cursor.len() - TAG_LENGTH);
+        let (position, slug) = match parse(payload) {
+            Some(parsed) => parsed,
+            None => return Marker::Id(marker.to_owned()),
+        };
+
+        match self.mac(payload, search).verify_truncated_left(tag) {
+            Ok(()) => Marker::Position(position),
+            Err(_) => Marker::Id(slug.to_owned()),
+        }
+    }
+}
+
+/// Splits the payload of a cursor into the position and the slug.
+fn parse(payload: &[u8]) -> Option<(Position, &str)> {
+    let (header, rest) = payload.split_at_checked(HEADER_LENGTH)?;
+    if header[0] != VERSION {
+        return None;
+    }
+
+    let micros = i64::from_be_bytes(header[1..9].try_into().ok()?);
+    let internal_id = i32::from_be_bytes(header[9..13].try_into().ok()?);
+    let (rank, slug) = match header[13] {
+        0 => (None, rest),
+        1 => {
+            let (rank, slug) = rest.split_at_checked(4)?;
+            (Some(f32::from_be_bytes(rank.try_into().ok()?)), slug)
+        }
+        _ => return None,
+    };
+    let slug = std::str::from_utf8(slug)
+        .ok()
+        .filter(|slug| !slug.is_empty())?;
+
+    Some((
+        Position {
+            created_at: chrono::Utc.timestamp_micros(micros).single()?,
+            internal_id,
+            rank,
+        },
+        slug,
+    ))
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn position(rank: Option<f32>) -> Position {
+        Position {
+            created_at: chrono::Utc.timestamp_micros(1_600_000_000_123_456).unwrap(),
+            internal_id: 42,
+            rank,
+        }
+    }
+
+    #[test]
+    fn round_trip() {
+        let cursors = Cursors::new(b"spam");
+        for (rank, search) in [(None, None), (Some(0.25), Some("eggs"))] {
+            let cursor = cursors.encode(&position(rank), "foobar", search);
+            assert!(cursor
+                .bytes()
+                .all(|b| b.is_ascii_alphanumeric() || b == b'-' || b == b'_'));
+            assert_eq!(
+                cursors.decode(&cursor, search),
+                Marker::Position(position(rank))
+            );
+        }
+    }
+
+    #[test]
+    fn unverified() {
+        let cursors = Cursors::new(b"spam");
+        let cursor = cursors.encode(&position(None), "foobar", None);
+
+        // signed with a different secret
+        assert_eq!(
+            Cursors::new(b"eggs").decode(&cursor, None),
+            Marker::Id("foobar".to_string())
+        );
+        // issued for a different search query
+        assert_eq!(
+            cursors.decode(&cursor, Some("eggs")),
+            Marker::Id("foobar".to_string())
+        );
+
+        // tampered with
+        let mut payload = URL_SAFE_NO_PAD.decode(&cursor).unwrap();
+        payload[12] ^= 1;
+        let tampered = URL_SAFE_NO_PAD.encode(payload);
+        assert_eq!(
+            cursors.decode(&tampered, None),
+            Marker::Id("foobar".to_string())
+        );
+    }
+
+    #[test]
+    fn slugs() {
+        let cursors = Cursors::random();
+        for slug in [
+            "foobar",
+            "spam-eggs",
+            "a",
+            "ZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZZ",
+        ] {
+            assert_eq!(cursors.decode(slug, None), Marker::Id(slug.to_string()));
+        }
+    }
+}
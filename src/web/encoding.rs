@@ -0,0 +1,240 @@
+use async_compression::tokio::bufread::{BrotliEncoder, GzipEncoder, ZstdEncoder};
+use async_compression::Level;
+use rocket::fairing::{Fairing, Info, Kind};
+use rocket::http::{ContentType, Method, Status};
+use rocket::tokio::io::BufReader;
+use rocket::{Request, Response};
+
+/// Bodies smaller than this are sent uncompressed by default: compression
+/// would not save enough bytes to justify the CPU time (or could even make
+/// them larger). Can be overridden in the config by setting
+/// `compression_min_size` to a different value.
+pub const MIN_COMPRESSED_SIZE: usize = 1024;
+/// The size of chunks the body is read, compressed, and sent to the client in.
+const CHUNK_SIZE: usize = 16 * 1024;
+/// Brotli's default quality (11) is meant for static content compressed once.
+/// Lower levels compress almost as well and are an order of magnitude faster.
+const BROTLI_QUALITY: i32 = 4;
+
+/// Supported content codings of response bodies, in the order of preference.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+enum ContentEncoding {
+    /// Compresses about as well as brotli at the levels suitable for dynamic
+    /// content, while being considerably faster at both ends
+    Zstd,
+    Brotli,
+    Gzip,
+    Identity,
+}
+
+impl ContentEncoding {
+    const ALL: [ContentEncoding; 4] = [
+        ContentEncoding::Zstd,
+        ContentEncoding::Brotli,
+        ContentEncoding::Gzip,
+        ContentEncoding::Identity,
+    ];
+
+    /// The name of the coding as used in Accept-Encoding/Content-Encoding.
+    fn as_str(&self) -> &'static str {
+        match self {
+            ContentEncoding::Zstd => "zstd",
+            ContentEncoding::Brotli => "br",
+            ContentEncoding::Gzip => "gzip",
+            ContentEncoding::Identity => "identity",
+        }
+    }
+
+    /// Choose the most preferred coding that the client accepts based on the
+    /// value of the Accept-Encoding request header (RFC 9110, section
+    /// 12.5.3). Codings with the same weight are chosen in the order of
+    /// ContentEncoding::ALL, i.e. compression is preferred. The identity
+    /// coding is acceptable, unless it is explicitly excluded.
+    fn negotiate(header: Option<&str>) -> Self {
+        let mut weights = Vec::new();
+        for item in header.unwrap_or_default().split(',') {
+            let mut params = item.split(';').map(str::trim);
+            let coding = params.next().unwrap_or_default().to_ascii_lowercase();
+            if coding.is_empty() {
+                continue;
+            }
+
+            // malformed weights make the coding unacceptable
+            let weight = params
+                .find_map(|param| param.strip_prefix("q="))
+                .map_or(Some(1.0), |q| q.parse::<f32>().ok())
+                .unwrap_or(0.0);
+            weights.push((coding, weight));
+        }
+
+        let weight_of = |coding: ContentEncoding| {
+            let lookup = |name: &str| {
+                weights
+                    .iter()
+                    .find(|(coding, _)| coding == name)
+                    .map(|(_, weight)| *weight)
+            };
+
+            lookup(coding.as_str())
+                .or_else(|| lookup("*"))
+                .unwrap_or(match coding {
+                    ContentEncoding::Identity => 1.0,
+                    _ => 0.0,
+                })
+        };
+
+        let mut best = (ContentEncoding::Identity, 0.0);
+        for coding in ContentEncoding::ALL {
+            let weight = weight_of(coding);
+            if weight > best.1 {
+                best = (coding, weight);
+            }
+        }
+
+        best.0
+    }
+}
+
+/// Returns true if responses of the given media type are worth compressing.
+/// Already compressed formats (images, archives) are not.
+fn is_compressible(content_type: &ContentType) -> bool {
+    content_type.top() == "text"
+        || content_type.is_json()
+        || content_type.is_msgpack()
+        || (content_type.top() == "application" && content_type.sub() == "x-ndjson")
+}
+
+/// Mark the entity tag of the response as weak (RFC 9110, section 8.8.1).
+///
+/// A compressed body is not byte-for-byte identical to the one the entity tag
+/// was calculated for, but it is semantically equivalent to it. Conditional
+/// requests use the weak comparison, so clients can revalidate cached
+/// responses regardless of the coding they were received in.
+fn weaken_etag(response: &mut Response<'_>) {
+    if let Some(etag) = response.headers().get_one("ETag") {
+        if !etag.starts_with("W/") {
+            let weak = format!("W/{}", etag);
+            response.set_raw_header("ETag", weak);
+        }
+    }
+}
+
+/// Rocket fairing that compresses response bodies on the fly using the
+/// content coding negotiated with the client via the Accept-Encoding header.
+///
+/// The body is read, compressed, and sent to the client in chunks, so neither
+/// a copy of it, nor the whole compressed body is ever created. Bodies of
+/// known size smaller than `min_size` bytes, responses of media types that
+/// don't compress well, and responses that already specify a content coding
+/// are sent as is.
+pub struct Compression {
+    pub min_size: usize,
+}
+
+impl Default for Compression {
+    fn default() -> Self {
+        Compression {
+            min_size: MIN_COMPRESSED_SIZE,
+        }
+    }
+}
+
+#[rocket::async_trait]
+impl Fairing for Compression {
+    fn info(&self) -> Info {
+        Info {
+            name: "Response compression",
+            kind: Kind::Response,
+        }
+    }
+
+    async fn on_response<'r>(&self, request: &'r Request<'_>, response: &mut Response<'r>) {
+        let encoding = ContentEncoding::negotiate(request.headers().get_one("Accept-Encoding"));
+
+        // 304 Not Modified has no body, but must carry the same headers the
+        // 200 OK response would have
+        if response.status() == Status::NotModified {
+            response.adjoin_raw_header("Vary", "Accept-Encoding");
+            if encoding != ContentEncoding::Identity {
+                weaken_etag(response);
+            }
+            return;
+        }
+
+        if !response
+            .content_type()
+            .is_some_and(|ct| is_compressible(&ct))
+        {
+            return;
+        }
+        response.adjoin_raw_header("Vary", "Accept-Encoding");
+
+        if encoding == ContentEncoding::Identity
+            || request.method() == Method::Head
+            || response.headers().contains("Content-Encoding")
+            || response
+                .body()
+                .preset_size()
+                .is_some_and(|size| size < self.min_size)
+        {
+            return;
+        }
+
+        let reader = BufReader::with_capacity(CHUNK_SIZE, response.body_mut().take());
+        match encoding {
+            ContentEncoding::Zstd => response.set_streamed_body(ZstdEncoder::new(reader)),
+            ContentEncoding::Brotli => response.set_streamed_body(BrotliEncoder::with_quality(
+                reader,
+                Level::Precise(BROTLI_QUALITY),
+            )),
+            ContentEncoding::Gzip => response.set_streamed_body(GzipEncoder::new(reader)),
+            ContentEncoding::Identity => unreachable!(),
+        }
+        response.set_raw_header("Content-Encoding", encoding.as_str());
+        weaken_etag(response);
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn negotiate() {
+        for (header, expected) in [
+            (None, ContentEncoding::Identity),
+            (Some(""), ContentEncoding::Identity),
+            (Some("gzip"), ContentEncoding::Gzip),
+            (Some("gzip, deflate, br"), ContentEncoding::Brotli),
+            (Some("gzip, deflate, br, zstd"), ContentEncoding::Zstd),
+            (Some("GZIP, deflate"), ContentEncoding::Gzip),
+            (Some("br;q=0.5, gzip"), ContentEncoding::Gzip),
+            (Some("br;q=0.5, gzip;q=0.4"), ContentEncoding::Brotli),
+            (Some("zstd;q=0.5, br"), ContentEncoding::Brotli),
+            (Some("gzip;q=0.5, identity"), ContentEncoding::Identity),
+            (Some("*"), ContentEncoding::Zstd),
+            (Some("*;q=0.5, zstd;q=0, br;q=0"), ContentEncoding::Gzip),
+            (Some("gzip;q=0"), ContentEncoding::Identity),
+            (Some("gzip;q=spam"), ContentEncoding::Identity),
+            (Some("deflate"), ContentEncoding::Identity),
+        ] {
+            assert_eq!(ContentEncoding::negotiate(header), expected, "{:?}", header);
+        }
+    }
+
+    #[test]
+    fn compressible() {
+        for (content_type, expected) in [
+            (ContentType::JSON, true),
+            (ContentType::MsgPack, true),
+            (ContentType::Text, true),
+            (ContentType::Plain, true),
+            (ContentType::new("application", "x-ndjson"), true),
+            (ContentType::PNG, false),
+            (ContentType::GZIP, false),
+            (ContentType::Binary, false),
+        ] {
+            assert_eq!(is_compressible(&content_type), expected, "{}", content_type);
+        }
+    }
+}
@@ -0,0 +1,382 @@
+use std::sync::{Arc, Mutex};
+use std::time::Instant;
+
+use prometheus::{
+    Counter, Encoder, HistogramOpts, HistogramVec, IntCounter, IntGauge, Opts, Registry,
+    TextEncoder,
+};
+use rocket::fairing::{Fairing, Info, Kind};
+use rocket::{Data, Request, Response};
+
+use crate::storage::{CacheStats, PoolStats};
+use crate::web::JwtStats;
+
+/// The prefix of the names of all exported metrics.
+const NAMESPACE: &str = "xsnippet";
+
+/// Bucket boundaries (in seconds) of the latency histograms. Most requests
+/// are expected to complete within a few milliseconds, and the slow ones are
+/// of interest up to the typical proxy timeout.
+const LATENCY_BUCKETS: &[f64] = &[
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+];
+
+/// Registry of the Prometheus metrics of the service.
+///
+/// Request and storage latencies are recorded as they happen. The state of the
+/// connection pool and the counters of the caches are kept by their owners
+/// and copied to the registry on every scrape.
+#[derive(Clone)]
+pub struct Metrics {
+    registry: Registry,
+    requests: HistogramVec,
+    storage: HistogramVec,
+    /// Serializes scrapes, so that the counters copied from the stats handles
+    /// are not incremented twice by concurrent scrapes.
+    scrape: Arc<Mutex<()>>,
+    pool: Option<(PoolStats, PoolMetrics)>,
+    snippet_cache: Option<(CacheStats, CacheCounters)>,
+    page_cache: Option<(CacheStats, CacheCounters)>,
+    jwt: Option<(JwtStats, JwtCounters)>,
+}
+
+#[derive(Clone)]
+struct PoolMetrics {
+    max_size: IntGauge,
+    size: IntGauge,
+    available: IntGauge,
+    waiting: IntGauge,
+    checkouts: IntCounter,
+    wait_seconds: Counter,
+}
+
+#[derive(Clone)]
+struct CacheCounters {
+    hits: IntCounter,
+    misses: IntCounter,
+    evictions: IntCounter,
+}
+
+#[derive(Clone)]
+struct JwtCounters {
+    cache_hits: IntCounter,
+    cache_misses: IntCounter,
+    verifications: IntCounter,
+    verification_failures: IntCounter,
+    verification_seconds: Counter,
+    jwks_refreshes: IntCounter,
+    jwks_refresh_failures: IntCounter,
+}
+
+impl Metrics {
+    pub fn new() -> prometheus::Result<Self> {
+        let registry = Registry::new_custom(Some(NAMESPACE.to_string()), None)?;
+
+        let requests = HistogramVec::new(
+            HistogramOpts::new(
+                "http_request_duration_seconds",
+                "Time spent processing HTTP requests",
+            )
+            .buckets(LATENCY_BUCKETS.to_vec()),
+            &["method", "route", "status"],
+        )?;
+        registry.register(Box::new(requests.clone()))?;
+
+        let storage = HistogramVec::new(
+            HistogramOpts::new(
+                "storage_operation_duration_seconds",
+                "Time spent in calls of the storage backend",
+            )
+            .buckets(LATENCY_BUCKETS.to_vec()),
+            &["operation", "outcome"],
+        )?;
+        registry.register(Box::new(storage.clone()))?;
+
+        Ok(Metrics {
+            registry,
+            requests,
+            storage,
+            scrape: Arc::new(Mutex::new(())),
+            pool: None,
+            snippet_cache: None,
+            page_cache: None,
+            jwt: None,
+        })
+    }
+
+    /// Export the state of the database connection pool.
+    pub fn with_pool_stats(mut self, stats: PoolStats) -> prometheus::Result<Self> {
+        let wait_seconds = Counter::new(
+            "db_pool_wait_seconds_total",
+            "Time spent waiting for a database connection",
+        )?;
+        self.registry.register(Box::new(wait_seconds.clone()))?;
+
+        let metrics = PoolMetrics {
+            max_size: self.gauge("db_pool_max_size", "Maximum number of connections")?,
+            size: self.gauge("db_pool_size", "Number of open connections")?,
+            available: self.gauge("db_pool_available", "Number of idle connections")?,
+            waiting: self.gauge(
+                "db_pool_waiting",
+                "Number of requests waiting for a connection",
+            )?,
+            checkouts: self.counter(
+                "db_pool_checkouts_total",
+                "Database connections requested from the pool",
+            )?,
+            wait_seconds,
+        };
+        self.pool = Some((stats, metrics));
+
+        Ok(self)
+    }
+
+    /// Export the counters of the snippet cache.
+    pub fn with_cache_stats(mut self, stats: CacheStats) -> prometheus::Result<Self> {
+        let counters = self.cache_counters("snippet_cache", "Snippet cache")?;
+        self.snippet_cache = Some((stats, counters));
+
+        Ok(self)
+    }
+
+    /// Export the counters of the cache of the first pages of snippets.
+    pub fn with_page_cache_stats(mut self, stats: CacheStats) -> prometheus::Result<Self> {
+        let counters = self.cache_counters("page_cache", "Page cache")?;
+        self.page_cache = Some((stats, counters));
+
+        Ok(self)
+    }
+
+    /// Export the counters of the JWT validator.
+    pub fn with_jwt_stats(mut self, stats: JwtStats) -> prometheus::Result<Self> {
+        let verification_seconds = Counter::new(
+            "jwt_verification_seconds_total",
+            "Time spent verifying JWT signatures",
+        )?;
+        self.registry
+            .register(Box::new(verification_seconds.clone()))?;
+
+        let counters = JwtCounters {
+            cache_hits: self.counter("jwt_cache_hits_total", "Verified JWT cache hits")?,
+            cache_misses: self.counter("jwt_cache_misses_total", "Verified JWT cache misses")?,
+            verifications: self
+                .counter("jwt_verifications_total", "JWT signature verifications")?,
+            verification_failures: self
+                .counter("jwt_verification_failures_total", "Rejected JWTs")?,
+            verification_seconds,
+            jwks_refreshes: self.counter("jwks_refreshes_total", "Reloads of JWT Key Set")?,
+            jwks_refresh_failures: self.counter(
+                "jwks_refresh_failures_total",
+                "Failed attempts to reload JWT Key Set",
+            )?,
+        };
+        self.jwt = Some((stats, counters));
+
+        Ok(self)
+    }
+
+    /// The histogram of request durations, labeled by the method, the route,
+    /// and the response status (see RequestMetrics).
+    pub fn request_durations(&self) -> HistogramVec {
+        self.requests.clone()
+    }
+
+    /// The histogram of storage call durations, labeled by the operation and
+    /// its outcome (see storage::MeteredStorage).
+    pub fn storage_durations(&self) -> HistogramVec {
+        self.storage.clone()
+    }
+
+    /// Returns the current values of all metrics in the Prometheus text format.
+    pub fn gather(&self) -> prometheus::Result<String> {
+        let _guard = self
+            .scrape
+            .lock()
+            .unwrap_or_else(|poisoned| poisoned.into_inner());
+
+        if let Some((stats, metrics)) = &self.pool {
+            metrics.max_size.set(stats.max_size() as i64);
+            metrics.size.set(stats.size() as i64);
+            metrics.available.set(stats.available() as i64);
+            metrics.waiting.set(stats.waiting() as i64);
+            catch_up(&metrics.checkouts, stats.checkouts());
+
+            let seconds = stats.wait_time().as_secs_f64();
+            let current = metrics.wait_seconds.get();
+            if seconds > current {
+                metrics.wait_seconds.inc_by(seconds - current);
+            }
+        }
+        for (stats, counters) in [&self.snippet_cache, &self.page_cache]
+            .into_iter()
+            .flatten()
+        {
+            catch_up(&counters.hits, stats.hits());
+            catch_up(&counters.misses, stats.misses());
+            catch_up(&counters.evictions, stats.evictions());
+        }
+        if let Some((stats, counters)) = &self.jwt {
+            catch_up(&counters.cache_hits, stats.cache_hits());
+            catch_up(&counters.cache_misses, stats.cache_misses());
+            catch_up(&counters.verifications, stats.verifications());
+            catch_up(
+                &counters.verification_failures,
+                stats.verification_failures(),
+            );
+            catch_up(&counters.jwks_refreshes, stats.jwks_refreshes());
+            catch_up(
+                &counters.jwks_refresh_failures,
+                stats.jwks_refresh_failures(),
+            );
+
+            let seconds = stats.verification_time().as_secs_f64();
+            let current = counters.verification_seconds.get();
+            if seconds > current {
+                counters.verification_seconds.inc_by(seconds - current);
+            }
+        }
+
+        let mut buffer = Vec::new();
+        TextEncoder::new().encode(&self.registry.gather(), &mut buffer)?;
+
+        String::from_utf8(buffer).map_err(|e| prometheus::Error::Msg(e.to_string()))
+    }
+
+    fn gauge(&self, name: &str, help: &str) -> prometheus::Result<IntGauge> {
+        let gauge = IntGauge::with_opts(Opts::new(name, help))?;
+        self.registry.register(Box::new(gauge.clone()))?;
+
+        Ok(gauge)
+    }
+
+    fn counter(&self, name: &str, help: &str) -> prometheus::Result<IntCounter> {
+        let counter = IntCounter::with_opts(Opts::new(name, help))?;
+        self.registry.register(Box::new(counter.clone()))?;
+
+        Ok(counter)
+    }
+
+    /// Registers the counters of a cache, whose names start with `name`.
+    fn cache_counters(&self, name: &str, description: &str) -> prometheus::Result<CacheCounters> {
+        Ok(CacheCounters {
+            hits: self.counter(
+                &format!("{}_hits_total", name),
+                &format!("{} hits", description),
+            )?,
+            misses: self.counter(
+                &format!("{}_misses_total", name),
+                &format!("{} misses", description),
+            )?,
+            evictions: self.counter(
+                &format!("{}_evictions_total", name),
+                &format!("{} evictions", description),
+            )?,
+        })
+    }
+}
+
+/// Advance the counter to the given value of the counter it mirrors.
+fn catch_up(counter: &IntCounter, value: u64) {
+    let current = counter.get();
+    if value > current {
+        counter.inc_by(value - current);
+    }
+}
+
+/// The time when Rocket started processing a request.
+struct RequestStart(Option<Instant>);
+
+/// Rocket fairing that records the latency of each request, labeled by the
+/// request method, the matched route, and the response status.
+pub struct RequestMetrics(pub HistogramVec);
+
+#[rocket::async_trait]
+impl Fairing for RequestMetrics {
+    fn info(&self) -> Info {
+        Info {
+            name: "Request latency metrics",
+            kind: Kind::Request | Kind::Response,
+        }
+    }
+
+    async fn on_request(&self, request: &mut Request<'_>, _: &mut Data<'_>) {
+        request.local_cache(|| RequestStart(Some(Instant::now())));
+    }
+
+    async fn on_response<'r>(&self, request: &'r Request<'_>, response: &mut Response<'r>) {
+        if let RequestStart(Some(started)) = request.local_cache(|| RequestStart(None)) {
+            // the route template (e.g. "/v1/snippets/<id>") rather than the
+            // actual path is used, so that the number of series is bounded
+            let route = request
+                .route()
+                .map_or_else(|| "unmatched".to_string(), |route| route.uri.to_string());
+
+            self.0
+                .with_label_values(&[
+                    request.method().as_str(),
+                    route.as_str(),
+                    &response.status().code.to_string(),
+                ])
+                .observe(started.elapsed().as_secs_f64());
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn gather() {
+        let metrics = Metrics::new()
+            .unwrap()
+            .with_cache_stats(CacheStats::default())
+            .unwrap()
+            .with_page_cache_stats(CacheStats::default())
+            .unwrap()
+            .with_jwt_stats(JwtStats::default())
+            .unwrap();
+
+        metrics
+            .storage_durations()
+            .with_label_values(&["get", "ok"])
+            .observe(0.002);
+        metrics
+            .requests
+            .with_label_values(&["GET", "/v1/snippets/<id>", "200"])
+            .observe(0.003);
+
+        let text = metrics.gather().unwrap();
+        for expected in [
+            "xsnippet_http_request_duration_seconds_bucket{",
+            "route=\"/v1/snippets/<id>\"",
+            "xsnippet_storage_operation_duration_seconds_count{operation=\"get\",outcome=\"ok\"} 1",
+            "xsnippet_snippet_cache_hits_total 0",
+            "xsnippet_page_cache_misses_total 0",
+            "xsnippet_jwt_verifications_total 0",
+            "xsnippet_jwt_verification_seconds_total 0",
+        ] {
+            assert!(
+                text.contains(expected),
+                "{} not found in:\n{}",
+                expected,
+                text
+            );
+        }
+
+        // the pool metrics are only exported if the pool stats are provided
+        assert!(!text.contains("xsnippet_db_pool_size"));
+    }
+
+    #[test]
+    fn catch_up_counter() {
+        let counter = IntCounter::new("spam", "eggs").unwrap();
+
+        catch_up(&counter, 3);
+        assert_eq!(counter.get(), 3);
+        catch_up(&counter, 3);
+        assert_eq!(counter.get(), 3);
+        catch_up(&counter, 5);
+        assert_eq!(counter.get(), 5);
+    }
+}
@@ -0,0 +1,571 @@
+"""Load and latency benchmark for XSnippet API.
+
+The benchmark reuses the live server fixtures from test_gabbits.py: it boots
+XSnippet API against a throwaway PostgreSQL database, seeds the database with
+the requested number of snippets, and then drives concurrent requests against
+a few representative endpoints. The results (latency percentiles and
+throughput per scenario) are printed as JSON, so that the runs can be stored
+and compared between commits.
+
+Usage (ROCKET_DATABASE_URL must point to a PostgreSQL instance that allows
+creation of new databases, just like for the functional tests):
+
+    python tests/benchmark.py --snippets 100000 --concurrency 16 \\
+        --duration 30 --output bench_output.json
+
+The `overload` scenario makes the database periodically unresponsive (by
+locking the snippets table) while clients keep requesting snippets. With a
+small pool and a short checkout timeout, e.g.
+
+    python tests/benchmark.py --scenario overload --concurrency 64 \\
+        --pool-size 8 --pool-wait-timeout-ms 200
+
+the requests that can't get a connection in time are rejected with 503
+Service Unavailable (reported as `rejected`), and the tail latency stays
+bounded by the checkout timeout instead of growing with the backlog.
+
+Responses are requested as JSON without compression by default. Use
+`--accept` and `--accept-encoding` to benchmark other representations, or
+`--compare-formats` to run the read-only scenarios once per combination of the
+supported formats and content codings, e.g.
+
+    python tests/benchmark.py --scenario get --scenario list-by-tag \\
+        --compare-formats
+
+Along with the latencies, each scenario reports the mean size of response
+bodies as sent over the wire (i.e. after compression) and the CPU time the
+server spent per request. The latter covers the whole request processing, so
+only the differences between the formats are meaningful: they are the cost of
+serialization and compression.
+
+The `deep-pagination` scenario requests pages far from the beginning of the
+list by passing snippet slugs as markers, which the server has to look up
+first, while `deep-pagination-cursor` follows the opaque cursors the server
+returns in the Link headers, which point at the position right away. Use
+`--count-estimate` to request the estimated total count along with the pages,
+and `--grow-to` to check that the latency of deep pages does not depend on the
+size of the table: the table is grown to each of the given sizes after the
+scenarios are run, and the pagination scenarios are run again, e.g.
+
+    python tests/benchmark.py --scenario deep-pagination \\
+        --scenario deep-pagination-cursor --count-estimate \\
+        --snippets 100000 --grow-to 1000000 --grow-to 5000000
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.parse
+
+import requests
+import sqlalchemy
+
+from sqlalchemy import text
+
+import test_gabbits
+
+
+SCENARIOS = (
+    "create",
+    "get",
+    "list-by-tag",
+    "deep-pagination",
+    "deep-pagination-cursor",
+    "overload",
+)
+TAGS_COUNT = 100
+
+# Media types and content codings compared by --compare-formats.
+FORMATS = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+}
+ENCODINGS = ("identity", "gzip", "br", "zstd")
+# Scenarios that do not modify the data, i.e. can be repeated for every
+# format without affecting the results of each other.
+READ_SCENARIOS = ("get", "list-by-tag", "deep-pagination", "deep-pagination-cursor")
+# Scenarios that are run again by --grow-to.
+PAGINATION_SCENARIOS = ("deep-pagination", "deep-pagination-cursor")
+# The positions of the pages requested by the pagination scenarios, as
+# fractions of the number of snippets.
+PAGINATION_DEPTHS = (0.25, 0.5, 0.75, 0.99)
+
+# In the overload scenario, the database stops responding for STALL_DURATION
+# seconds every STALL_PERIOD seconds.
+STALL_DURATION = 0.5
+STALL_PERIOD = 1.0
+
+
+class XSnippetApiForBenchmarks(test_gabbits.XSnippetApi):
+    """Start live server of XSnippet API built in the release mode."""
+
+    _cargo_build_args = ["--release"]
+
+    def __init__(self, pool_size=None, pool_wait_timeout_ms=None):
+        super().__init__()
+
+        # do not let the debug logging affect the measurements
+        self.environ["ROCKET_TRACING"] = "warn"
+
+        if pool_size is not None:
+            self.environ["ROCKET_DATABASE_POOL_SIZE"] = str(pool_size)
+        if pool_wait_timeout_ms is not None:
+            self.environ["ROCKET_DATABASE_POOL_WAIT_TIMEOUT_MS"] = str(pool_wait_timeout_ms)
+
+        # the number of snippets inserted by seed()
+        self.seeded = 0
+
+    @property
+    def endpoint(self):
+        return f"http://{test_gabbits.XSNIPPET_API_HOST}:{self.port}/v1/snippets"
+
+    def seed(self, count, batch_size=50000):
+        """Insert `count` more snippets directly into the database.
+
+        Creating millions of snippets via the API would take longer than the
+        benchmark itself, so the rows are generated by PostgreSQL instead.
+        The new snippets are newer than the ones inserted by previous calls.
+        """
+
+        engine = sqlalchemy.create_engine(self.test_db_url)
+        syntaxes = list(self._syntaxes or ["python"])
+        epoch = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+        with engine.begin() as conn:
+            for start in range(self.seeded, self.seeded + count, batch_size):
+                stop = min(start + batch_size, self.seeded + count)
+                params = {
+                    "start": start,
+                    "stop": stop - 1,
+                    "epoch": epoch,
+                    "syntaxes": syntaxes,
+                    "tags": TAGS_COUNT,
+                }
+
+                # slugs are derived from the sequence number, so that they are
+                # unique, and creation dates are monotonically increasing, so
+                # that pagination goes through all the rows in a stable order
+                conn.execute(text("""
+                    INSERT INTO snippets (slug, title, syntax, created_at, updated_at)
+                    SELECT 'b' || to_hex(i),
+                           'snippet #' || i,
+                           (:syntaxes)[1 + i % cardinality(:syntaxes)],
+                           :epoch + i * interval '1 second',
+                           :epoch + i * interval '1 second'
+                    FROM generate_series(:start, :stop) AS i
+                """), params)
+                # changesets can only be inserted into existing partitions,
+                # which the server creates ahead of the snippets periodically
+                conn.execute(text("SELECT changesets_create_partitions()"))
+                conn.execute(text("""
+                    WITH contents AS (
+                        SELECT id, created_at, updated_at,
+                               repeat(md5(slug), 1 + id % 32) AS content
+                        FROM snippets
+                        WHERE slug = ANY(ARRAY(
+                            SELECT 'b' || to_hex(i) FROM generate_series(:start, :stop) AS i
+                        ))
+                    ), inserted AS (
+                        INSERT INTO blobs (hash, content)
+                        SELECT DISTINCT sha256(convert_to(content, 'UTF8')), content
+                        FROM contents
+                        ON CONFLICT DO NOTHING
+                    )
+                    INSERT INTO changesets (snippet_id, version, blob_hash, created_at, updated_at)
+                    SELECT id, 0, sha256(convert_to(content, 'UTF8')), created_at, updated_at
+                    FROM contents
+                """), params)
+                conn.execute(text("""
+                    INSERT INTO tags (snippet_id, value)
+                    SELECT id, 'tag' || (id % :tags)
+                    FROM snippets
+                    WHERE slug = ANY(ARRAY(
+                        SELECT 'b' || to_hex(i) FROM generate_series(:start, :stop) AS i
+                    ))
+                """), params)
+
+            conn.execute(text("ANALYZE"))
+
+        engine.dispose()
+        self.seeded += count
+
+    def sample_slugs(self, count):
+        """Return up to `count` random slugs of existing snippets."""
+
+        engine = sqlalchemy.create_engine(self.test_db_url)
+        with engine.connect() as conn:
+            slugs = conn.execute(
+                text("SELECT slug FROM snippets ORDER BY random() LIMIT :count"),
+                {"count": count},
+            ).scalars().all()
+        engine.dispose()
+
+        return slugs
+
+    def sample_markers(self, depths):
+        """Return slugs of snippets at the given positions of the default order."""
+
+        engine = sqlalchemy.create_engine(self.test_db_url)
+        with engine.connect() as conn:
+            markers = [
+                conn.execute(
+                    text("""
+                        SELECT slug FROM snippets
+                        ORDER BY created_at DESC, id DESC
+                        OFFSET :depth LIMIT 1
+                    """),
+                    {"depth": depth},
+                ).scalar()
+                for depth in depths
+            ]
+        engine.dispose()
+
+        return [marker for marker in markers if marker is not None]
+
+    def sample_cursors(self, markers, params):
+        """Return cursors pointing at the same snippets as the given slugs.
+
+        Cursors are signed by the server, so they are taken from the links to
+        the next pages. The page that follows a slug is requested with a
+        cursor pointing at the last snippet of that page instead, which is as
+        deep as the slug itself for the tables the benchmark works with.
+        """
+
+        cursors = []
+        for marker in markers:
+            response = requests.get(
+                self.endpoint, params={**params, "marker": marker}
+            )
+            response.raise_for_status()
+
+            next_url = response.links.get("next", {}).get("url")
+            if next_url:
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(next_url).query)
+                cursors.append(query["marker"][0])
+
+        return cursors
+
+    def cpu_time(self):
+        """Return the CPU time (in seconds) consumed by the server so far.
+
+        Only supported on Linux; None is returned elsewhere.
+        """
+
+        try:
+            with open(f"/proc/{self.process.pid}/stat") as f:
+                # the command name may contain spaces, so the fields are
+                # counted from the closing parenthesis that terminates it
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            return None
+
+        # utime and stime, i.e. the 14th and the 15th fields of the file
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def stall(self, deadline):
+        """Make the database unresponsive periodically until the deadline.
+
+        Locking the table blocks all queries that read it until the lock is
+        released, which is how a database struggling under load (or waiting
+        for a long-running migration) looks from the application side.
+        """
+
+        engine = sqlalchemy.create_engine(self.test_db_url)
+        with engine.connect() as conn:
+            while time.monotonic() < deadline:
+                with conn.begin():
+                    conn.execute(text("LOCK TABLE snippets IN ACCESS EXCLUSIVE MODE"))
+                    time.sleep(STALL_DURATION)
+                time.sleep(max(STALL_PERIOD - STALL_DURATION, 0.0))
+        engine.dispose()
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+
+    rank = max(math.ceil(percent / 100.0 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def _summarize(latencies, errors, rejected, elapsed, body_bytes, cpu_time):
+    latencies = sorted(latencies)
+
+    def to_ms(value):
+        return round(value * 1000.0, 3) if value is not None else None
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rejected": rejected,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "body_bytes": round(body_bytes / len(latencies), 1) if latencies else None,
+        "server_cpu_ms": (
+            to_ms(cpu_time / len(latencies)) if latencies and cpu_time is not None else None
+        ),
+        "latency_ms": {
+            "mean": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": to_ms(_percentile(latencies, 50)),
+            "p95": to_ms(_percentile(latencies, 95)),
+            "p99": to_ms(_percentile(latencies, 99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def _make_request_factory(scenario, fixture, args):
+    """Return a function that generates (method, url, kwargs) for a scenario."""
+
+    endpoint = fixture.endpoint
+
+    if scenario == "create":
+        syntaxes = list(fixture._syntaxes or ["python"])
+
+        def factory(rng):
+            snippet = {
+                "title": "benchmark",
+                "syntax": rng.choice(syntaxes),
+                "content": "x" * rng.randint(16, args.content_size),
+                "tags": [f"tag{rng.randrange(TAGS_COUNT)}"],
+            }
+            return "POST", endpoint, {
+                "data": json.dumps(snippet),
+                "headers": {"Content-Type": "application/json"},
+            }
+
+    elif scenario in ("get", "overload"):
+        slugs = fixture.sample_slugs(args.samples)
+
+        def factory(rng):
+            return "GET", f"{endpoint}/{rng.choice(slugs)}", {}
+
+    elif scenario == "list-by-tag":
+        def factory(rng):
+            return "GET", endpoint, {
+                "params": {
+                    "tag": f"tag{rng.randrange(TAGS_COUNT)}",
+                    "limit": 20,
+                    "view": args.list_view,
+                },
+            }
+
+    elif scenario in ("deep-pagination", "deep-pagination-cursor"):
+        params = {"limit": 20, "view": args.list_view}
+        if args.count_estimate:
+            params["count"] = "estimated"
+
+        depths = [int(fixture.seeded * fraction) for fraction in PAGINATION_DEPTHS]
+        markers = fixture.sample_markers(depths)
+        if scenario == "deep-pagination-cursor":
+            markers = fixture.sample_cursors(markers, params)
+
+        def factory(rng):
+            return "GET", endpoint, {
+                "params": {**params, "marker": rng.choice(markers)},
+            }
+
+    else:
+        raise ValueError(f"Unknown scenario: {scenario}")
+
+    return factory
+
+
+def run_scenario(scenario, fixture, args, accept=None, accept_encoding=None):
+    """Drive concurrent requests for a given scenario and collect latencies."""
+
+    factory = _make_request_factory(scenario, fixture, args)
+    deadline = time.monotonic() + args.duration
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    rejected = [0]
+    body_bytes = [0]
+
+    # requests asks for compressed responses by default, hence the coding is
+    # always set explicitly
+    headers = {
+        "Accept": accept or FORMATS[args.accept],
+        "Accept-Encoding": accept_encoding or args.accept_encoding,
+    }
+
+    def worker(seed):
+        rng = random.Random(seed)
+        session = requests.Session()
+        session.headers.update(headers)
+        local_latencies = []
+        local_errors = 0
+        local_rejected = 0
+        local_bytes = 0
+
+        while time.monotonic() < deadline:
+            method, url, kwargs = factory(rng)
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url, stream=True, **kwargs)
+                # the body is read as is, i.e. without decompressing it
+                size = len(response.raw.read(decode_content=False))
+                status = response.status_code
+            except requests.RequestException:
+                status = None
+            finished = time.perf_counter()
+
+            # requests shed under overload are expected (and must be fast),
+            # so their latencies are included into the distribution
+            if status is not None and (status < 400 or status == 503):
+                local_latencies.append(finished - started)
+                local_rejected += status == 503
+                local_bytes += size
+            else:
+                local_errors += 1
+
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+            rejected[0] += local_rejected
+            body_bytes[0] += local_bytes
+
+    cpu_started = fixture.cpu_time()
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency + 1) as executor:
+        if scenario == "overload":
+            executor.submit(fixture.stall, deadline)
+        futures = [executor.submit(worker, args.seed + i) for i in range(args.concurrency)]
+        for future in futures:
+            future.result()
+    elapsed = time.monotonic() - started
+    cpu_finished = fixture.cpu_time()
+    cpu_time = cpu_finished - cpu_started if cpu_started is not None else None
+
+    return _summarize(latencies, errors[0], rejected[0], elapsed, body_bytes[0], cpu_time)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--snippets", type=int, default=10000,
+                        help="number of snippets to seed the database with")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="duration of each scenario in seconds")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run (can be repeated; default: all)")
+    parser.add_argument("--content-size", type=int, default=4096,
+                        help="maximum size of created snippets in bytes")
+    parser.add_argument("--samples", type=int, default=1000,
+                        help="number of distinct snippets requested by `get`")
+    parser.add_argument("--seed", type=int, default=42,
+                        help="seed of the random number generators")
+    parser.add_argument("--pool-size", type=int,
+                        help="maximum number of database connections of the server")
+    parser.add_argument("--pool-wait-timeout-ms", type=int,
+                        help="how long the server waits for a database connection")
+    parser.add_argument("--accept", choices=FORMATS, default="json",
+                        help="format of the responses")
+    parser.add_argument("--accept-encoding", default="identity",
+                        help="value of the Accept-Encoding header of the requests")
+    parser.add_argument("--list-view", choices=("full", "summary"), default="full",
+                        help="view of the snippets requested by the list scenarios")
+    parser.add_argument("--count-estimate", action="store_true",
+                        help="request the estimated total count of snippets "
+                             "along with the pages in the pagination scenarios")
+    parser.add_argument("--grow-to", type=int, action="append", default=[],
+                        help="grow the table to this number of snippets once the "
+                             "scenarios are run, and run the pagination scenarios "
+                             "again (can be repeated)")
+    parser.add_argument("--compare-formats", action="store_true",
+                        help="run the read-only scenarios for every combination "
+                             "of the formats and the content codings")
+    parser.add_argument("--output", help="write the JSON report to this file")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = args.scenario or list(SCENARIOS)
+
+    fixture = XSnippetApiForBenchmarks(args.pool_size, args.pool_wait_timeout_ms)
+    fixture.start_fixture()
+    try:
+        seeding_started = time.monotonic()
+        fixture.seed(args.snippets)
+        seeding_time = time.monotonic() - seeding_started
+
+        report = {
+            "revision": _git_revision(),
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "parameters": {
+                "snippets": args.snippets,
+                "concurrency": args.concurrency,
+                "duration": args.duration,
+                "content_size": args.content_size,
+                "seed": args.seed,
+                "pool_size": args.pool_size,
+                "pool_wait_timeout_ms": args.pool_wait_timeout_ms,
+                "accept": FORMATS[args.accept],
+                "accept_encoding": args.accept_encoding,
+                "list_view": args.list_view,
+                "count_estimate": args.count_estimate,
+            },
+            "seeding_time": round(seeding_time, 3),
+            "scenarios": {},
+        }
+
+        # scenarios that only read data go first, so that their results do
+        # not depend on how many snippets the `create` scenario managed to add;
+        # overload goes last, so that it does not affect the other scenarios
+        order = {"create": 1, "overload": 2}
+        for scenario in sorted(scenarios, key=lambda s: order.get(s, 0)):
+            report["scenarios"][scenario] = run_scenario(scenario, fixture, args)
+
+        if args.compare_formats:
+            report["formats"] = {}
+            for name, media_type in FORMATS.items():
+                for encoding in ENCODINGS:
+                    report["formats"][f"{name}+{encoding}"] = {
+                        scenario: run_scenario(scenario, fixture, args, media_type, encoding)
+                        for scenario in scenarios
+                        if scenario in READ_SCENARIOS
+                    }
+
+        # the latency of deep pages must not depend on the size of the table
+        if args.grow_to:
+            report["growth"] = {}
+        for size in sorted(args.grow_to):
+            if size > fixture.seeded:
+                fixture.seed(size - fixture.seeded)
+            report["growth"][fixture.seeded] = {
+                scenario: run_scenario(scenario, fixture, args)
+                for scenario in scenarios
+                if scenario in PAGINATION_SCENARIOS
+            }
+    finally:
+        fixture.stop_fixture()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import pytest
+
+
+def pytest_collection_modifyitems(config, items):
+    """Keep the tests generated from the same YAML file on one xdist worker.
+
+    Tests within a YAML file depend on each other and share a live server
+    started by the fixture, so they must be executed sequentially and in
+    order. When the suite is run with `pytest -n auto --dist loadgroup`,
+    pytest-xdist schedules all tests of the same group to the same worker.
+    """
+
+    group = None
+    for item in items:
+        callspec = getattr(item, "callspec", None)
+        if callspec is None:
+            continue
+
+        # Gabbi generates a `start_<test>` item that starts the fixtures
+        # before the first test of every YAML file
+        if callspec.id.startswith("start_"):
+            group = callspec.id[len("start_"):]
+        if group is not None:
+            item.add_marker(pytest.mark.xdist_group(group))
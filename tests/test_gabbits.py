@@ -4,6 +4,7 @@ import json
 import math
 import os
 import random
+import re
 import socket
 import string
 import subprocess
@@ -25,14 +26,116 @@ from gabbi.handlers import base
 from sqlalchemy import text
 
 
+def _free_port(host):
+    """Return a TCP port that is currently not used on the given host."""
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class _LivePort:
+    """The port of the live server of the fixture that is currently running.
+
+    Gabbi bakes the port into the tests when they are generated, whereas
+    every fixture picks a free port when it starts a server, so that servers
+    of different pytest-xdist workers run side by side, and a new server
+    never has to wait for the port of the previous one to be released. The
+    fixtures within a worker run one at a time, so the tests can look the
+    port up when a request is made.
+    """
+
+    value = None
+
+    def __int__(self):
+        return self.value
+
+    def __str__(self):
+        return str(self.value)
+
+
 XSNIPPET_API_HOST = "127.0.0.1"
-XSNIPPET_API_PORT = 8000
+XSNIPPET_API_PORT = _LivePort()
+
+# Setting this environment variable to a non-empty value makes the fixtures
+# apply schema migrations to every test database, instead of cloning the
+# template database. Useful for comparing the fixture setup timings.
+MIGRATE_EACH_DATABASE = bool(os.getenv("XSNIPPET_TESTS_MIGRATE_EACH_DATABASE"))
+
+# The server binaries and the template database are created once per test
+# session and reused by all fixtures.
+_server_binaries = {}
+_template_database = None
 
 
 def _random_name(length=8):
     return ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
 
 
+def _server_binary(build_args=()):
+    """Build XSnippet API (once per session) and return the path to the binary."""
+
+    build_args = tuple(build_args)
+    if build_args not in _server_binaries:
+        output = subprocess.run(
+            ["cargo", "build", "--message-format=json-render-diagnostics", *build_args],
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+
+        for line in output.decode().splitlines():
+            message = json.loads(line)
+            if message.get("reason") == "compiler-artifact" and message.get("executable"):
+                _server_binaries[build_args] = message["executable"]
+
+    return _server_binaries[build_args]
+
+
+def _migrate(database_url):
+    """Apply schema migrations to the database identified by the given URL."""
+
+    # the connection string is passed explicitly, so that ROCKET_DATABASE_URL
+    # keeps pointing to the management database
+    alembic.config.main([
+        "-x", "database_url={}".format(database_url.render_as_string(hide_password=False)),
+        "upgrade", "head",
+    ])
+
+
+def _create_database(management_db, name, template=None):
+    url = management_db.url.set(database=name)
+
+    statement = "CREATE DATABASE {database} OWNER {username}".format(
+        **url.translate_connect_args())
+    if template:
+        statement += " TEMPLATE {}".format(template)
+
+    with management_db.connect() as conn:
+        conn.execute(text(statement))
+
+    return url
+
+
+def _drop_database(management_db, name):
+    with management_db.connect() as conn:
+        conn.execute(text("DROP DATABASE IF EXISTS {};".format(name)))
+
+
+def _template_database_name(management_db):
+    """Create a migrated template database (once per session) and return its name."""
+
+    global _template_database
+
+    if _template_database is None:
+        name = "template_" + _random_name()
+        _migrate(_create_database(management_db, name))
+        atexit.register(_drop_database, management_db, name)
+
+        _template_database = name
+
+    return _template_database
+
+
 def _base64urlUint(num):
     """base64url encoding of the value's unsigned big-endian representation."""
 
@@ -45,7 +148,7 @@ def _base64urlUint(num):
 class XSnippetApi(gabbi.fixture.GabbiFixture):
     """Start live server of XSnippet API."""
 
-    _launch_command = ["cargo", "run"]
+    _cargo_build_args = []
     _launch_timeout = 5.0
     _shutdown_timeout = 5.0
     _syntaxes = ["python", "rust", "clojure", "json", "lua"]
@@ -53,7 +156,6 @@ class XSnippetApi(gabbi.fixture.GabbiFixture):
     def __init__(self):
         self.environ = {
             "ROCKET_ADDRESS": XSNIPPET_API_HOST,
-            "ROCKET_PORT": str(XSNIPPET_API_PORT),
             "ROCKET_LOG_LEVEL": "critical",
             "ROCKET_TRACING": "debug",
         }
@@ -68,7 +170,7 @@ class XSnippetApi(gabbi.fixture.GabbiFixture):
         self.process = None
 
     def setup_db(self):
-        """Create a temporary database and apply schema migrations."""
+        """Create a temporary database with the up-to-date schema."""
 
         # admin connection that allows creation of new databases
         self.management_db = sqlalchemy.create_engine(
@@ -79,37 +181,33 @@ class XSnippetApi(gabbi.fixture.GabbiFixture):
             },
         )
 
-        # create a temporary database with a random name
-        self.test_db_url = self.management_db.url.set(database=_random_name())
-
-        with self.management_db.connect() as conn:
-            conn.execute(
-                text("CREATE DATABASE {database} OWNER {username};".format(
-                     **self.test_db_url.translate_connect_args())))
-
-        # apply schema migrations to the temporary database. Both
-        # Alembic and XSnippet API expect the connection string to be
-        # passed via the ROCKET_DATABASE_URL environment variable, so
-        # we update the variable to point to the temporary database for
-        # the duration of the test
-        os.environ["ROCKET_DATABASE_URL"] = self.test_db_url.render_as_string(hide_password=False)
-        alembic.config.main(["upgrade", "head"])
+        # create a temporary database with a random name. Cloning the template
+        # database that has already been migrated is much faster than applying
+        # all schema migrations one by one
+        if MIGRATE_EACH_DATABASE:
+            self.test_db_url = _create_database(self.management_db, _random_name())
+            _migrate(self.test_db_url)
+        else:
+            self.test_db_url = _create_database(
+                self.management_db, _random_name(),
+                template=_template_database_name(self.management_db))
+
+        # XSnippet API expects the connection string to be passed via the
+        # ROCKET_DATABASE_URL environment variable
+        self.environ["ROCKET_DATABASE_URL"] = self.test_db_url.render_as_string(hide_password=False)
 
     def teardown_db(self):
         """Clean up the temporary database."""
 
-        with self.management_db.connect() as conn:
-            conn.execute(
-                text("DROP DATABASE IF EXISTS {};".format(self.test_db_url.database)))
-
-        # restore the original value of ROCKET_DATABASE_URL, so that
-        # it can be used by the fixture to create new databases again
-        os.environ["ROCKET_DATABASE_URL"] = self.management_db.url.render_as_string(hide_password=False)
-
+        _drop_database(self.management_db, self.test_db_url.database)
 
     def start_server(self):
+        self.port = _free_port(XSNIPPET_API_HOST)
+        XSNIPPET_API_PORT.value = self.port
+
         environ = os.environ.copy()
         environ.update(self.environ)
+        environ["ROCKET_PORT"] = str(self.port)
 
         # capture stdout/stderr of xsnippet-api process to a temporary file.
         # Alternatively, we could either connect the child process to our
@@ -118,10 +216,10 @@ class XSnippetApi(gabbi.fixture.GabbiFixture):
         # because the child process can easily fill up the pipe buffer if we do
         # not regularly read from it in a separate thread).
         self.application_log = tempfile.TemporaryFile()
-        self.process = subprocess.Popen(self._launch_command, env=environ,
+        self.process = subprocess.Popen([_server_binary(self._cargo_build_args)], env=environ,
                                         stdout=self.application_log,
                                         stderr=subprocess.STDOUT)
-        _wait_for_socket(XSNIPPET_API_HOST, XSNIPPET_API_PORT, self._launch_timeout)
+        _wait_for_socket(XSNIPPET_API_HOST, self.port, self._launch_timeout)
 
     def stop_server(self):
         if self.process:
@@ -141,8 +239,18 @@ class XSnippetApi(gabbi.fixture.GabbiFixture):
     def start_fixture(self):
         """Start the live server."""
 
+        started_at = time.monotonic()
         self.setup_db()
+        db_ready_at = time.monotonic()
         self.start_server()
+        server_ready_at = time.monotonic()
+
+        print(
+            f"{self.__class__.__name__} setup took {server_ready_at - started_at:.3f}s "
+            f"(database: {db_ready_at - started_at:.3f}s, "
+            f"server: {server_ready_at - db_ready_at:.3f}s)",
+            file=sys.stderr,
+        )
 
         # Due to the issue in Gabbi, when `pytest` is invoked with either
         # `--exitfirst/-x` or `--maxfail`, and there are enough failures to
@@ -334,7 +442,7 @@ class XSnippetApiWithSnippets(XSnippetApi):
         super().start_fixture()
 
         session = requests.Session()
-        endpoint = f"http://{XSNIPPET_API_HOST}:{XSNIPPET_API_PORT}/v1/snippets"
+        endpoint = f"http://{XSNIPPET_API_HOST}:{self.port}/v1/snippets"
 
         # Snippets are inserted in reverse because they are returned in
         # descending order by default.
@@ -343,6 +451,18 @@ class XSnippetApiWithSnippets(XSnippetApi):
             response.raise_for_status()
 
 
+class XSnippetApiWithSmallBulkRequestSize(XSnippetApiWithCustomAuthProvider):
+    """Start live server of XSnippet API that only accepts small bulk requests."""
+
+    MAX_BULK_REQUEST_SIZE = 1024
+
+    def __init__(self):
+        super().__init__()
+
+        # a TOML inline table, see the comment on ROCKET_SYNTAXES
+        self.environ["ROCKET_LIMITS"] = "{max_bulk_request_size=%d}" % self.MAX_BULK_REQUEST_SIZE
+
+
 class XSnippetApiWithImportedSnippets(XSnippetApiWithCustomAuthProvider):
     """Start live server of XSnippet API with pre-imported snippets.
 
@@ -415,7 +535,7 @@ class XSnippetApiWithImportedSnippets(XSnippetApiWithCustomAuthProvider):
 
         token = self.tokens["TOKEN_IMPORT"]
         session = requests.Session()
-        endpoint = f"http://{XSNIPPET_API_HOST}:{XSNIPPET_API_PORT}/v1/snippets/import"
+        endpoint = f"http://{XSNIPPET_API_HOST}:{self.port}/v1/snippets/import"
 
         for snippet in self.snippets:
             response = session.post(endpoint, data=json.dumps(snippet),
@@ -423,8 +543,88 @@ class XSnippetApiWithImportedSnippets(XSnippetApiWithCustomAuthProvider):
             response.raise_for_status()
 
 
+class XSnippetApiWithReplica(XSnippetApi):
+    """Start live server of XSnippet API with a read replica of the database.
+
+    The replica is simulated by a second database that has the same schema,
+    but is not kept in sync with the primary one. Instead, it contains a
+    snippet of its own, so that the tests can tell which database a response
+    came from.
+    """
+
+    REPLICA_SNIPPET_ID = "replica"
+    READ_YOUR_WRITES_WINDOW_MS = 1000
+
+    def setup_db(self):
+        super().setup_db()
+
+        self.replica_db_url = _create_database(
+            self.management_db, _random_name(),
+            template=_template_database_name(self.management_db))
+
+        replica_db = sqlalchemy.create_engine(self.replica_db_url)
+        try:
+            with replica_db.begin() as conn:
+                conn.execute(text("""
+                    WITH snippet AS (
+                        INSERT INTO snippets (slug, title) VALUES (:slug, 'replica only')
+                        RETURNING id
+                    ), blob AS (
+                        INSERT INTO blobs (hash, content)
+                        VALUES (sha256(convert_to(:content, 'UTF8')), :content)
+                        RETURNING hash
+                    )
+                    INSERT INTO changesets (snippet_id, version, blob_hash)
+                    SELECT snippet.id, 0, blob.hash FROM snippet, blob
+                """), {"slug": self.REPLICA_SNIPPET_ID, "content": "replicated"})
+        finally:
+            replica_db.dispose()
+
+        self.environ.update({
+            # a TOML array, see the comment on ROCKET_SYNTAXES
+            "ROCKET_DATABASE_REPLICA_URLS": json.dumps([
+                self.replica_db_url.render_as_string(hide_password=False),
+            ]),
+            "ROCKET_DATABASE_READ_YOUR_WRITES_WINDOW_MS": str(self.READ_YOUR_WRITES_WINDOW_MS),
+            # cached pages would hide which database a page came from
+            "ROCKET_PAGE_CACHE_SIZE": "0",
+        })
+
+    def teardown_db(self):
+        try:
+            super().teardown_db()
+        finally:
+            _drop_database(self.management_db, self.replica_db_url.database)
+
+
+def _cursor_slug(marker):
+    """Return the slug of the snippet a pagination cursor points at.
+
+    Cursors are signed by the server, so the tests can't predict them, but
+    they can check which snippet a cursor points at (see web::cursor for the
+    layout). Values that are not cursors are returned as is.
+    """
+
+    try:
+        cursor = base64.urlsafe_b64decode(marker + "=" * (-len(marker) % 4))
+    except ValueError:
+        return marker
+
+    # version, created_at, internal id, and the rank flag; then the rank (if
+    # the flag is set), the slug, and the 16-byte signature
+    header_length = 1 + 8 + 4 + 1
+    if len(cursor) <= header_length + 16 or cursor[0] != 1:
+        return marker
+    slug_start = header_length + (4 if cursor[header_length - 1] else 0)
+    return cursor[slug_start:-16].decode("utf-8")
+
+
 class LinkHeaderResponseHandler(base.ResponseHandler):
-    """Link HTTP header response handler for Gabbi."""
+    """Link HTTP header response handler for Gabbi.
+
+    Pagination cursors in the links are replaced by the slugs of the snippets
+    they point at, so that the expected links can refer to the snippets.
+    """
 
     test_key_suffix = "link_header"
     test_key_value = []
@@ -432,10 +632,40 @@ class LinkHeaderResponseHandler(base.ResponseHandler):
     def action(self, test, item, value=None):
         item = test.replace_template(item)
         link_items = requests.utils.parse_header_links(test.response["Link"])
+        for link in link_items:
+            link["url"] = re.sub(
+                r"(?<=[?&]marker=)[^&]+",
+                lambda match: _cursor_slug(match.group(0)),
+                link["url"],
+            )
 
         test.assertIn(item, link_items)
 
 
+class NdjsonResponseHandler(base.ResponseHandler):
+    """Newline-delimited JSON response handler for Gabbi.
+
+    Each line of the response body is parsed as a JSON object, and compared
+    with the expected object in the same position. Only the fields listed in
+    the expected objects are compared, but the number of lines must match.
+    """
+
+    test_key_suffix = "ndjson_lines"
+    test_key_value = []
+
+    def __call__(self, test):
+        expected = test.test_data[self._key]
+        if not expected:
+            return
+
+        expected = test.replace_template(expected)
+        lines = [json.loads(line) for line in test.output.splitlines() if line.strip()]
+        test.assertEqual(len(expected), len(lines), test.output)
+        for item, line in zip(expected, lines):
+            for key, value in item.items():
+                test.assertEqual(value, line.get(key), line)
+
+
 def _wait_for_socket(host, port, timeout):
     """Wait for socket to start accepting connections."""
 
@@ -460,7 +690,7 @@ def pytest_generate_tests(metafunc):
         host=XSNIPPET_API_HOST,
         port=XSNIPPET_API_PORT,
         fixture_module=sys.modules[__name__],
-        response_handlers=[LinkHeaderResponseHandler],
+        response_handlers=[LinkHeaderResponseHandler, NdjsonResponseHandler],
         metafunc=metafunc,
         test_loader_name=__name__,
     )